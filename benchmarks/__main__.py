@@ -0,0 +1,116 @@
+"""
+Run the benchmarks and write their results as JSON, optionally comparing them
+with an earlier run and failing if any measurement got worse by more than a
+threshold.
+
+    python -m benchmarks --output results.json
+    python -m benchmarks --compare baseline.json --threshold 0.15
+    python -m benchmarks bench_encoding bench_fanout
+"""
+
+import argparse
+import importlib
+import json
+import platform
+import sys
+
+BENCHMARKS = [
+    "bench_encoding",
+    "bench_fanout",
+    "bench_storage",
+    "bench_stream",
+    "bench_flush",
+    "bench_catchup",
+    "bench_grip",
+]
+
+# measured fields, and whether a higher value is better. fields not listed
+#   here describe the case being measured
+HIGHER_IS_BETTER_SUFFIXES = ("_per_sec",)
+LOWER_IS_BETTER_SUFFIXES = ("_ms",)
+LOWER_IS_BETTER = ("rounds", "storage_reads")
+
+
+def metric_direction(field):
+    if field.endswith(HIGHER_IS_BETTER_SUFFIXES):
+        return 1
+    if field.endswith(LOWER_IS_BETTER_SUFFIXES) or field in LOWER_IS_BETTER:
+        return -1
+    return 0
+
+
+def describe(result):
+    return ", ".join(
+        "%s=%s" % (k, v) for k, v in result.items() if metric_direction(k) == 0
+    )
+
+
+# return a list of (benchmark, case, field, old, new, change) for every
+#   measurement that got worse by more than threshold
+def compare(baseline, current, threshold):
+    regressions = []
+    for name, results in current["benchmarks"].items():
+        old_results = baseline["benchmarks"].get(name)
+        if old_results is None or len(old_results) != len(results):
+            continue
+        for old, new in zip(old_results, results):
+            for field, value in new.items():
+                direction = metric_direction(field)
+                old_value = old.get(field)
+                if direction == 0 or not old_value or value is None:
+                    continue
+                change = (value - old_value) / float(old_value)
+                if change * direction < -threshold:
+                    regressions.append(
+                        (name, describe(new), field, old_value, value, change)
+                    )
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m benchmarks")
+    parser.add_argument("benchmarks", nargs="*", default=BENCHMARKS)
+    parser.add_argument("--output", help="write results to this file")
+    parser.add_argument("--compare", help="baseline results to compare with")
+    parser.add_argument(
+        "--threshold",
+        type=float,
+        default=0.15,
+        help="allowed relative change before failing (default 0.15)",
+    )
+    args = parser.parse_args(argv)
+
+    current = {
+        "python": platform.python_version(),
+        "machine": platform.machine(),
+        "benchmarks": {},
+    }
+    for name in args.benchmarks:
+        module = importlib.import_module("benchmarks.%s" % name)
+        sys.stderr.write("running %s\n" % name)
+        current["benchmarks"][name] = module.run()
+
+    out = json.dumps(current, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(out + "\n")
+    else:
+        print(out)
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        regressions = compare(baseline, current, args.threshold)
+        for name, case, field, old, new, change in regressions:
+            sys.stderr.write(
+                "regression: %s (%s) %s %s -> %s (%+.1f%%)\n"
+                % (name, case, field, old, new, change * 100)
+            )
+        if regressions:
+            return 1
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
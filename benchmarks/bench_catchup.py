@@ -0,0 +1,75 @@
+"""
+Count the get_events round trips a client needs to catch up when it is far
+behind on one channel and current on the others.
+
+    python -m benchmarks.bench_catchup
+"""
+
+import json
+import math
+from unittest.mock import patch
+
+from .common import setup_django, Timer
+
+CHANNELS = 10
+BACKLOG = 1000
+LIMIT = 100
+
+
+def run():
+    setup_django(migrate=True)
+
+    from django_eventstream.eventrequest import EventRequest
+    from django_eventstream.eventstream import get_events
+    from django_eventstream.storage import DjangoModelStorage
+
+    storage = DjangoModelStorage()
+    channels = ["catchup-%d" % i for i in range(CHANNELS)]
+
+    for channel in channels[1:]:
+        storage.append_event(channel, "message", "x")
+    for _ in range(BACKLOG):
+        storage.append_event(channels[0], "message", "x")
+
+    request = EventRequest()
+    request.is_next = False
+    request.is_recover = False
+    request.channels = channels
+    request.channel_last_ids = {channels[0]: 0}
+    for channel in channels[1:]:
+        request.channel_last_ids[channel] = 1
+
+    rounds = 0
+    received = 0
+    with (
+        patch("django_eventstream.eventstream.get_storage", return_value=storage),
+        patch.object(storage, "get_events", wraps=storage.get_events) as reads,
+    ):
+        with Timer() as t:
+            while True:
+                resp = get_events(request, limit=LIMIT, user=None)
+                rounds += 1
+                for channel, items in resp.channel_items.items():
+                    received += len(items)
+                    if items and channel not in resp.channel_more:
+                        request.channel_last_ids[channel] = items[-1].id
+                if not resp.channel_more:
+                    break
+
+    return [
+        {
+            "channels": CHANNELS,
+            "backlog": BACKLOG,
+            "limit": LIMIT,
+            "events": received,
+            "rounds": rounds,
+            "even_split_rounds": math.ceil(BACKLOG / (LIMIT / CHANNELS)),
+            "storage_reads": reads.call_count,
+            "elapsed_ms": round(t.elapsed * 1000, 2),
+        }
+    ]
+
+
+if __name__ == "__main__":
+    for result in run():
+        print(json.dumps(result))
@@ -0,0 +1,54 @@
+"""
+Measure the per-event encoding helpers: SSE framing, event id building and
+Last-Event-ID parsing.
+
+    python -m benchmarks.bench_encoding
+"""
+
+import json
+
+from .common import setup_django, measure
+
+DATA = json.dumps({"text": "hello world", "n": 12345, "items": [1, 2, 3]})
+
+
+def run():
+    setup_django()
+
+    from django_eventstream.utils import (
+        sse_encode_event,
+        make_id,
+        parse_last_event_id,
+        parse_last_event_id_cached,
+    )
+
+    one = {"room-1": "1234"}
+    many = {"room-%d" % i: str(1000 + i) for i in range(10)}
+    one_id = make_id(one)
+    many_id = make_id(many)
+
+    # parse without the memo, as for a client seen for the first time
+    parse_uncached = parse_last_event_id_cached.__wrapped__
+
+    cases = [
+        (
+            "sse_encode_event",
+            lambda: sse_encode_event("message", DATA, event_id=one_id),
+        ),
+        (
+            "sse_encode_event_escape",
+            lambda: sse_encode_event("message", DATA, event_id="%I", escape=True),
+        ),
+        ("make_id_1", lambda: make_id(one)),
+        ("make_id_10", lambda: make_id(many)),
+        ("parse_last_event_id_1", lambda: parse_uncached(one_id)),
+        ("parse_last_event_id_10", lambda: parse_uncached(many_id)),
+        ("parse_last_event_id_10_cached", lambda: parse_last_event_id(many_id)),
+    ]
+
+    return [{"name": name, "ops_per_sec": measure(fn)} for name, fn in cases]
+
+
+if __name__ == "__main__":
+    for result in run():
+        print(json.dumps(result))
@@ -0,0 +1,52 @@
+"""
+Measure ListenerManager.add_to_queues for one channel with different numbers
+of listeners. Listeners are drained after each call so queues never fill.
+
+    python -m benchmarks.bench_fanout
+"""
+
+import json
+
+from .common import setup_django, measure
+
+FANOUTS = [1, 10, 100, 1000]
+
+
+def run():
+    setup_django()
+
+    from django_eventstream.event import Event
+    from django_eventstream.views import Listener, ListenerManager
+
+    results = []
+    for fanout in FANOUTS:
+        lm = ListenerManager()
+        listeners = []
+        for _ in range(fanout):
+            listener = Listener()
+            listener.channels = {"fanout"}
+            listener.wake_threadsafe = lambda: None
+            lm.add_listener(listener)
+            listeners.append(listener)
+
+        e = Event("fanout", "message", "x", id=1)
+
+        def publish():
+            lm.add_to_queues("fanout", e)
+            for listener in listeners:
+                listener.channel_items = {}
+
+        rate = measure(publish)
+        results.append(
+            {
+                "fanout": fanout,
+                "ops_per_sec": rate,
+                "deliveries_per_sec": rate * fanout,
+            }
+        )
+    return results
+
+
+if __name__ == "__main__":
+    for result in run():
+        print(json.dumps(result))
@@ -0,0 +1,91 @@
+"""
+Measure how the stream flush policy affects the number of chunks written
+(each chunk is one ASGI body message, and usually one send syscall) and the
+delivery throughput for a single listener on a busy channel.
+
+    python -m benchmarks.bench_flush
+"""
+
+import asyncio
+import json
+from unittest.mock import patch
+
+from .common import setup_django, Timer
+
+CHANNEL = "bench"
+EVENTS = 20000
+EVENTS_PER_TICK = 5
+POLICIES = [(0, 65536), (2, 65536), (10, 65536), (10, 4096)]
+
+
+async def run_policy(delay, max_bytes):
+    from django.test import override_settings
+    from django_eventstream.event import Event
+    from django_eventstream.eventrequest import EventRequest
+    from django_eventstream.views import Listener, stream, get_listener_manager
+
+    request = EventRequest()
+    request.is_next = False
+    request.is_recover = False
+    request.channels = [CHANNEL]
+    request.channel_last_ids = {}
+
+    listener = Listener()
+    listener.channels = set(request.channels)
+
+    lm = get_listener_manager()
+    e = Event(CHANNEL, "message", json.dumps({"n": 0, "text": "x" * 64}))
+
+    with (
+        override_settings(
+            EVENTSTREAM_FLUSH_DELAY=delay, EVENTSTREAM_FLUSH_MAX_BYTES=max_bytes
+        ),
+        patch("django_eventstream.eventstream.get_storage", return_value=None),
+        patch("django_eventstream.views.MAX_PENDING", EVENTS),
+    ):
+        response = stream(request, listener)
+
+        # skip padding and stream-open
+        await response.__anext__()
+
+        async def publish():
+            for _ in range(int(EVENTS / EVENTS_PER_TICK)):
+                for _ in range(EVENTS_PER_TICK):
+                    lm.add_to_queues(CHANNEL, e)
+                await asyncio.sleep(0)
+
+        chunks = 0
+        received = 0
+        size = 0
+        with Timer() as t:
+            task = asyncio.ensure_future(publish())
+            while received < EVENTS:
+                chunk = await response.__anext__()
+                chunks += 1
+                size += len(chunk)
+                received += chunk.count("event: message\n")
+            await task
+        await response.aclose()
+
+    return {
+        "delay_ms": delay,
+        "max_bytes": max_bytes,
+        "events": received,
+        "chunks": chunks,
+        "bytes": size,
+        "events_per_chunk": round(received / chunks, 2),
+        "events_per_sec": round(received / t.elapsed),
+    }
+
+
+def run():
+    setup_django()
+    results = []
+    for delay, max_bytes in POLICIES:
+        results.append(asyncio.run(run_policy(delay, max_bytes)))
+    return results
+
+
+if __name__ == "__main__":
+    for result in run():
+        print(json.dumps(result))
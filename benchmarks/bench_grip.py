@@ -0,0 +1,100 @@
+"""
+Measure proxied requests per second through the events view, as seen when
+a GRIP proxy opens and renews streams. Requests carry a Grip-Sig header and
+pass through GripMiddleware, with a proxy configured that needs no signature.
+
+    python -m benchmarks.bench_grip
+"""
+
+import json
+from unittest.mock import patch
+
+from .common import setup_django, Timer
+
+CHANNELS = ["grip-a", "grip-b", "grip-c"]
+REQUESTS = 2000
+
+
+def run_mode(cached, link):
+    from django.test import RequestFactory
+    from django_grip import GripMiddleware
+    from django_eventstream import eventresponse
+    from django_eventstream.utils import LRUCache
+    from django_eventstream.views import events
+
+    middleware = GripMiddleware(lambda request: None)
+    factory = RequestFactory()
+
+    params = {"channel": CHANNELS}
+    if link == "next":
+        # the next link handed out on the first request
+        request = factory.get("/events/", params, HTTP_GRIP_SIG="x")
+        middleware.process_request(request)
+        middleware.process_response(request, events(request))
+        next_link = request.grip.instruct.next_link
+
+    patches = []
+    if not cached:
+        patches = [
+            patch.object(eventresponse, "token_cache", LRUCache(0)),
+            patch.object(
+                eventresponse,
+                "get_id_format",
+                eventresponse.get_id_format.__wrapped__,
+            ),
+            patch.object(
+                eventresponse,
+                "get_grip_channel_name",
+                eventresponse.get_grip_channel_name.__wrapped__,
+            ),
+        ]
+
+    for p in patches:
+        p.start()
+    try:
+        with Timer() as t:
+            for _ in range(REQUESTS):
+                if link == "next":
+                    request = factory.get(next_link, HTTP_GRIP_SIG="x")
+                else:
+                    request = factory.get("/events/", params, HTTP_GRIP_SIG="x")
+                middleware.process_request(request)
+                response = middleware.process_response(request, events(request))
+                assert response.status_code == 200
+    finally:
+        for p in patches:
+            p.stop()
+
+    return {
+        "link": link,
+        "cached": cached,
+        "requests": REQUESTS,
+        "requests_per_sec": round(REQUESTS / t.elapsed),
+    }
+
+
+def run():
+    setup_django(migrate=True)
+
+    from django.test import override_settings
+    from django_eventstream.storage import DjangoModelStorage
+
+    storage = DjangoModelStorage()
+    for channel in CHANNELS:
+        for _ in range(10):
+            storage.append_event(channel, "message", json.dumps({"x": 1}))
+
+    results = []
+    with (
+        override_settings(GRIP_PROXIES=[{"control_uri": "http://localhost:5561"}]),
+        patch("django_eventstream.eventstream.get_storage", return_value=storage),
+    ):
+        for link in ("open", "next"):
+            for cached in (False, True):
+                results.append(run_mode(cached, link))
+    return results
+
+
+if __name__ == "__main__":
+    for result in run():
+        print(json.dumps(result))
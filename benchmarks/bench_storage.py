@@ -0,0 +1,84 @@
+"""
+Measure appending events to storage and replaying them, with
+DjangoModelStorage on SQLite, RedisStorage against an in-process fake Redis
+server, and SegmentFileStorage in a temporary directory, with and without
+flushing each append to disk.
+
+    python -m benchmarks.bench_storage
+"""
+
+import json
+import shutil
+import tempfile
+
+from .common import setup_django, Timer
+from .fakeredis import FakeRedisServer
+
+EVENTS = 1000
+LIMIT = 100
+DATA = json.dumps({"text": "hello world", "n": 12345})
+
+
+def run_backend(name, storage):
+    channel = "bench-%s" % name
+
+    with Timer() as t:
+        for _ in range(EVENTS):
+            storage.append_event(channel, "message", DATA)
+    append_elapsed = t.elapsed
+
+    replayed = 0
+    with Timer() as t:
+        last_id = 0
+        while True:
+            events = storage.get_events(channel, last_id, limit=LIMIT)
+            if not events:
+                break
+            replayed += len(events)
+            last_id = events[-1].id
+    replay_elapsed = t.elapsed
+
+    assert replayed == EVENTS
+
+    return {
+        "backend": name,
+        "events": EVENTS,
+        "appends_per_sec": round(EVENTS / append_elapsed),
+        "replayed_per_sec": round(replayed / replay_elapsed),
+    }
+
+
+def run():
+    setup_django(migrate=True)
+
+    from django.test import override_settings
+    from django_eventstream.storage import (
+        DjangoModelStorage,
+        RedisStorage,
+        SegmentFileStorage,
+    )
+
+    results = [run_backend("django", DjangoModelStorage())]
+
+    with FakeRedisServer() as server:
+        with override_settings(
+            EVENTSTREAM_STORAGE_CONNECTION=server.connection_details
+        ):
+            results.append(run_backend("redis", RedisStorage()))
+
+    for name, fsync in (("segment", True), ("segment-nosync", False)):
+        path = tempfile.mkdtemp()
+        try:
+            with override_settings(
+                EVENTSTREAM_SEGMENT_STORAGE={"path": path, "fsync": fsync}
+            ):
+                results.append(run_backend(name, SegmentFileStorage()))
+        finally:
+            shutil.rmtree(path)
+
+    return results
+
+
+if __name__ == "__main__":
+    for result in run():
+        print(json.dumps(result))
@@ -0,0 +1,106 @@
+"""
+Measure the stream() generator end to end while a client catches up on a
+stored backlog, then receives live events, counting the events and bytes it
+produces per second.
+
+    python -m benchmarks.bench_stream
+"""
+
+import asyncio
+import json
+from unittest.mock import patch
+
+from .common import setup_django, Timer
+
+CHANNEL = "bench-stream"
+BACKLOG = 2000
+LIVE = 5000
+DATA = json.dumps({"text": "hello world", "n": 12345})
+
+
+async def read_until(response, events):
+    received = 0
+    size = 0
+    while received < events:
+        chunk = await response.__anext__()
+        size += len(chunk)
+        received += chunk.count("event: message\n")
+    return received, size
+
+
+async def run_stream(storage, current_id):
+    from django_eventstream.event import Event
+    from django_eventstream.eventrequest import EventRequest
+    from django_eventstream.views import Listener, stream, get_listener_manager
+
+    request = EventRequest()
+    request.is_next = False
+    request.is_recover = False
+    request.channels = [CHANNEL]
+    request.channel_last_ids = {CHANNEL: "0"}
+
+    listener = Listener()
+    listener.channels = set(request.channels)
+
+    lm = get_listener_manager()
+    results = []
+
+    with (
+        patch("django_eventstream.eventstream.get_storage", return_value=storage),
+        patch("django_eventstream.views.MAX_PENDING", LIVE),
+    ):
+        response = stream(request, listener)
+
+        with Timer() as t:
+            received, size = await read_until(response, BACKLOG)
+        results.append(
+            {
+                "phase": "catchup",
+                "events": received,
+                "events_per_sec": round(received / t.elapsed),
+                "bytes_per_sec": round(size / t.elapsed),
+            }
+        )
+
+        async def publish():
+            for n in range(LIVE):
+                e = Event(CHANNEL, "message", DATA, id=current_id + n + 1)
+                lm.add_to_queues(CHANNEL, e)
+                if n % 10 == 0:
+                    await asyncio.sleep(0)
+
+        with Timer() as t:
+            task = asyncio.ensure_future(publish())
+            received, size = await read_until(response, LIVE)
+            await task
+        results.append(
+            {
+                "phase": "live",
+                "events": received,
+                "events_per_sec": round(received / t.elapsed),
+                "bytes_per_sec": round(size / t.elapsed),
+            }
+        )
+
+        await response.aclose()
+
+    return results
+
+
+def run():
+    setup_django(migrate=True)
+
+    from django_eventstream.storage import DjangoModelStorage
+
+    storage = DjangoModelStorage()
+    for _ in range(BACKLOG):
+        storage.append_event(CHANNEL, "message", DATA)
+
+    current_id = storage.get_current_id(CHANNEL)
+
+    return asyncio.run(run_stream(storage, current_id))
+
+
+if __name__ == "__main__":
+    for result in run():
+        print(json.dumps(result))
@@ -0,0 +1,57 @@
+import os
+import time
+
+
+def setup_django(migrate=False):
+    os.environ.setdefault("DJANGO_SETTINGS_MODULE", "tests.settings")
+
+    import django
+    from django.conf import settings
+
+    # share the in-memory database with the threads that sync_to_async uses
+    db = settings.DATABASES["default"]
+    if db["ENGINE"].endswith("sqlite3") and db["NAME"] == ":memory:":
+        db["NAME"] = "file:benchmarks?mode=memory&cache=shared"
+
+    django.setup()
+
+    if migrate:
+        from django.core.management import call_command
+
+        call_command("migrate", verbosity=0)
+
+
+class Timer(object):
+    def __init__(self):
+        self.start = None
+        self.elapsed = None
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.elapsed = time.perf_counter() - self.start
+
+
+# call fn repeatedly and return the best rate in calls per second over a few
+#   rounds, each lasting at least min_time seconds
+def measure(fn, rounds=3, min_time=0.2):
+    number = 1
+    while True:
+        start = time.perf_counter()
+        for _ in range(number):
+            fn()
+        elapsed = time.perf_counter() - start
+        if elapsed >= min_time:
+            break
+        number *= 2
+
+    best = elapsed
+    for _ in range(rounds - 1):
+        start = time.perf_counter()
+        for _ in range(number):
+            fn()
+        best = min(best, time.perf_counter() - start)
+
+    return round(number / best)
@@ -0,0 +1,118 @@
+"""
+A small in-memory server speaking the Redis protocol, with just the commands
+used by RedisStorage and PUBLISH. It lets the benchmarks and tests run the
+real client, including its connection pool and protocol handling, without a
+Redis server. Expiry times are accepted and ignored, and published messages
+are recorded rather than delivered.
+"""
+
+import socket
+import socketserver
+import threading
+
+
+def encode(value):
+    if value is None:
+        return b"$-1\r\n"
+    if isinstance(value, int):
+        return b":%d\r\n" % value
+    if isinstance(value, list):
+        return b"*%d\r\n" % len(value) + b"".join(encode(v) for v in value)
+    return b"$%d\r\n%s\r\n" % (len(value), value)
+
+
+class Handler(socketserver.StreamRequestHandler):
+    def setup(self):
+        super(Handler, self).setup()
+        self.connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+    def read_command(self):
+        line = self.rfile.readline()
+        if not line:
+            return None
+        assert line[:1] == b"*"
+        args = []
+        for _ in range(int(line[1:])):
+            size = int(self.rfile.readline()[1:])
+            args.append(self.rfile.read(size + 2)[:-2])
+        return args
+
+    def execute(self, args):
+        data = self.server.data
+        name = args[0].upper()
+        if name == b"GET":
+            return encode(data.get(args[1]))
+        elif name == b"MGET":
+            return encode([data.get(k) for k in args[1:]])
+        elif name == b"SET":
+            data[args[1]] = args[2]
+            return b"+OK\r\n"
+        elif name == b"SETEX":
+            data[args[1]] = args[3]
+            return b"+OK\r\n"
+        elif name in (b"INCR", b"INCRBY"):
+            value = int(data.get(args[1], b"0")) + (
+                int(args[2]) if len(args) > 2 else 1
+            )
+            data[args[1]] = b"%d" % value
+            return encode(value)
+        elif name == b"PUBLISH":
+            self.server.published.append((args[1], args[2]))
+            return encode(0)
+        elif name == b"PING":
+            return b"+PONG\r\n"
+        else:
+            # handshake commands such as CLIENT and SELECT
+            return b"+OK\r\n"
+
+    def handle(self):
+        queued = None
+        while True:
+            args = self.read_command()
+            if args is None:
+                return
+            name = args[0].upper()
+            if name == b"MULTI":
+                queued = []
+                reply = b"+OK\r\n"
+            elif name == b"EXEC":
+                with self.server.lock:
+                    replies = [self.execute(a) for a in queued]
+                queued = None
+                reply = b"*%d\r\n" % len(replies) + b"".join(replies)
+            elif queued is not None:
+                queued.append(args)
+                reply = b"+QUEUED\r\n"
+            else:
+                with self.server.lock:
+                    reply = self.execute(args)
+            self.wfile.write(reply)
+
+
+class FakeRedisServer(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self):
+        super(FakeRedisServer, self).__init__(("127.0.0.1", 0), Handler)
+        self.data = {}
+        self.published = []
+        self.lock = threading.Lock()
+
+    @property
+    def connection_details(self):
+        # only RESP2 is spoken, so the client must not ask for RESP3
+        return {
+            "host": "127.0.0.1",
+            "port": self.server_address[1],
+            "db": 0,
+            "protocol": 2,
+        }
+
+    def __enter__(self):
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+    def __exit__(self, *exc):
+        self.shutdown()
+        self.server_close()
@@ -5,8 +5,10 @@ from .eventresponse import EventResponse
 from .eventstream import (
     EventPermissionError,
     send_event,
+    asend_event,
     get_events,
     get_current_event_id,
+    set_snapshot,
     channel_permission_changed,
 )
 
@@ -0,0 +1,113 @@
+import hashlib
+import threading
+from django.conf import settings
+from .utils import LRUCache, load_class
+
+# maximum number of entries kept by LocalAuthorizationCache
+LOCAL_CACHE_MAX = 10000
+
+
+class AuthorizationCacheBase(object):
+    def __init__(self):
+        self.ttl = getattr(settings, "EVENTSTREAM_AUTHORIZATION_CACHE_TTL", 0)
+
+    # return True or False if known, else None
+    def get(self, user_id, channel):
+        raise NotImplementedError()
+
+    def set(self, user_id, channel, allowed):
+        raise NotImplementedError()
+
+    def invalidate(self, user_id, channel):
+        raise NotImplementedError()
+
+
+class LocalAuthorizationCache(AuthorizationCacheBase):
+    """
+    Keeps results in process memory. When EVENTSTREAM_REDIS is set,
+    invalidations are passed to the other workers through Redis.
+    """
+
+    def __init__(self):
+        super(LocalAuthorizationCache, self).__init__()
+        self.entries = LRUCache(LOCAL_CACHE_MAX, ttl=self.ttl)
+
+    def get(self, user_id, channel):
+        return self.entries.get((str(user_id), channel))
+
+    def set(self, user_id, channel, allowed):
+        self.entries.set((str(user_id), channel), allowed)
+
+    def invalidate(self, user_id, channel):
+        self.entries.pop((str(user_id), channel))
+
+
+class DjangoCacheAuthorizationCache(AuthorizationCacheBase):
+    """
+    Keeps results in a Django cache, set by EVENTSTREAM_AUTHORIZATION_CACHE_ALIAS.
+    With a shared cache backend, invalidations apply to all workers at once.
+    """
+
+    def __init__(self):
+        from django.core.cache import caches
+
+        super(DjangoCacheAuthorizationCache, self).__init__()
+        alias = getattr(settings, "EVENTSTREAM_AUTHORIZATION_CACHE_ALIAS", "default")
+        self.cache = caches[alias]
+
+    @staticmethod
+    def make_key(user_id, channel):
+        channel_hash = hashlib.sha1(channel.encode("utf-8")).hexdigest()
+        return "eventstream-auth:%s:%s" % (user_id, channel_hash)
+
+    def get(self, user_id, channel):
+        return self.cache.get(self.make_key(user_id, channel))
+
+    def set(self, user_id, channel, allowed):
+        self.cache.set(self.make_key(user_id, channel), allowed, self.ttl)
+
+    def invalidate(self, user_id, channel):
+        self.cache.delete(self.make_key(user_id, channel))
+
+
+authorization_cache = None
+authorization_cache_loaded = False
+authorization_cache_lock = threading.Lock()
+
+
+# return the process-wide authorization cache, or None if disabled
+def get_authorization_cache():
+    global authorization_cache, authorization_cache_loaded
+    with authorization_cache_lock:
+        if not authorization_cache_loaded:
+            if getattr(settings, "EVENTSTREAM_AUTHORIZATION_CACHE_TTL", 0) > 0:
+                authorization_cache = load_class(
+                    getattr(
+                        settings,
+                        "EVENTSTREAM_AUTHORIZATION_CACHE_CLASS",
+                        "django_eventstream.authcache.LocalAuthorizationCache",
+                    )
+                )
+            authorization_cache_loaded = True
+    return authorization_cache
+
+
+# ids are strings, so they compare equal after being sent to other
+#   processes as JSON, whatever the type of the primary key
+def get_user_id(user):
+    return str(user.pk) if user else "anonymous"
+
+
+# user_id may be given to avoid evaluating a lazily loaded user on cache hits
+def can_read_channel(channelmanager, user, channel, user_id=None):
+    cache = get_authorization_cache()
+    if cache is None:
+        return channelmanager.can_read_channel(user, channel)
+
+    if user_id is None:
+        user_id = get_user_id(user)
+    allowed = cache.get(user_id, channel)
+    if allowed is None:
+        allowed = bool(channelmanager.can_read_channel(user, channel))
+        cache.set(user_id, channel, allowed)
+    return allowed
@@ -1,4 +1,4 @@
-from dataclasses import dataclass
+from dataclasses import dataclass, field
 from typing import Optional
 
 # Object class replaced with dataclass for type safety
@@ -10,3 +10,5 @@ class Event:
     type: str
     data: dict
     id: Optional[int] = None
+    # timing of a sampled event through the pipeline, see tracing.py
+    trace: Optional[dict] = field(default=None, repr=False, compare=False)
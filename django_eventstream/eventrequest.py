@@ -3,7 +3,15 @@ import jwt
 import six
 from django.contrib.auth import get_user_model
 from django.conf import settings
-from .utils import parse_last_event_id, get_channelmanager
+from django.utils.functional import SimpleLazyObject
+from .authcache import get_user_id
+from .utils import (
+    LRUCache,
+    get_channelmanager,
+    is_compact_id,
+    parse_compact_id,
+    parse_last_event_id,
+)
 
 try:
     from urllib import unquote
@@ -11,6 +19,49 @@ except ImportError:
     from urllib.parse import unquote
 
 
+# maximum number of decoded es-meta tokens to keep
+TOKEN_CACHE_SIZE = 1024
+
+# maximum number of users to keep, if EVENTSTREAM_USER_CACHE_TTL is set
+USER_CACHE_SIZE = 1024
+
+token_cache = LRUCache(TOKEN_CACHE_SIZE)
+user_cache = LRUCache(USER_CACHE_SIZE)
+
+
+def decode_es_meta(token):
+    # tokens are reused across renewals, so keep the decoded claims around
+    es_meta = token_cache.get(token)
+    if es_meta is None:
+        es_meta = jwt.decode(
+            token,
+            settings.SECRET_KEY.encode("utf-8"),
+            algorithms=["HS256"],
+        )
+        token_cache.set(token, es_meta)
+
+    if int(time.time()) >= es_meta["exp"]:
+        token_cache.pop(token)
+        raise ValueError("es-meta signature is expired")
+
+    return es_meta
+
+
+def get_user(user_id):
+    ttl = getattr(settings, "EVENTSTREAM_USER_CACHE_TTL", 0)
+    if ttl > 0:
+        user = user_cache.get(user_id)
+        if user is not None:
+            return user
+
+    user = get_user_model().objects.get(pk=user_id)
+
+    if ttl > 0:
+        user_cache.set(user_id, user, ttl=ttl)
+
+    return user
+
+
 class EventRequest(object):
     class Error(ValueError):
         pass
@@ -29,6 +80,8 @@ class EventRequest(object):
         self.channel_last_ids = {}
         self.is_recover = False
         self.user = None
+        self.user_id = None
+        self.event_types = None
 
         if http_request:
             self.apply_http_request(
@@ -42,20 +95,17 @@ class EventRequest(object):
 
         es_meta = {}
         if http_request.GET.get("es-meta"):
-            es_meta = jwt.decode(
-                http_request.GET["es-meta"],
-                settings.SECRET_KEY.encode("utf-8"),
-                algorithms=["HS256"],
-            )
-            if int(time.time()) >= es_meta["exp"]:
-                raise ValueError("es-meta signature is expired")
+            es_meta = decode_es_meta(http_request.GET["es-meta"])
 
         if "user" in es_meta:
-            if es_meta["user"] != "anonymous":
-                user = get_user_model().objects.get(pk=es_meta["user"])
+            user_id = es_meta["user"]
+            if user_id != "anonymous":
+                # only loaded if something needs more than the id
+                user = SimpleLazyObject(lambda: get_user(user_id))
         else:
             if hasattr(http_request, "user") and http_request.user.is_authenticated:
                 user = http_request.user
+            user_id = get_user_id(user)
 
         if "channels" in es_meta:
             channels = es_meta["channels"]
@@ -71,6 +121,14 @@ class EventRequest(object):
         if len(channels) > channel_limit:
             raise EventRequest.Error("Channel limit exceeded")
 
+        # optional filter on event types, by view keywords else query params
+        if "event_types" in view_kwargs:
+            event_types = set(view_kwargs["event_types"])
+        else:
+            event_types = set(http_request.GET.getlist("event_type"))
+        if not event_types:
+            event_types = None
+
         if http_request.GET.get("link") == "next":
             is_next = True
 
@@ -99,13 +157,17 @@ class EventRequest(object):
                     )
 
                 try:
-                    parsed = parse_last_event_id(last_event_id)
-
                     channel_last_ids = {}
-                    for channel, last_id in six.iteritems(parsed):
-                        channel = unquote(channel)
-                        if channel in channels:
+                    if is_compact_id(last_event_id):
+                        parsed = parse_compact_id(last_event_id, channels)
+                        for channel, last_id in six.iteritems(parsed):
                             channel_last_ids[channel] = last_id
+                    else:
+                        parsed = parse_last_event_id(last_event_id)
+                        for channel, last_id in six.iteritems(parsed):
+                            channel = unquote(channel)
+                            if channel in channels:
+                                channel_last_ids[channel] = last_id
                 except:
                     raise EventRequest.Error(
                         "Failed to parse Last-Event-ID or lastEventId"
@@ -118,3 +180,5 @@ class EventRequest(object):
         self.is_next = is_next
         self.is_recover = is_recover
         self.user = user
+        self.user_id = user_id
+        self.event_types = event_types
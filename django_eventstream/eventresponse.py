@@ -1,17 +1,66 @@
 import copy
+import functools
 import time
 import jwt
 import six
 from gripcontrol import Channel
 from django.conf import settings
 from django.http import HttpResponse
-from .utils import sse_encode_event, make_id, build_id_escape
+from .utils import sse_encode_event, make_id, build_id_escape, LRUCache
 
 try:
     from urllib import quote
 except ImportError:
     from urllib.parse import quote
 
+# lifetime of the es-meta token given to the proxy, in seconds
+ES_META_TTL = 3600
+
+# reuse a token until it has less than this many seconds left
+ES_META_REFRESH = 600
+
+TOKEN_CACHE_SIZE = 1024
+
+STREAM_OPEN = ":" + (" " * 2048) + "\n\n" + "event: stream-open\ndata:\n\n"
+
+KEEP_ALIVE = "event: keep-alive\ndata:\n\n"
+
+# signed tokens, by channels and user
+token_cache = LRUCache(TOKEN_CACHE_SIZE)
+
+
+def get_es_meta_token(channels, user_id):
+    key = (tuple(channels), user_id)
+    token = token_cache.get(key)
+    if token is None:
+        es_meta = {
+            "iss": "es",
+            "exp": int(time.time()) + ES_META_TTL,
+            "channels": list(channels),
+            "user": user_id,
+        }
+        token = six.ensure_text(
+            jwt.encode(es_meta, settings.SECRET_KEY.encode("utf-8"))
+        )
+        token_cache.set(key, token, ttl=ES_META_TTL - ES_META_REFRESH)
+    return token
+
+
+@functools.lru_cache(maxsize=4096)
+def get_grip_channel_name(channel):
+    return "events-%s" % quote(channel)
+
+
+@functools.lru_cache(maxsize=4096)
+def get_id_format(channels):
+    id_parts = []
+    for channel in channels:
+        enc_channel = quote(channel)
+        id_parts.append(
+            "%s:%%(events-%s)s" % (build_id_escape(enc_channel), enc_channel)
+        )
+    return ",".join(id_parts)
+
 
 class EventResponse(object):
     def __init__(self):
@@ -19,9 +68,15 @@ class EventResponse(object):
         self.channel_last_ids = {}
         self.channel_reset = set()
         self.channel_more = set()
+        # channels where reading stopped at an event not yet visible
+        self.channel_gaps = set()
+        # position read up to, for channels whose last read events were
+        #   filtered out and so aren't in channel_items
+        self.channel_read_ids = {}
         self.is_next = False
         self.is_recover = False
         self.user = None
+        self.user_id = None
 
     def to_grip_response(self, http_request):
         last_ids = copy.deepcopy(self.channel_last_ids)
@@ -30,8 +85,7 @@ class EventResponse(object):
         body = ""
 
         if not self.is_next:
-            body += ":" + (" " * 2048) + "\n\n"
-            body += "event: stream-open\ndata:\n\n"
+            body += STREAM_OPEN
 
         if len(self.channel_reset) > 0:
             body += sse_encode_event(
@@ -49,11 +103,18 @@ class EventResponse(object):
                     item.type, item.data, event_id=event_id, escape=True
                 )
 
+        if self.channel_read_ids:
+            last_ids.update(self.channel_read_ids)
+            event_id = make_id(last_ids)
+
         resp = HttpResponse(body, content_type="text/event-stream")
 
         more = len(self.channel_more) > 0
 
-        user_id = str(self.user.id) if self.user else "anonymous"
+        if self.user_id is not None:
+            user_id = str(self.user_id)
+        else:
+            user_id = str(self.user.id) if self.user else "anonymous"
 
         params = http_request.GET.copy()
         params["link"] = "next"
@@ -65,15 +126,7 @@ class EventResponse(object):
             params["recover"] = "true"
             if "lastEventId" in params:
                 del params["lastEventId"]
-        es_meta = {
-            "iss": "es",
-            "exp": int(time.time()) + 3600,
-            "channels": list(self.channel_items.keys()),
-            "user": user_id,
-        }
-        params["es-meta"] = six.ensure_text(
-            jwt.encode(es_meta, settings.SECRET_KEY.encode("utf-8"))
-        )
+        params["es-meta"] = get_es_meta_token(self.channel_items.keys(), user_id)
         next_uri = http_request.path + "?" + params.urlencode()
 
         instruct = http_request.grip.start_instruct()
@@ -81,9 +134,8 @@ class EventResponse(object):
         instruct.set_next_link(next_uri)
 
         for channel in six.iterkeys(self.channel_items):
-            enc_channel = quote(channel)
             last_id = last_ids.get(channel)
-            gc = Channel("events-%s" % enc_channel, prev_id=last_id)
+            gc = Channel(get_grip_channel_name(channel), prev_id=last_id)
             if last_id:
                 gc.filters.append("build-id")
             gc.filters.append("skip-users")
@@ -97,17 +149,10 @@ class EventResponse(object):
             instruct.set_hold_stream()
 
         if len(last_ids) > 0:
-            id_parts = []
-            for channel in six.iterkeys(last_ids):
-                enc_channel = quote(channel)
-                id_parts.append(
-                    "%s:%%(events-%s)s" % (build_id_escape(enc_channel), enc_channel)
-                )
-            id_format = ",".join(id_parts)
-            instruct.meta["id_format"] = id_format
+            instruct.meta["id_format"] = get_id_format(tuple(last_ids.keys()))
 
         instruct.meta["user"] = user_id
 
-        instruct.set_keep_alive("event: keep-alive\ndata:\n\n", 20)
+        instruct.set_keep_alive(KEEP_ALIVE, 20)
 
         return resp
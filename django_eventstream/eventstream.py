@@ -1,8 +1,17 @@
 import copy
 import json
 import logging
+import six
+from asgiref.sync import sync_to_async
 from django.core.serializers.json import DjangoJSONEncoder
-from .storage import EventDoesNotExist
+from .pgnotify import get_postgres_notifier
+from .storage import (
+    DjangoModelStorage,
+    EventDoesNotExist,
+    PartialEvents,
+    get_read_coalescer,
+)
+from .authcache import can_read_channel, get_authorization_cache, get_user_id
 from .eventresponse import EventResponse
 from .utils import (
     make_id,
@@ -10,6 +19,8 @@ from .utils import (
     publish_kick,
     get_storage,
     get_channelmanager,
+    get_async_redis_client,
+    get_redis_client,
 )
 from django.conf import settings
 
@@ -34,124 +45,443 @@ if hasattr(settings, "EVENTSTREAM_REDIS"):
             "You must install the redis package to use RedisListener for multiprocess event handling. \n pip install redis"
         )
 
-    redis_client = redis.Redis(**settings.EVENTSTREAM_REDIS)
+    redis_client = get_redis_client(settings.EVENTSTREAM_REDIS)
+
+
+# the message passed to other processes about an event
+def make_message(e, trace=None):
+    message = {
+        "channel": e.channel,
+        "event_type": e.type,
+        "data": e.data,
+        "pub_id": str(e.id) if e.id is not None else None,
+    }
+    if trace:
+        message["trace"] = trace
+    return message
+
+
+class EventSend(object):
+    """
+    The steps of sending an event, shared by send_event and asend_event.
+    They differ only in how they wait for the storage append, the
+    notification, the Redis publish and the GRIP publish in between.
+    """
+
+    def __init__(self, channel, event_type, data, json_encode=True):
+        from .metrics import get_metrics
+        from .tracing import start_trace
+
+        get_metrics().inc("eventstream_events_sent_total")
+
+        self.trace = start_trace()
+
+        if json_encode:
+            data = json.dumps(data, cls=DjangoJSONEncoder)
+
+        self.channel = channel
+        self.event_type = event_type
+        self.data = data
+
+        # storage to append to, if the channel is stored
+        self.storage = get_storage()
+        if self.storage and not get_channelmanager().is_channel_reliable(channel):
+            self.storage = None
+
+        self.notifier = None if redis_client else get_postgres_notifier()
+        self.notified = False
+
+    def stored(self, e):
+        from .tracing import mark_stage
+
+        if self.trace:
+            mark_stage(self.trace, "append")
+        if self.notifier:
+            self.notifier.notify(make_message(e, self.trace))
+
+    # keyword arguments for the storage append
+    def get_append_kwargs(self):
+        if self.notifier and isinstance(self.storage, DjangoModelStorage):
+            # notify in the transaction inserting the event
+            self.notified = True
+            return {"on_insert": self.stored}
+        return {}
+
+    def make_event(self):
+        from .event import Event
+
+        return Event(self.channel, self.event_type, self.data)
+
+    # return the message to send with the notifier after the append, or
+    #   after making the event when the channel isn't stored, if any
+    def get_notification(self, e):
+        from .tracing import mark_stage
+
+        if self.notified:
+            return None
+        if self.storage and self.trace:
+            mark_stage(self.trace, "append")
+        if self.notifier:
+            return make_message(e, self.trace)
+        return None
+
+    # send to local listeners, unless another process does. returns the
+    #   message to publish to Redis, if enabled
+    def deliver(self, e):
+        from .views import get_listener_manager
+
+        e.trace = self.trace
+
+        if redis_client:
+            return json.dumps(make_message(e, self.trace))
+        if not self.notifier:
+            get_listener_manager().add_to_queues(self.channel, e)
+        return None
+
+    # positional arguments for publish_event
+    def get_publish_args(self, e):
+        if self.storage:
+            pub_id = str(e.id)
+            pub_prev_id = str(e.id - 1)
+        else:
+            pub_id = None
+            pub_prev_id = None
+        return (self.channel, self.event_type, self.data, pub_id, pub_prev_id)
 
 
 def send_event(
     channel, event_type, data, skip_user_ids=None, async_publish=True, json_encode=True
 ):
-    from .event import Event
-    from .views import get_listener_manager
-
-    if json_encode:
-        data = json.dumps(data, cls=DjangoJSONEncoder)
-
     if skip_user_ids is None:
         skip_user_ids = []
 
-    storage = get_storage()
-    channelmanager = get_channelmanager()
+    send = EventSend(channel, event_type, data, json_encode=json_encode)
 
-    if channelmanager.is_channel_reliable(channel) and storage:
-        e = storage.append_event(channel, event_type, data)
-        pub_id = str(e.id)
-        pub_prev_id = str(e.id - 1)
+    if send.storage:
+        e = send.storage.append_event(
+            channel, event_type, send.data, **send.get_append_kwargs()
+        )
     else:
-        e = Event(channel, event_type, data)
-        pub_id = None
-        pub_prev_id = None
+        e = send.make_event()
 
-    # Publish event to Redis Pub/Sub if enabled
-    if redis_client:
-        redis_message = {
-            "channel": channel,
-            "event_type": event_type,
-            "data": data,
-            "pub_id": pub_id,
-        }
-        redis_client.publish("events_channel", json.dumps(redis_message))
-    else:
-        # Send to local listeners
-        get_listener_manager().add_to_queues(channel, e)
+    message = send.get_notification(e)
+    if message:
+        send.notifier.notify(message)
+
+    # Publish event to Redis Pub/Sub if enabled, or send to local listeners
+    message = send.deliver(e)
+    if message:
+        redis_client.publish("events_channel", message)
 
     # Publish through grip proxy
     publish_event(
-        channel,
-        event_type,
-        data,
-        pub_id,
-        pub_prev_id,
+        *send.get_publish_args(e),
         skip_user_ids=skip_user_ids,
         blocking=(not async_publish),
     )
 
 
+async def asend_event(
+    channel, event_type, data, skip_user_ids=None, async_publish=True, json_encode=True
+):
+    """
+    Like send_event, for use in async code. Storage appends and Redis
+    publishes are awaited instead of blocking the event loop, and listeners
+    served by the calling loop are woken directly.
+    """
+    if skip_user_ids is None:
+        skip_user_ids = []
+
+    send = EventSend(channel, event_type, data, json_encode=json_encode)
+
+    if send.storage:
+        e = await send.storage.aappend_event(
+            channel, event_type, send.data, **send.get_append_kwargs()
+        )
+    else:
+        e = send.make_event()
+
+    message = send.get_notification(e)
+    if message:
+        await sync_to_async(send.notifier.notify)(message)
+
+    # Publish event to Redis Pub/Sub if enabled, or send to local listeners
+    message = send.deliver(e)
+    if message:
+        client = get_async_redis_client(settings.EVENTSTREAM_REDIS)
+        await client.publish("events_channel", message)
+
+    # Publish through grip proxy
+    if async_publish:
+        # only queues the item
+        publish_event(
+            *send.get_publish_args(e), skip_user_ids=skip_user_ids, blocking=False
+        )
+    else:
+        await sync_to_async(publish_event, thread_sensitive=False)(
+            *send.get_publish_args(e), skip_user_ids=skip_user_ids, blocking=True
+        )
+
+
+# split a read limit across channels. every channel gets at least an even
+#   share, and the budget not needed by channels with a known small backlog
+#   goes to the channels that are further behind
+def allocate_read_limits(backlogs, limit):
+    even_share = max(int(limit / len(backlogs)), 1)
+
+    known = sorted(
+        (backlog, channel)
+        for channel, backlog in six.iteritems(backlogs)
+        if backlog is not None
+    )
+    unknown = [
+        channel for channel, backlog in six.iteritems(backlogs) if backlog is None
+    ]
+
+    limits = {}
+    remaining = limit
+
+    # unknown backlogs can't give anything back, so they take an even share
+    for channel in unknown:
+        limits[channel] = even_share
+        remaining -= even_share
+
+    for i, (backlog, channel) in enumerate(known):
+        share = max(int(remaining / (len(known) - i)), 0)
+        used = min(backlog, share)
+        limits[channel] = max(used, even_share)
+        remaining -= used
+
+    return limits
+
+
+# read up to limit events after from_id. returns (events, more, read_id,
+#   gap), where read_id is set if the last events read were filtered out,
+#   and gap is set if reading stopped at an event that isn't visible yet
+def read_channel_events(
+    storage, coalescer, channel, from_id, limit, current_id, event_types
+):
+    if coalescer:
+        events = coalescer.get_events(
+            channel, from_id, limit=limit + 1, current_id=current_id
+        )
+    else:
+        events = storage.get_events(channel, from_id, limit=limit + 1)
+
+    gap = isinstance(events, PartialEvents)
+
+    more = False
+    if len(events) >= limit + 1:
+        events = events[:limit]
+        more = True
+
+    read_id = None
+    if events and event_types is not None:
+        last_read_id = events[-1].id
+        events = [e for e in events if e.type in event_types]
+        if not events or events[-1].id != last_read_id:
+            read_id = last_read_id
+
+    return events, more, read_id, gap
+
+
+# like read_channel_events, but starting with the channel's snapshot. returns
+#   None if there is no usable snapshot newer than last_id
+def read_snapshot_events(
+    storage, coalescer, channel, last_id, limit, current_id, event_types
+):
+    snapshot = storage.get_snapshot(channel)
+    if snapshot is None:
+        return None
+    if last_id is not None and snapshot.id <= int(last_id):
+        return None
+
+    try:
+        events, more, read_id, gap = read_channel_events(
+            storage, coalescer, channel, snapshot.id, limit, current_id, event_types
+        )
+    except EventDoesNotExist:
+        # the events following the snapshot are gone
+        return None
+
+    return [snapshot] + events, more, read_id, gap
+
+
 def get_events(request, limit=100, user=None):
     if user is None:
         user = request.user
+        user_id = getattr(request, "user_id", None)
+    else:
+        user_id = None
+
+    if user_id is None:
+        user_id = get_user_id(user)
 
     resp = EventResponse()
     resp.is_next = request.is_next
     resp.is_recover = request.is_recover
     resp.user = user
+    resp.user_id = user_id
 
     if len(request.channels) == 0:
         return resp
 
-    limit_per_type = int(limit / len(request.channels))
-    if limit_per_type < 1:
-        limit_per_type = 1
-
     storage = get_storage()
     channelmanager = get_channelmanager()
 
+    event_types = getattr(request, "event_types", None)
+
     inaccessible_channels = []
     for channel in request.channels:
-        if not channelmanager.can_read_channel(user, channel):
+        if not can_read_channel(channelmanager, user, channel, user_id=user_id):
             inaccessible_channels.append(channel)
 
     if len(inaccessible_channels) > 0:
         msg = "Permission denied to channels: %s" % (", ".join(inaccessible_channels))
         raise EventPermissionError(msg, channels=inaccessible_channels)
 
+    reliable_channels = []
+    if storage:
+        for channel in request.channels:
+            if channelmanager.is_channel_reliable(channel):
+                reliable_channels.append(channel)
+
+    coalescer = get_read_coalescer(storage) if storage else None
+
+    # with several channels, look up all current ids in one batch, so the
+    #   read limit can be split according to each channel's backlog. the
+    #   current ids also key the results cached by the read coalescer
+    cur_ids = {}
+    if (len(request.channels) > 1 or coalescer) and reliable_channels:
+        cur_ids = storage.get_current_ids(reliable_channels)
+
+    backlogs = {}
+    for channel in request.channels:
+        last_id = request.channel_last_ids.get(channel)
+        if channel in cur_ids and last_id is not None:
+            backlogs[channel] = max(cur_ids[channel] - int(last_id), 0)
+        else:
+            backlogs[channel] = None
+
+    channel_limits = allocate_read_limits(backlogs, limit)
+
+    use_snapshots = getattr(settings, "EVENTSTREAM_SNAPSHOTS", False)
+    snapshot_threshold = getattr(settings, "EVENTSTREAM_SNAPSHOT_THRESHOLD", limit)
+
     for channel in request.channels:
         reset = False
 
         last_id = request.channel_last_ids.get(channel)
         more = False
-
-        if channelmanager.is_channel_reliable(channel) and storage:
-            if last_id is not None:
+        read_id = None
+        gap = False
+
+        if channel in reliable_channels:
+            channel_limit = channel_limits[channel]
+            current_id = cur_ids.get(channel)
+            backlog = backlogs[channel]
+
+            # new clients, and clients further behind than the threshold,
+            #   start from the channel's snapshot if there is one
+            snapshot_result = None
+            if use_snapshots and (
+                last_id is None
+                or (backlog is not None and backlog > snapshot_threshold)
+            ):
+                snapshot_result = read_snapshot_events(
+                    storage,
+                    coalescer,
+                    channel,
+                    last_id,
+                    channel_limit,
+                    current_id,
+                    event_types,
+                )
+
+            if snapshot_result is not None:
+                events, more, read_id, gap = snapshot_result
+                last_id = str(events[0].id)
+            elif last_id is None:
+                events = []
+                if current_id is not None:
+                    last_id = str(current_id)
+                else:
+                    last_id = str(storage.get_current_id(channel))
+            elif current_id == int(last_id):
+                # already current as of the batch lookup
+                events = []
+            else:
                 try:
-                    events = storage.get_events(
-                        channel, int(last_id), limit=limit_per_type + 1
+                    events, more, read_id, gap = read_channel_events(
+                        storage,
+                        coalescer,
+                        channel,
+                        int(last_id),
+                        channel_limit,
+                        current_id,
+                        event_types,
                     )
-                    if len(events) >= limit_per_type + 1:
-                        events = events[:limit_per_type]
-                        more = True
                 except EventDoesNotExist as e:
-                    reset = True
-                    events = []
-                    last_id = str(e.current_id)
-            else:
-                events = []
-                last_id = str(storage.get_current_id(channel))
+                    if use_snapshots:
+                        snapshot_result = read_snapshot_events(
+                            storage,
+                            coalescer,
+                            channel,
+                            None,
+                            channel_limit,
+                            current_id,
+                            event_types,
+                        )
+                    if snapshot_result is not None:
+                        events, more, read_id, gap = snapshot_result
+                        last_id = str(events[0].id)
+                    else:
+                        reset = True
+                        events = []
+                        last_id = str(e.current_id)
         else:
             events = []
             last_id = None
 
+        if read_id is not None:
+            resp.channel_read_ids[channel] = read_id
         resp.channel_items[channel] = events
         if last_id is not None:
             resp.channel_last_ids[channel] = last_id
         if reset:
             resp.channel_reset.add(channel)
+        if gap:
+            resp.channel_gaps.add(channel)
         if more:
-            last_id_before_limit = events[-1].id
+            if channel in resp.channel_read_ids:
+                last_id_before_limit = resp.channel_read_ids[channel]
+            else:
+                last_id_before_limit = events[-1].id
             request.channel_last_ids[channel] = last_id_before_limit
             resp.channel_more.add(channel)
     return resp
 
 
+def set_snapshot(channel, data, event_id=None, json_encode=True):
+    """
+    Store the compacted state of a channel as of event_id (by default, the
+    channel's current id). New subscribers, and subscribers far behind, then
+    receive a "snapshot" event with this data followed only by later events.
+    """
+    storage = get_storage()
+
+    if not storage:
+        raise ValueError("set_snapshot requires storage to be enabled")
+
+    if json_encode:
+        data = json.dumps(data, cls=DjangoJSONEncoder)
+
+    if event_id is None:
+        event_id = storage.get_current_id(channel)
+
+    storage.set_snapshot(channel, int(event_id), data)
+
+
 def get_current_event_id(channels):
     storage = get_storage()
 
@@ -166,14 +496,42 @@ def get_current_event_id(channels):
 
 
 def channel_permission_changed(user, channel):
-    from .views import get_listener_manager
-
     channelmanager = get_channelmanager()
-    if not channelmanager.can_read_channel(user, channel):
-        user_id = user.id if user else "anonymous"
+    user_id = get_user_id(user)
+    allowed = channelmanager.can_read_channel(user, channel)
+
+    # apply locally first, as this process may not be receiving messages
+    #   from the others. if it is, it applies the change again when its own
+    #   message comes back, which is harmless since invalidating and kicking
+    #   are idempotent
+    apply_permission_changed(user_id, channel, kick=not allowed)
+
+    # let every other worker drop its cached result and kick its listeners
+    message = {
+        "type": "permission-changed",
+        "user_id": user_id,
+        "channel": channel,
+        "kick": not allowed,
+    }
+    notifier = get_postgres_notifier()
 
-        # kick local listeners
-        get_listener_manager().kick(user_id, channel)
+    if redis_client:
+        redis_client.publish("events_channel", json.dumps(message))
+    elif notifier:
+        notifier.notify(message)
 
+    if not allowed:
         # kick users connected to grip proxy
         publish_kick(user_id, channel)
+
+
+def apply_permission_changed(user_id, channel, kick):
+    from .views import get_listener_manager
+
+    cache = get_authorization_cache()
+    if cache:
+        cache.invalidate(user_id, channel)
+
+    if kick:
+        # kick local listeners
+        get_listener_manager().kick(user_id, channel)
@@ -0,0 +1,279 @@
+"""
+An in-process stand-in for a GRIP proxy such as Pushpin, for tests and load
+measurements without a running proxy. Requests are passed straight to a view
+through GripMiddleware, and items published with django_grip are delivered to
+the held streams. Only the parts of GRIP used by django_eventstream are
+implemented: stream holds, next links, recovery, and the build-id, skip-users
+and require-sub filters.
+"""
+
+import base64
+import contextlib
+import json
+import re
+import threading
+import time
+from django.test import RequestFactory
+
+META_PARAM = re.compile(r'([^=,\s]+)="((?:[^"\\]|\\.)*)"')
+
+ID_FORMAT_PARAM = re.compile(r"%\(([^)]+)\)s")
+
+
+def parse_channel_header(value):
+    channels = {}
+    for part in value.split(", "):
+        params = part.split("; ")
+        channel = {"prev_id": None, "filters": []}
+        for param in params[1:]:
+            k, v = param.split("=", 1)
+            if k == "prev-id":
+                channel["prev_id"] = v
+            elif k == "filter":
+                channel["filters"].append(v)
+        channels[params[0]] = channel
+    return channels
+
+
+def parse_meta_header(value):
+    return {k: re.sub(r"\\(.)", r"\1", v) for k, v in META_PARAM.findall(value or "")}
+
+
+def parse_link_header(value):
+    if not value:
+        return None
+    params = value.split("; ")
+    if "rel=next" not in params[1:]:
+        return None
+    return params[0].strip("<>")
+
+
+def build_id(content, id_format, ids):
+    event_id = ID_FORMAT_PARAM.sub(lambda m: ids.get(m.group(1)) or "", id_format)
+    event_id = event_id.replace("%%", "%")
+    return re.sub(
+        r"%(.)",
+        lambda m: event_id if m.group(1) == "I" else m.group(1),
+        content,
+        flags=re.S,
+    )
+
+
+class StubStream(object):
+    def __init__(self, proxy, uri):
+        self.proxy = proxy
+        self.uri = uri
+        self.channels = {}
+        self.meta = {}
+        self.next_link = None
+        self.held = False
+        self.closed = False
+        self.status = None
+        self.requests = 0
+        self.chunks = []
+
+    @property
+    def body(self):
+        return "".join(content for _, content in self.chunks)
+
+    def last_ids(self):
+        return {
+            name: c["prev_id"]
+            for name, c in self.channels.items()
+            if c["prev_id"] is not None
+        }
+
+    # the stream was interrupted, so ask the origin for what was missed
+    def recover(self):
+        if self.next_link and not self.closed:
+            self.proxy.request(self, self.next_link, grip_last=self.last_ids())
+
+    def close(self):
+        self.proxy.remove_stream(self)
+        self.closed = True
+
+
+class GripStub(object):
+    """
+    Holds streams for a view, and accepts publishes in place of a GRIP proxy.
+    It can be added to a PubControl instance as a client, or installed in
+    place of the configured proxies with installed().
+    """
+
+    def __init__(self, view=None, view_kwargs=None, on_data=None):
+        if view is None:
+            from .views import events
+
+            view = events
+
+        self.view = view
+        self.view_kwargs = view_kwargs or {}
+        self.on_data = on_data
+        self.factory = RequestFactory()
+        self.lock = threading.RLock()
+        self.subscriptions = {}
+        self.requests = 0
+        self.published = 0
+        self.delivered = 0
+        self.recovered = 0
+
+    def open(self, uri):
+        stream = StubStream(self, uri)
+        self.request(stream, uri)
+        return stream
+
+    def request(self, stream, uri, grip_last=None):
+        from django_grip import GripMiddleware
+
+        middleware = GripMiddleware(lambda request: None)
+
+        while True:
+            headers = {}
+            if grip_last:
+                headers["HTTP_GRIP_LAST"] = ",".join(
+                    "%s; last-id=%s" % (c, i) for c, i in grip_last.items()
+                )
+            request = self.factory.get(uri, **headers)
+            middleware.process_request(request)
+            request.grip.proxied = True
+            request.grip.signed = True
+            response = self.view(request, **self.view_kwargs)
+            response = middleware.process_response(request, response)
+
+            with self.lock:
+                self.requests += 1
+            stream.requests += 1
+            stream.status = response.status_code
+            self.deliver(stream, response.content.decode("utf-8"))
+
+            self.remove_stream(stream)
+            if response.status_code != 200:
+                stream.closed = True
+                return
+
+            stream.channels = parse_channel_header(response.get("Grip-Channel", ""))
+            stream.meta = parse_meta_header(response.get("Grip-Set-Meta"))
+            stream.next_link = parse_link_header(response.get("Grip-Link"))
+            stream.held = response.get("Grip-Hold") == "stream"
+
+            if stream.held:
+                with self.lock:
+                    for name in stream.channels:
+                        self.subscriptions.setdefault(name, set()).add(stream)
+                return
+
+            if not stream.next_link:
+                stream.closed = True
+                return
+
+            # not held yet, the origin has more to send
+            uri = stream.next_link
+            grip_last = None
+
+    def remove_stream(self, stream):
+        with self.lock:
+            for name in stream.channels:
+                streams = self.subscriptions.get(name)
+                if streams:
+                    streams.discard(stream)
+                    if not streams:
+                        del self.subscriptions[name]
+
+    def deliver(self, stream, content):
+        if not content:
+            return
+        stream.chunks.append((time.perf_counter(), content))
+        with self.lock:
+            self.delivered += 1
+        if self.on_data:
+            self.on_data(stream, content)
+
+    def publish_item(self, item):
+        channel = item["channel"]
+        meta = item.get("meta", {})
+        fmt = item.get("http-stream")
+        if fmt is None:
+            return
+
+        with self.lock:
+            self.published += 1
+            streams = list(self.subscriptions.get(channel, ()))
+
+        to_recover = []
+        for stream in streams:
+            sub = stream.channels.get(channel)
+            if sub is None or stream.closed:
+                continue
+
+            prev_id = item.get("prev-id")
+            if prev_id is not None and sub["prev_id"] is not None:
+                if prev_id != sub["prev_id"]:
+                    to_recover.append(stream)
+                    continue
+
+            # filtered items still move the position forward
+            if item.get("id") is not None:
+                sub["prev_id"] = item["id"]
+
+            if "require-sub" in sub["filters"]:
+                required = meta.get("require_sub")
+                if required and required not in stream.channels:
+                    continue
+
+            if "skip-users" in sub["filters"]:
+                skip = meta.get("skip_users", "")
+                if skip and stream.meta.get("user") in skip.split(","):
+                    continue
+
+            if fmt.get("action") == "close":
+                stream.close()
+                continue
+
+            if "content-bin" in fmt:
+                content = base64.b64decode(fmt["content-bin"]).decode("utf-8")
+            else:
+                content = fmt.get("content", "")
+
+            if "build-id" in sub["filters"]:
+                content = build_id(
+                    content, stream.meta.get("id_format", ""), stream.last_ids()
+                )
+
+            self.deliver(stream, content)
+
+        for stream in to_recover:
+            with self.lock:
+                self.recovered += 1
+            stream.recover()
+
+    # PubControlClient interface
+
+    def publish(self, channel, item, blocking=False, callback=None):
+        i = item.export()
+        i["channel"] = channel
+        self.publish_item(i)
+        if callback:
+            callback(True, "")
+
+    def http_call(self, endpoint, data, headers={}):
+        for item in json.loads(data)["items"]:
+            self.publish_item(item)
+        return (200, {}, "Published\n")
+
+    def wait_all_sent(self):
+        pass
+
+    def close(self):
+        pass
+
+    @contextlib.contextmanager
+    def installed(self):
+        from django_grip import get_pubcontrol
+
+        pub = get_pubcontrol()
+        clients = pub.clients
+        pub.clients = [self]
+        try:
+            yield self
+        finally:
+            pub.clients = clients
@@ -0,0 +1,89 @@
+import json
+from urllib.error import HTTPError, URLError
+from urllib.parse import urlencode
+from urllib.request import Request, urlopen
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+
+def format_seconds(v):
+    if v is None:
+        return "-"
+    return "%.1fs" % v
+
+
+class Command(BaseCommand):
+    help = (
+        "Show the listeners of a running server process, as reported by its "
+        "debug view"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("url", help="URL of the debug view")
+        parser.add_argument(
+            "--token",
+            help="debug token to send (default: EVENTSTREAM_DEBUG_TOKEN)",
+        )
+        parser.add_argument("--limit", type=int, default=20)
+        parser.add_argument("--json", action="store_true", help="print raw JSON")
+        parser.add_argument("--timeout", type=float, default=10)
+
+    def handle(self, *args, **options):
+        token = options["token"] or getattr(settings, "EVENTSTREAM_DEBUG_TOKEN", None)
+
+        url = options["url"]
+        url += ("&" if "?" in url else "?") + urlencode({"limit": options["limit"]})
+        req = Request(url, headers={"Accept": "application/json"})
+        if token:
+            req.add_header("Authorization", "Bearer %s" % token)
+
+        try:
+            with urlopen(req, timeout=options["timeout"]) as resp:
+                snapshot = json.loads(resp.read())
+        except HTTPError as e:
+            raise CommandError("debug view responded with status %d" % e.code)
+        except (URLError, OSError) as e:
+            raise CommandError("failed to fetch %s: %s" % (url, e))
+
+        if options["json"]:
+            self.stdout.write(json.dumps(snapshot, indent=2))
+            return
+
+        self.stdout.write(
+            "pid %d: %d listeners on %d channels"
+            % (snapshot["pid"], snapshot["listeners"], snapshot["channels"])
+        )
+
+        redis = snapshot["redis_listener"]
+        if redis:
+            self.stdout.write(
+                "redis listener: %s, %d messages received, last %s ago"
+                % (
+                    "subscribed" if redis["subscribed"] else "not subscribed",
+                    redis["received"],
+                    format_seconds(redis["idle"]),
+                )
+            )
+
+        self.stdout.write("\ntop channels:")
+        for c in snapshot["top_channels"]:
+            self.stdout.write("  %8d  %s" % (c["listeners"], c["channel"]))
+
+        self.stdout.write(
+            "\n%18s %8s %9s %9s %5s  %s"
+            % ("connection", "pending", "age", "idle", "flags", "user / channels")
+        )
+        for c in snapshot["connections"]:
+            flags = ("O" if c["overflow"] else "") + ("E" if c["error"] else "")
+            self.stdout.write(
+                "%18d %8d %9s %9s %5s  %s / %s"
+                % (
+                    c["id"],
+                    c["pending"],
+                    format_seconds(c["age"]),
+                    format_seconds(c["idle"]),
+                    flags or "-",
+                    c["user_id"] or "-",
+                    ",".join(c["channels"]),
+                )
+            )
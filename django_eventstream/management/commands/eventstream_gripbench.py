@@ -0,0 +1,95 @@
+import json
+import threading
+import time
+from django.core.management.base import BaseCommand
+from django_eventstream import send_event
+from django_eventstream.gripstub import GripStub
+from django_eventstream.management.stats import latency_summary
+
+
+class Command(BaseCommand):
+    help = (
+        "Measure the GRIP path in-process: open streams through a stand-in "
+        "proxy, publish events, and report latency and request rates"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--clients", type=int, default=100)
+        parser.add_argument("--events", type=int, default=1000)
+        parser.add_argument("--channel", default="gripbench")
+        parser.add_argument("--payload", type=int, default=100, help="bytes")
+        parser.add_argument("--timeout", type=float, default=30.0)
+
+    def handle(self, *args, **options):
+        clients = options["clients"]
+        events = options["events"]
+        channel = options["channel"]
+
+        lock = threading.Lock()
+        done = threading.Condition(lock)
+        latencies = []
+
+        def on_data(stream, content):
+            now = time.perf_counter()
+            for line in content.split("\n"):
+                if not line.startswith("data: {"):
+                    continue
+                try:
+                    sent = json.loads(line[6:]).get("t")
+                except ValueError:
+                    continue
+                if sent is not None:
+                    with done:
+                        latencies.append(now - sent)
+                        done.notify()
+
+        stub = GripStub(on_data=on_data)
+
+        with stub.installed():
+            start = time.perf_counter()
+            streams = [stub.open("/?channel=%s" % channel) for _ in range(clients)]
+            open_elapsed = time.perf_counter() - start
+
+            held = len([s for s in streams if s.held])
+            if held < clients:
+                self.stderr.write(
+                    "Warning: only %d of %d streams held" % (held, clients)
+                )
+
+            pad = "x" * options["payload"]
+            start = time.perf_counter()
+            for n in range(events):
+                send_event(
+                    channel, "message", {"t": time.perf_counter(), "n": n, "pad": pad}
+                )
+            publish_elapsed = time.perf_counter() - start
+
+            expected = events * held
+            deadline = time.monotonic() + options["timeout"]
+            with done:
+                while len(latencies) < expected:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    done.wait(remaining)
+            deliver_elapsed = time.perf_counter() - start
+
+            for stream in streams:
+                stream.close()
+
+        result = {
+            "clients": clients,
+            "events": events,
+            "requests": stub.requests,
+            "recovered": stub.recovered,
+            "opens_per_sec": round(clients / open_elapsed) if open_elapsed else None,
+            "publishes_per_sec": (
+                round(events / publish_elapsed) if publish_elapsed else None
+            ),
+            "deliveries": len(latencies),
+            "deliveries_per_sec": (
+                round(len(latencies) / deliver_elapsed) if deliver_elapsed else None
+            ),
+            "latency_ms": latency_summary(latencies),
+        }
+        self.stdout.write(json.dumps(result, indent=2))
@@ -0,0 +1,295 @@
+import asyncio
+import json
+import random
+import threading
+import time
+from urllib.parse import urlencode
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.utils.module_loading import import_string
+from django_eventstream import send_event
+from django_eventstream.management.stats import latency_summary
+
+
+def get_rss():
+    try:
+        with open("/proc/self/statm") as f:
+            pages = int(f.read().split()[1])
+    except (OSError, IndexError, ValueError):
+        return None
+    import resource
+
+    return pages * resource.getpagesize()
+
+
+def get_asgi_application():
+    name = getattr(settings, "ASGI_APPLICATION", None)
+    if name:
+        return import_string(name)
+
+    from django.core.asgi import get_asgi_application
+
+    return get_asgi_application()
+
+
+class SSEClient(object):
+    """
+    A stream client that calls the ASGI application directly, without a
+    server or sockets in between.
+    """
+
+    def __init__(self, app, path, channel, on_message):
+        self.app = app
+        self.path = path
+        self.channel = channel
+        self.on_message = on_message
+        self.last_id = None
+        self.status = None
+        self.task = None
+        self.disconnect = None
+        self.connected = None
+        self.opened_at = None
+        self.connected_at = None
+        self.catchup_target = None
+        self.catchup_time = None
+        self.buffer = ""
+
+    def start(self):
+        loop = asyncio.get_event_loop()
+        self.opened_at = time.perf_counter()
+        self.connected_at = None
+        self.connected = asyncio.Event()
+        self.disconnect = loop.create_future()
+        self.buffer = ""
+        self.task = asyncio.ensure_future(self.run())
+
+    async def run(self):
+        headers = [(b"host", b"localhost"), (b"accept", b"text/event-stream")]
+        if self.last_id:
+            headers.append((b"last-event-id", self.last_id.encode("utf-8")))
+        scope = {
+            "type": "http",
+            "asgi": {"version": "3.0"},
+            "http_version": "1.1",
+            "method": "GET",
+            "scheme": "http",
+            "path": self.path,
+            "raw_path": self.path.encode("utf-8"),
+            "query_string": urlencode({"channel": self.channel}).encode("utf-8"),
+            "root_path": "",
+            "headers": headers,
+            "client": ("127.0.0.1", 50000),
+            "server": ("localhost", 80),
+        }
+        requested = False
+
+        async def receive():
+            nonlocal requested
+            if not requested:
+                requested = True
+                return {"type": "http.request", "body": b"", "more_body": False}
+            await self.disconnect
+            return {"type": "http.disconnect"}
+
+        async def send(message):
+            if message["type"] == "http.response.start":
+                self.status = message["status"]
+            elif message["type"] == "http.response.body":
+                self.feed(message.get("body", b"").decode("utf-8"))
+
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            # unblock anyone waiting on a failed connection
+            self.connected.set()
+
+    def feed(self, data):
+        now = time.perf_counter()
+        self.buffer += data
+        while "\n\n" in self.buffer:
+            block, self.buffer = self.buffer.split("\n\n", 1)
+            event_type = None
+            event_id = None
+            lines = []
+            for line in block.split("\n"):
+                if line.startswith("event: "):
+                    event_type = line[7:]
+                elif line.startswith("id: "):
+                    event_id = line[4:]
+                elif line.startswith("data: "):
+                    lines.append(line[6:])
+            if event_id:
+                self.last_id = event_id
+            if event_type == "stream-open" and self.connected_at is None:
+                self.connected_at = now
+                self.connected.set()
+            elif event_type == "message":
+                self.on_message(self, "\n".join(lines), now)
+
+    async def stop(self):
+        if not self.disconnect.done():
+            self.disconnect.set_result(None)
+        try:
+            await asyncio.wait_for(self.task, 5)
+        except (asyncio.TimeoutError, asyncio.CancelledError):
+            pass
+
+
+class Command(BaseCommand):
+    help = (
+        "Run the ASGI application in-process with simulated stream clients, "
+        "send events at a fixed rate, and report connection, delivery and "
+        "reconnection figures"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--path", default="/events/", help="path of the view")
+        parser.add_argument("--clients", type=int, default=100)
+        parser.add_argument("--channels", type=int, default=10)
+        parser.add_argument("--channel-prefix", default="loadtest")
+        parser.add_argument("--rate", type=float, default=100, help="events/sec")
+        parser.add_argument("--duration", type=float, default=10, help="seconds")
+        parser.add_argument("--payload", type=int, default=100, help="bytes")
+        parser.add_argument(
+            "--reconnect",
+            type=float,
+            default=0.1,
+            help="fraction of clients forced to reconnect halfway through",
+        )
+        parser.add_argument(
+            "--reconnect-delay",
+            type=float,
+            default=1.0,
+            help="seconds that reconnecting clients stay away",
+        )
+        parser.add_argument("--seed", type=int, default=0)
+        parser.add_argument("--timeout", type=float, default=30)
+
+    def handle(self, *args, **options):
+        result = asyncio.run(self.run(options))
+        self.stdout.write(json.dumps(result, indent=2))
+
+    async def run(self, options):
+        app = get_asgi_application()
+        rng = random.Random(options["seed"])
+
+        channels = [
+            "%s-%d" % (options["channel_prefix"], i) for i in range(options["channels"])
+        ]
+        latencies = []
+        last_n = {}
+
+        def on_message(client, data, now):
+            try:
+                payload = json.loads(data)
+            except ValueError:
+                return
+            target = client.catchup_target
+            if target is None:
+                latencies.append(now - payload["t"])
+            elif payload["n"] >= target:
+                # events replayed from storage don't count toward latency
+                client.catchup_time = now - client.opened_at
+                client.catchup_target = None
+
+        clients = [
+            SSEClient(app, options["path"], channels[i % len(channels)], on_message)
+            for i in range(options["clients"])
+        ]
+
+        rss_before = get_rss()
+
+        for client in clients:
+            client.start()
+        try:
+            await asyncio.wait_for(
+                asyncio.gather(*[c.connected.wait() for c in clients]),
+                options["timeout"],
+            )
+        except asyncio.TimeoutError:
+            raise CommandError("timed out opening streams")
+
+        failed = [c for c in clients if c.connected_at is None]
+        if failed:
+            raise CommandError(
+                "%d streams failed to open (status %s)"
+                % (len(failed), failed[0].status)
+            )
+
+        rss_after = get_rss()
+        setup_times = [c.connected_at - c.opened_at for c in clients]
+
+        # send events from a thread, as a web or worker process would
+        pad = "x" * options["payload"]
+        rate = options["rate"]
+        total = int(rate * options["duration"])
+        stop = threading.Event()
+
+        def publish():
+            start = time.perf_counter()
+            for n in range(total):
+                if stop.is_set():
+                    return n
+                delay = start + n / rate - time.perf_counter()
+                if delay > 0:
+                    time.sleep(delay)
+                channel = channels[n % len(channels)]
+                send_event(
+                    channel, "message", {"t": time.perf_counter(), "n": n, "pad": pad}
+                )
+                last_n[channel] = n
+            return total
+
+        loop = asyncio.get_event_loop()
+        start = time.perf_counter()
+        publisher = loop.run_in_executor(None, publish)
+
+        reconnecting = rng.sample(
+            clients, int(round(len(clients) * options["reconnect"]))
+        )
+        try:
+            if reconnecting:
+                await asyncio.sleep(options["duration"] / 2)
+                await asyncio.gather(*[c.stop() for c in reconnecting])
+                await asyncio.sleep(options["reconnect_delay"])
+                for client in reconnecting:
+                    # caught up once the latest event sent while away arrives
+                    client.catchup_target = last_n.get(client.channel)
+                    client.start()
+
+            sent = await publisher
+        finally:
+            stop.set()
+        send_elapsed = time.perf_counter() - start
+
+        # wait for deliveries to settle
+        deadline = time.monotonic() + options["timeout"]
+        count = -1
+        while count != len(latencies) and time.monotonic() < deadline:
+            count = len(latencies)
+            await asyncio.sleep(0.2)
+        elapsed = time.perf_counter() - start
+
+        await asyncio.gather(*[c.stop() for c in clients])
+
+        catchup_times = [c.catchup_time for c in reconnecting if c.catchup_time]
+
+        rss_per_connection = None
+        if rss_before is not None and rss_after is not None:
+            rss_per_connection = round((rss_after - rss_before) / len(clients))
+
+        return {
+            "clients": len(clients),
+            "channels": len(channels),
+            "seed": options["seed"],
+            "connect_ms": latency_summary(setup_times),
+            "events_sent": sent,
+            "send_rate": round(sent / send_elapsed, 1),
+            "deliveries": len(latencies),
+            "deliveries_per_sec": round(len(latencies) / elapsed, 1),
+            "latency_ms": latency_summary(latencies, percentiles=(50, 99, 99.9)),
+            "reconnected": len(reconnecting),
+            "caught_up": len(catchup_times),
+            "catchup_ms": latency_summary(catchup_times),
+            "rss_per_connection_bytes": rss_per_connection,
+        }
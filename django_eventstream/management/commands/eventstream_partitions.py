@@ -0,0 +1,65 @@
+import datetime
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections, transaction
+from django.utils import timezone
+from django_eventstream import partitions
+
+
+class Command(BaseCommand):
+    help = (
+        "Create the partitioned events table used by PartitionedModelStorage "
+        "and its upcoming partitions, and drop partitions whose events have "
+        "all expired. Run it periodically, more often than the partition "
+        "interval"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--database",
+            help="database to use (default: the configured one)",
+        )
+        parser.add_argument(
+            "--dry-run",
+            action="store_true",
+            help="print the statements instead of running them",
+        )
+
+    def handle(self, *args, **options):
+        config = partitions.get_config()
+        database = options["database"] or config["database"]
+        connection = connections[database]
+        if connection.vendor != "postgresql":
+            raise CommandError("partitioned event storage requires PostgreSQL")
+
+        table = partitions.get_table()
+        now = timezone.now()
+        wanted = partitions.get_wanted_partitions(
+            table, now, config["interval"], config["premake"]
+        )
+        cutoff = now - datetime.timedelta(seconds=config["retention_age"])
+
+        # finds nothing before the table is created
+        existing = partitions.get_partitions(connection, table)
+        create, drop = partitions.plan_partitions(existing, wanted, cutoff)
+
+        statements = partitions.get_create_table_sql(connection, table)
+        for name, start, end in create:
+            statements.append(
+                partitions.get_create_partition_sql(connection, table, name, start, end)
+            )
+        for name, _, _ in drop:
+            statements.append(partitions.get_drop_partition_sql(connection, name))
+
+        if options["dry_run"]:
+            for sql in statements:
+                self.stdout.write(sql + ";")
+            return
+
+        with transaction.atomic(using=database):
+            with connection.cursor() as cursor:
+                for sql in statements:
+                    cursor.execute(sql)
+
+        self.stdout.write(
+            "%d partitions created, %d dropped" % (len(create), len(drop))
+        )
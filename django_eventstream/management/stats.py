@@ -0,0 +1,19 @@
+def percentile(values, p):
+    if not values:
+        return None
+    values = sorted(values)
+    k = min(int(round(p / 100.0 * (len(values) - 1))), len(values) - 1)
+    return values[k]
+
+
+def ms(v):
+    return round(v * 1000, 3) if v is not None else None
+
+
+# summarize durations in seconds as milliseconds
+def latency_summary(values, percentiles=(50, 90, 99)):
+    out = {}
+    for p in percentiles:
+        out["p%s" % str(p).replace(".", "")] = ms(percentile(values, p))
+    out["max"] = ms(max(values) if values else None)
+    return out
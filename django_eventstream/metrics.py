@@ -0,0 +1,267 @@
+import asyncio
+import bisect
+import functools
+import threading
+import time
+from django.conf import settings
+from .utils import load_class
+
+# upper bounds in seconds for latency histograms
+DEFAULT_BUCKETS = (
+    0.0005,
+    0.001,
+    0.0025,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1.0,
+    2.5,
+)
+
+# channels with the most listeners are reported individually, up to this many
+MAX_CHANNEL_LABELS = 100
+
+
+def labels_key(labels):
+    if not labels:
+        return ()
+    return tuple(sorted(labels.items()))
+
+
+def escape_label_value(s):
+    return str(s).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def format_sample(name, labels, value):
+    if labels:
+        name += (
+            "{"
+            + ",".join('%s="%s"' % (k, escape_label_value(v)) for k, v in labels)
+            + "}"
+        )
+    return "%s %s" % (name, repr(float(value)) if isinstance(value, float) else value)
+
+
+class MetricsSinkBase(object):
+    # add to a counter
+    def inc(self, name, value=1, labels=None):
+        raise NotImplementedError()
+
+    # record a value in a histogram, such as a duration in seconds
+    def observe(self, name, value, labels=None):
+        raise NotImplementedError()
+
+
+class MetricsRegistry(MetricsSinkBase):
+    """
+    Keeps counters and histograms in process memory, and renders them along
+    with the current gauges in the Prometheus text format.
+    """
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = buckets
+        self.lock = threading.Lock()
+        self.counters = {}
+        self.histograms = {}
+
+    def inc(self, name, value=1, labels=None):
+        key = (name, labels_key(labels))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name, value, labels=None):
+        key = (name, labels_key(labels))
+        i = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            h = self.histograms.get(key)
+            if h is None:
+                h = [[0] * len(self.buckets), 0.0, 0]
+                self.histograms[key] = h
+            if i < len(self.buckets):
+                h[0][i] += 1
+            h[1] += value
+            h[2] += 1
+
+    def get_counter(self, name, **labels):
+        with self.lock:
+            return self.counters.get((name, labels_key(labels)), 0)
+
+    def render(self, samples=None):
+        with self.lock:
+            counters = sorted(self.counters.items())
+            histograms = sorted(
+                (key, (list(h[0]), h[1], h[2])) for key, h in self.histograms.items()
+            )
+
+        lines = []
+        typed = set()
+
+        def add_type(name, metric_type):
+            if name not in typed:
+                typed.add(name)
+                lines.append("# TYPE %s %s" % (name, metric_type))
+
+        for (name, labels), value in counters:
+            add_type(name, "counter")
+            lines.append(format_sample(name, labels, value))
+
+        for (name, labels), (counts, total, count) in histograms:
+            add_type(name, "histogram")
+            cumulative = 0
+            for bound, n in zip(self.buckets, counts):
+                cumulative += n
+                lines.append(
+                    format_sample(
+                        name + "_bucket", labels + (("le", repr(bound)),), cumulative
+                    )
+                )
+            lines.append(
+                format_sample(name + "_bucket", labels + (("le", "+Inf"),), count)
+            )
+            lines.append(format_sample(name + "_sum", labels, total))
+            lines.append(format_sample(name + "_count", labels, count))
+
+        for name, metric_type, labels, value in samples or []:
+            add_type(name, metric_type)
+            lines.append(format_sample(name, labels_key(labels), value))
+
+        return "\n".join(lines) + "\n"
+
+
+class Metrics(object):
+    def __init__(self, enabled=False, sinks=None):
+        self.enabled = enabled
+        self.registry = MetricsRegistry()
+        self.sinks = [self.registry]
+        if sinks:
+            self.sinks.extend(sinks)
+
+    def inc(self, name, value=1, **labels):
+        if not self.enabled:
+            return
+        for sink in self.sinks:
+            sink.inc(name, value, labels)
+
+    def observe(self, name, value, **labels):
+        if not self.enabled:
+            return
+        for sink in self.sinks:
+            sink.observe(name, value, labels)
+
+    def render(self):
+        return self.registry.render(collect_samples())
+
+
+metrics = None
+metrics_lock = threading.Lock()
+
+
+def get_metrics():
+    global metrics
+    if metrics is None:
+        with metrics_lock:
+            if metrics is None:
+                enabled = getattr(settings, "EVENTSTREAM_METRICS", False)
+                sinks = []
+                if enabled:
+                    for name in getattr(settings, "EVENTSTREAM_METRICS_SINKS", []):
+                        sinks.append(load_class(name))
+                metrics = Metrics(enabled=enabled, sinks=sinks)
+    return metrics
+
+
+# wrap a storage method to record its duration
+def timed(f):
+    if asyncio.iscoroutinefunction(f):
+        return timed_async(f)
+
+    @functools.wraps(f)
+    def wrapper(self, *args, **kwargs):
+        m = get_metrics()
+        if not m.enabled:
+            return f(self, *args, **kwargs)
+        start = time.perf_counter()
+        try:
+            return f(self, *args, **kwargs)
+        finally:
+            m.observe(
+                "eventstream_storage_seconds",
+                time.perf_counter() - start,
+                backend=self.__class__.__name__,
+                op=f.__name__,
+            )
+
+    return wrapper
+
+
+def timed_async(f):
+    @functools.wraps(f)
+    async def wrapper(self, *args, **kwargs):
+        m = get_metrics()
+        if not m.enabled:
+            return await f(self, *args, **kwargs)
+        start = time.perf_counter()
+        try:
+            return await f(self, *args, **kwargs)
+        finally:
+            m.observe(
+                "eventstream_storage_seconds",
+                time.perf_counter() - start,
+                backend=self.__class__.__name__,
+                op=f.__name__,
+            )
+
+    return wrapper
+
+
+# current values from the other parts of the pipeline, read at scrape time
+def collect_samples():
+    from .publisher import get_grip_publisher
+    from .utils import get_redis_pool_stats
+    from .views import get_admission_controller, get_listener_manager
+
+    out = []
+
+    lm = get_listener_manager()
+    with lm.lock:
+        counts = [(len(ls), c) for c, ls in lm.listeners_by_channel.items()]
+        listeners = lm.listener_count
+    out.append(("eventstream_listeners", "gauge", None, listeners))
+    counts.sort(key=lambda x: (-x[0], x[1]))
+    for count, channel in counts[:MAX_CHANNEL_LABELS]:
+        out.append(
+            ("eventstream_channel_listeners", "gauge", {"channel": channel}, count)
+        )
+
+    admission = get_admission_controller()
+    if admission.enabled:
+        stats = admission.get_stats()
+        for k in ("catching_up", "queued"):
+            out.append(("eventstream_admission_%s" % k, "gauge", None, stats[k]))
+        for k in ("admitted", "deferred", "rejected"):
+            out.append(
+                ("eventstream_admission_%s_total" % k, "counter", None, stats[k])
+            )
+
+    publisher = get_grip_publisher()
+    if publisher.enabled:
+        stats = publisher.get_stats()
+        out.append(
+            ("eventstream_grip_publish_pending", "gauge", None, stats["pending"])
+        )
+        for k in ("sent", "failed", "dropped", "retried", "batches"):
+            out.append(
+                ("eventstream_grip_publish_%s_total" % k, "counter", None, stats[k])
+            )
+
+    for pool in get_redis_pool_stats():
+        labels = {k: pool[k] for k in ("host", "port", "db")}
+        for k in ("max_connections", "created", "in_use"):
+            if k in pool:
+                out.append(("eventstream_redis_pool_%s" % k, "gauge", labels, pool[k]))
+
+    return out
@@ -0,0 +1,28 @@
+# Generated by Django 5.2.18 on 2026-10-19 16:57
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("django_eventstream", "0001_initial"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="EventSnapshot",
+            fields=[
+                (
+                    "id",
+                    models.AutoField(
+                        primary_key=True, serialize=False, verbose_name="ID"
+                    ),
+                ),
+                ("channel", models.CharField(max_length=255, unique=True)),
+                ("eid", models.BigIntegerField(default=0)),
+                ("data", models.TextField()),
+                ("updated", models.DateTimeField(auto_now=True)),
+            ],
+        ),
+    ]
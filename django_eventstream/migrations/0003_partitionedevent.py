@@ -0,0 +1,33 @@
+# Generated by Django 5.2.18 on 2026-10-19 17:38
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("django_eventstream", "0002_eventsnapshot"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="PartitionedEvent",
+            fields=[
+                ("channel", models.CharField(db_index=True, max_length=255)),
+                ("type", models.CharField(db_index=True, max_length=255)),
+                ("data", models.TextField()),
+                ("eid", models.BigIntegerField(db_index=True, default=0)),
+                ("created", models.DateTimeField(auto_now_add=True, db_index=True)),
+                (
+                    "id",
+                    models.BigAutoField(
+                        primary_key=True, serialize=False, verbose_name="ID"
+                    ),
+                ),
+            ],
+            options={
+                "db_table": "django_eventstream_partitionedevent",
+                "managed": False,
+            },
+        ),
+    ]
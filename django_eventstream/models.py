@@ -1,7 +1,9 @@
 # -*- coding: utf-8 -*-
 from __future__ import unicode_literals
 
+from django.conf import settings
 from django.db import IntegrityError, models, transaction
+from django.utils import timezone
 
 
 class EventCounter(models.Model):
@@ -23,8 +25,7 @@ class EventCounter(models.Model):
         return en
 
 
-class Event(models.Model):
-    id = models.AutoField(primary_key=True, serialize=False, verbose_name="ID")
+class EventBase(models.Model):
     channel = models.CharField(max_length=255, db_index=True)
     type = models.CharField(max_length=255, db_index=True)
     data = models.TextField()
@@ -32,29 +33,107 @@ class Event(models.Model):
     created = models.DateTimeField(db_index=True, auto_now_add=True)
 
     class Meta:
-        unique_together = ("channel", "eid")
+        abstract = True
+
+    # called with the saved instance within the transaction that inserted
+    #   it, when set before saving a new event
+    on_insert = None
 
     def save(self, *args, **kwargs):
         if not self.eid:
-            counter = EventCounter.get_or_create(self.channel)
+            if getattr(settings, "EVENTSTREAM_ID_ALLOCATION", "lock") == "sequence":
+                self.save_with_sequence(*args, **kwargs)
+            else:
+                self.save_with_lock(*args, **kwargs)
+        else:
+            super(EventBase, self).save(*args, **kwargs)
 
-            with transaction.atomic():
-                counter = EventCounter.objects.select_for_update().get(id=counter.id)
+    # allocate the id and insert the event while holding the counter row
+    #   lock, so events of a channel become visible strictly in id order
+    def save_with_lock(self, *args, **kwargs):
+        counter = EventCounter.get_or_create(self.channel)
 
-                if counter.value == 0:
-                    # insert placeholder to enable querying from ID 0
-                    zero_event = Event(channel=self.channel)
-                    super(Event, zero_event).save()
+        with transaction.atomic():
+            counter = EventCounter.objects.select_for_update().get(id=counter.id)
 
-                self.eid = counter.value + 1
+            if counter.value == 0:
+                # insert placeholder to enable querying from ID 0
+                zero_event = type(self)(channel=self.channel)
+                super(EventBase, zero_event).save()
 
-                try:
-                    super(Event, self).save(*args, **kwargs)
-                except Exception:
-                    self.eid = 0
-                    raise
+            self.eid = counter.value + 1
 
-                counter.value = self.eid
-                counter.save()
-        else:
-            super(Event, self).save(*args, **kwargs)
+            try:
+                super(EventBase, self).save(*args, **kwargs)
+            except Exception:
+                self.eid = 0
+                raise
+
+            counter.value = self.eid
+            counter.save()
+
+            if self.on_insert:
+                self.on_insert(self)
+
+    # take the next id in a transaction of its own, and insert the event
+    #   after the counter row lock is released. concurrent publishers to a
+    #   channel only wait for each other's counter updates, but an event may
+    #   become visible before one with a lower id. readers handle this by
+    #   stopping at gaps in the ids, see DjangoModelStorage.get_events
+    def save_with_sequence(self, *args, **kwargs):
+        counter = EventCounter.get_or_create(self.channel)
+
+        with transaction.atomic():
+            EventCounter.objects.filter(id=counter.id).update(
+                value=models.F("value") + 1, updated=timezone.now()
+            )
+            eid = EventCounter.objects.values_list("value", flat=True).get(
+                id=counter.id
+            )
+
+            if eid == 1:
+                # insert placeholder to enable querying from ID 0, before
+                #   any other id of the channel is handed out
+                zero_event = type(self)(channel=self.channel)
+                super(EventBase, zero_event).save()
+
+        self.eid = eid
+
+        try:
+            if self.on_insert:
+                with transaction.atomic():
+                    super(EventBase, self).save(*args, **kwargs)
+                    self.on_insert(self)
+            else:
+                super(EventBase, self).save(*args, **kwargs)
+        except Exception:
+            self.eid = 0
+            raise
+
+
+class Event(EventBase):
+    id = models.AutoField(primary_key=True, serialize=False, verbose_name="ID")
+
+    class Meta:
+        unique_together = ("channel", "eid")
+
+
+# events table range-partitioned by created, used by
+#   PartitionedModelStorage. the table and its partitions are managed by the
+#   eventstream_partitions command rather than by migrations, and the primary
+#   key in the database is (id, created) since it must include the partition
+#   key
+class PartitionedEvent(EventBase):
+    id = models.BigAutoField(primary_key=True, serialize=False, verbose_name="ID")
+
+    class Meta:
+        managed = False
+        db_table = "django_eventstream_partitionedevent"
+
+
+class EventSnapshot(models.Model):
+    id = models.AutoField(primary_key=True, serialize=False, verbose_name="ID")
+    channel = models.CharField(max_length=255, unique=True)
+    eid = models.BigIntegerField(default=0)
+    data = models.TextField()
+    updated = models.DateTimeField(auto_now=True)
@@ -0,0 +1,140 @@
+import datetime
+import re
+from django.conf import settings
+from django.utils.dateparse import parse_datetime
+from .storage import EVENT_TIMEOUT
+
+# The events table of PartitionedModelStorage is range-partitioned by the
+#   created column into partitions covering a fixed interval each, aligned to
+#   the Unix epoch. Partitions are created ahead of time, and dropped once
+#   every event in them has expired.
+
+# seconds covered by each partition
+PARTITION_INTERVAL = 60 * 60 * 24
+
+# number of partitions to keep created ahead of the current one
+PARTITION_PREMAKE = 3
+
+# seconds to look back from the referenced event's creation time when
+#   reading the events that follow it
+PARTITION_READ_SLACK = 60
+
+EPOCH = datetime.datetime(1970, 1, 1, tzinfo=datetime.timezone.utc)
+
+
+def get_config():
+    config = getattr(settings, "EVENTSTREAM_PARTITIONED_STORAGE", None) or {}
+    return {
+        "database": config.get("database", "default"),
+        "interval": config.get("interval", PARTITION_INTERVAL),
+        "premake": config.get("premake", PARTITION_PREMAKE),
+        "retention_age": config.get("retention_age", EVENT_TIMEOUT * 60),
+        "read_slack": config.get("read_slack", PARTITION_READ_SLACK),
+    }
+
+
+def get_table():
+    from .models import PartitionedEvent
+
+    return PartitionedEvent._meta.db_table
+
+
+# return the start of the partition containing t
+def partition_start(t, interval):
+    seconds = int((t - EPOCH).total_seconds())
+    return EPOCH + datetime.timedelta(seconds=seconds - seconds % interval)
+
+
+def partition_name(table, start):
+    return "%s_p%s" % (table, start.strftime("%Y%m%d%H%M"))
+
+
+# return (name, start, end) of the partitions that should exist at time now
+def get_wanted_partitions(table, now, interval, premake):
+    step = datetime.timedelta(seconds=interval)
+    start = partition_start(now, interval)
+    out = []
+    for _ in range(premake + 1):
+        out.append((partition_name(table, start), start, start + step))
+        start += step
+    return out
+
+
+def parse_bound(bound):
+    m = re.match(r"FOR VALUES FROM \('([^']+)'\) TO \('([^']+)'\)$", bound)
+    if not m:
+        return None
+    return parse_datetime(m.group(1)), parse_datetime(m.group(2))
+
+
+# return (name, start, end) of the existing partitions, ordered by start
+def get_partitions(connection, table):
+    with connection.cursor() as cursor:
+        cursor.execute(
+            "SELECT c.relname, pg_get_expr(c.relpartbound, c.oid) "
+            "FROM pg_inherits i "
+            "JOIN pg_class c ON c.oid = i.inhrelid "
+            "JOIN pg_class p ON p.oid = i.inhparent "
+            "WHERE p.relname = %s",
+            [table],
+        )
+        rows = cursor.fetchall()
+
+    out = []
+    for name, bound in rows:
+        r = parse_bound(bound)
+        if r is None:
+            # a default partition. leave it alone
+            continue
+        out.append((name, r[0], r[1]))
+    out.sort(key=lambda p: p[1])
+    return out
+
+
+def get_create_table_sql(connection, table):
+    qn = connection.ops.quote_name
+    return [
+        "CREATE TABLE IF NOT EXISTS %s ("
+        "id bigint GENERATED BY DEFAULT AS IDENTITY, "
+        "channel varchar(255) NOT NULL, "
+        "type varchar(255) NOT NULL, "
+        "data text NOT NULL, "
+        "eid bigint NOT NULL, "
+        "created timestamp with time zone NOT NULL, "
+        "PRIMARY KEY (id, created)"
+        ") PARTITION BY RANGE (created)" % qn(table),
+        "CREATE INDEX IF NOT EXISTS %s ON %s (channel, eid)"
+        % (qn(table + "_channel_eid"), qn(table)),
+    ]
+
+
+def get_create_partition_sql(connection, table, name, start, end):
+    qn = connection.ops.quote_name
+    return (
+        "CREATE TABLE IF NOT EXISTS %s PARTITION OF %s FOR VALUES FROM ('%s') TO ('%s')"
+        % (
+            qn(name),
+            qn(table),
+            start.isoformat(),
+            end.isoformat(),
+        )
+    )
+
+
+def get_drop_partition_sql(connection, name):
+    return "DROP TABLE IF EXISTS %s" % connection.ops.quote_name(name)
+
+
+# return (create, drop), the partitions to create and those to drop, given
+#   the existing ones
+def plan_partitions(existing, wanted, cutoff):
+    create = []
+    for p in wanted:
+        # skip ranges already covered, even partly, such as by partitions
+        #   made with a different interval
+        if not any(e[1] < p[2] and p[1] < e[2] for e in existing):
+            create.append(p)
+
+    drop = [e for e in existing if e[2] <= cutoff]
+
+    return create, drop
@@ -0,0 +1,240 @@
+import asyncio
+import json
+import logging
+import threading
+import time
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.db import connections
+from django.db.models import Q
+
+logger = logging.getLogger(__name__)
+
+# the server rejects NOTIFY payloads of this many bytes or more
+MAX_PAYLOAD = 8000
+
+# seconds to wait before listening again after losing the connection
+RECONNECT_DELAY = 1.0
+
+
+# return the settings as a dict, or None if not enabled
+def get_config():
+    config = getattr(settings, "EVENTSTREAM_POSTGRES_NOTIFY", None)
+    if config is None or config is False:
+        return None
+    if config is True:
+        return {}
+    return config
+
+
+# return the payload to send for a message. messages about stored events
+#   that are too big for a notification only carry the event's position,
+#   and receivers fetch the event from the database
+def make_payload(message):
+    payload = json.dumps(message)
+    if len(payload.encode("utf-8")) < MAX_PAYLOAD:
+        return payload
+
+    if message.get("pub_id") is None:
+        raise ValueError(
+            "event on channel %s is too big for NOTIFY and isn't stored"
+            % message["channel"]
+        )
+
+    ref = {"channel": message["channel"], "pub_id": message["pub_id"], "fetch": True}
+    if message.get("trace"):
+        ref["trace"] = message["trace"]
+    return json.dumps(ref)
+
+
+class PostgresNotifier(object):
+    """
+    Sends messages to the other worker processes with NOTIFY. The server only
+    delivers a notification when the transaction that sent it commits, so
+    notifications sent in the transaction inserting an event are never
+    received before the event can be read.
+    """
+
+    def __init__(self, config):
+        self.database = config.get("database", "default")
+        self.channel = config.get("channel", "eventstream")
+
+    def notify(self, message):
+        payload = make_payload(message)
+        with connections[self.database].cursor() as cursor:
+            cursor.execute("SELECT pg_notify(%s, %s)", [self.channel, payload])
+
+
+notifier = None
+notifier_lock = threading.Lock()
+
+
+# return the PostgresNotifier, or None if not enabled
+def get_postgres_notifier():
+    global notifier
+    config = get_config()
+    if config is None:
+        return None
+    with notifier_lock:
+        if notifier is None:
+            notifier = PostgresNotifier(config)
+    return notifier
+
+
+def get_conninfo(database):
+    params = connections[database].settings_dict
+    conninfo = {
+        "dbname": params.get("NAME"),
+        "user": params.get("USER"),
+        "password": params.get("PASSWORD"),
+        "host": params.get("HOST"),
+        "port": params.get("PORT"),
+    }
+    return {k: v for k, v in conninfo.items() if v}
+
+
+class PostgresListener(object):
+    """
+    Receives the messages sent by PostgresNotifier, on a connection of its
+    own, and passes them to the local listeners. Notifications that only
+    carry an event's position are fetched from the database, in batches of
+    up to fetch_batch events. Messages arriving while a fetch is pending
+    wait for it, so they are passed on in the order they were sent. Events
+    that could not be fetched make the listeners of their channel read from
+    the database, as when their queue overflows.
+    """
+
+    def __init__(self, config=None):
+        try:
+            import psycopg
+        except ImportError:
+            raise ImportError(
+                "You must install the psycopg package to use PostgreSQL notifications for multiprocess event handling. \n pip install psycopg"
+            )
+
+        if config is None:
+            config = get_config()
+        self.database = config.get("database", "default")
+        self.channel = config.get("channel", "eventstream")
+        self.fetch_batch = config.get("fetch_batch", 100)
+        self.conninfo = config.get("conninfo")
+        self.psycopg = psycopg
+
+        self.listening = False
+        self.received = 0
+        self.fetched = 0
+        self.last_message = None
+        self.pending = None
+
+    async def listen(self):
+        from psycopg import sql
+
+        conninfo = self.conninfo
+        if conninfo is None:
+            conninfo = get_conninfo(self.database)
+        if isinstance(conninfo, dict):
+            conn = await self.psycopg.AsyncConnection.connect(
+                autocommit=True, **conninfo
+            )
+        else:
+            conn = await self.psycopg.AsyncConnection.connect(conninfo, autocommit=True)
+
+        async with conn:
+            await conn.execute(
+                sql.SQL("LISTEN {}").format(sql.Identifier(self.channel))
+            )
+            self.listening = True
+            try:
+                async for notify in conn.notifies():
+                    self.received += 1
+                    self.last_message = time.time()
+                    self.handle(json.loads(notify.payload))
+            finally:
+                self.listening = False
+
+    def handle(self, message):
+        if self.pending is not None:
+            self.pending.append(message)
+        elif message.get("fetch"):
+            self.pending = [message]
+            asyncio.ensure_future(self.flush())
+        else:
+            self.dispatch(message)
+
+    async def flush(self):
+        while self.pending:
+            batch = self.pending
+            self.pending = []
+            try:
+                await sync_to_async(self.fetch)(batch)
+            except Exception:
+                logger.exception("failed to fetch notified events")
+            for message in batch:
+                if message.get("fetch"):
+                    # not fetched. the listeners of the channel read it
+                    #   from the db instead, along with what follows
+                    self.overflow(message["channel"])
+                else:
+                    self.dispatch(message)
+        self.pending = None
+
+    # fill in the type and data of messages that only carry a position
+    def fetch(self, messages):
+        from . import models
+        from .storage import DjangoModelStorage
+        from .utils import get_storage
+
+        storage = get_storage()
+        if isinstance(storage, DjangoModelStorage):
+            event_model = storage.get_event_model()
+        else:
+            event_model = models.Event
+
+        refs = [m for m in messages if m.get("fetch")]
+        for i in range(0, len(refs), self.fetch_batch):
+            chunk = refs[i : i + self.fetch_batch]
+
+            by_channel = {}
+            for m in chunk:
+                by_channel.setdefault(m["channel"], []).append(int(m["pub_id"]))
+            query = Q()
+            for channel, ids in by_channel.items():
+                query |= Q(channel=channel, eid__in=ids)
+
+            found = {}
+            for db_event in event_model.objects.using(self.database).filter(query):
+                found[(db_event.channel, db_event.eid)] = db_event
+
+            for m in chunk:
+                db_event = found.get((m["channel"], int(m["pub_id"])))
+                if db_event is None:
+                    # trimmed already. the listeners read from the db instead
+                    logger.warning(
+                        "notified event %s of channel %s not found"
+                        % (m["pub_id"], m["channel"])
+                    )
+                    continue
+                m["event_type"] = db_event.type
+                m["data"] = json.loads(db_event.data)
+                m["fetch"] = False
+                self.fetched += 1
+
+    def dispatch(self, message):
+        from .views import dispatch_message
+
+        dispatch_message(message, "notify")
+
+    def overflow(self, channel):
+        from .views import get_listener_manager
+
+        get_listener_manager().set_overflow(channel)
+
+    async def start(self):
+        while True:
+            try:
+                await self.listen()
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logger.exception("postgres listener failed")
+            await asyncio.sleep(RECONNECT_DELAY)
@@ -0,0 +1,201 @@
+import collections
+import json
+import logging
+import threading
+import time
+from django.conf import settings
+from pubcontrol import Item, PubControlClient
+
+logger = logging.getLogger(__name__)
+
+
+class PublishRequest(object):
+    def __init__(self, channel, item, wait=False):
+        self.channel = channel
+        self.item = item
+        self.exported = item.export()
+        self.exported["channel"] = channel
+        self.done = threading.Event() if wait else None
+        self.error = None
+
+    def finish(self, error=None):
+        self.error = error
+        if self.done is not None:
+            self.done.set()
+
+
+class GripPublisher(object):
+    """
+    Queues GRIP publishes and sends them to the proxies from a background
+    thread. Items queued within batch_delay of each other are sent in a single
+    publish request, across channels, and failed requests are retried with
+    exponential backoff. Batches are sent one at a time, so items reach the
+    proxy in the order they were queued.
+    """
+
+    def __init__(self, config=None, pubcontrol=None):
+        if config is None:
+            config = {}
+        self.enabled = bool(config)
+        self.batch_delay = config.get("batch_delay", 10) / 1000.0
+        self.batch_size = config.get("batch_size", 100)
+        self.queue_size = config.get("queue_size", 10000)
+        self.retries = config.get("retries", 3)
+        self.retry_backoff = config.get("retry_backoff", 500) / 1000.0
+        self.pubcontrol = pubcontrol
+
+        self.cond = threading.Condition()
+        self.queue = collections.deque()
+        self.thread = None
+        self.queued = 0
+        self.sent = 0
+        self.batches = 0
+        self.retried = 0
+        self.failed = 0
+        self.dropped = 0
+
+    def get_clients(self):
+        if self.pubcontrol is None:
+            from django_grip import get_pubcontrol
+
+            self.pubcontrol = get_pubcontrol()
+        return self.pubcontrol.clients
+
+    # queue an item for publishing. if blocking, wait until the batch
+    #   containing it has been sent, and raise if it could not be
+    def publish(
+        self, channel, formats, id=None, prev_id=None, meta=None, blocking=False
+    ):
+        if not self.get_clients():
+            return
+
+        prefix = getattr(settings, "GRIP_PREFIX", "")
+        item = Item(formats, id=id, prev_id=prev_id, meta=meta or {})
+        req = PublishRequest(prefix + channel, item, wait=blocking)
+
+        with self.cond:
+            if len(self.queue) >= self.queue_size:
+                self.dropped += 1
+                logger.warning("grip publish queue full, dropping item")
+                if blocking:
+                    raise ValueError("grip publish queue full")
+                return
+            self.queue.append(req)
+            self.queued += 1
+            self.ensure_thread()
+            self.cond.notify()
+
+        if blocking:
+            req.done.wait()
+            if req.error:
+                raise ValueError("failed to publish: %s" % req.error)
+
+    def ensure_thread(self):
+        if self.thread is None:
+            self.thread = threading.Thread(target=self.run, daemon=True)
+            self.thread.start()
+
+    def take_batch(self):
+        with self.cond:
+            while not self.queue:
+                self.cond.wait()
+
+            # give other items a chance to join the batch
+            deadline = time.monotonic() + self.batch_delay
+            while len(self.queue) < self.batch_size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                self.cond.wait(remaining)
+
+            batch = []
+            while self.queue and len(batch) < self.batch_size:
+                batch.append(self.queue.popleft())
+            return batch
+
+    def send_batch(self, batch):
+        headers = {"Content-Type": "application/json"}
+
+        error = None
+        for client in self.get_clients():
+            if not isinstance(client, PubControlClient):
+                # zmq clients have no per-request overhead to save
+                for req in batch:
+                    client.publish(req.channel, req.item, blocking=True)
+                continue
+
+            items = [req.exported for req in batch]
+            if client.sub_monitor:
+                items = [
+                    i
+                    for i in items
+                    if client.sub_monitor.is_channel_subscribed_to(i["channel"])
+                ]
+                if not items:
+                    continue
+            body = json.dumps({"items": items}).encode("utf-8")
+
+            attempt = 0
+            while True:
+                try:
+                    client.http_call("/publish/", body, headers)
+                    break
+                except ValueError as e:
+                    if attempt >= self.retries:
+                        logger.error("grip publish failed: %s" % e)
+                        error = str(e)
+                        break
+                    time.sleep(self.retry_backoff * (2**attempt))
+                    attempt += 1
+                    with self.cond:
+                        self.retried += 1
+
+        with self.cond:
+            self.batches += 1
+            if error:
+                self.failed += len(batch)
+            else:
+                self.sent += len(batch)
+
+        for req in batch:
+            req.finish(error)
+
+    def run(self):
+        while True:
+            batch = self.take_batch()
+            try:
+                self.send_batch(batch)
+            except Exception as e:
+                logger.exception("grip publish batch failed")
+                for req in batch:
+                    req.finish(str(e))
+
+    def get_stats(self):
+        with self.cond:
+            return {
+                "pending": len(self.queue),
+                "queued": self.queued,
+                "sent": self.sent,
+                "batches": self.batches,
+                "retried": self.retried,
+                "failed": self.failed,
+                "dropped": self.dropped,
+            }
+
+
+grip_publisher = None
+grip_publisher_lock = threading.Lock()
+
+
+def get_grip_publisher():
+    global grip_publisher
+    with grip_publisher_lock:
+        if grip_publisher is None:
+            grip_publisher = GripPublisher(
+                getattr(settings, "EVENTSTREAM_GRIP_PUBLISH", None)
+            )
+    return grip_publisher
+
+
+def get_grip_publish_stats():
+    return get_grip_publisher().get_stats()
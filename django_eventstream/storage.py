@@ -1,15 +1,33 @@
+import bisect
 import sys
 import json
 import datetime
+import hashlib
+import mmap
+import os
+import struct
+import threading
 import time
+import weakref
+import zlib
 from copy import deepcopy
 from typing import TypeVar, Dict, Any
+from urllib.parse import quote
 
+from asgiref.sync import sync_to_async
 from django.conf import settings
+from django.db import router
 from django.utils import timezone
 from django.core.serializers.json import DjangoJSONEncoder
 from .event import Event
-from .utils import get_storage
+from .metrics import get_metrics, timed
+from .utils import get_async_redis_client, get_redis_client
+
+try:
+    import fcntl
+except ImportError:
+    # not available on Windows
+    fcntl = None
 
 is_python3 = sys.version_info >= (3,)
 
@@ -19,6 +37,13 @@ EVENT_TIMEOUT = 60 * 24
 # attempt to trim this many events per pass
 EVENT_TRIM_BATCH = 50
 
+# maximum number of read results kept by a ReadCoalescer
+READ_CACHE_MAX = 1024
+
+# seconds after which a missing event id is assumed to belong to a failed
+#   insert, rather than one still in progress
+ID_GAP_TIMEOUT = 5
+
 T = TypeVar("T")
 
 
@@ -28,6 +53,16 @@ class EventDoesNotExist(Exception):
         self.current_id = current_id
 
 
+class PartialEvents(list):
+    """
+    Events returned by get_events that stop before a gap in the ids, where
+    an id was handed out but its event isn't visible yet. Reading again
+    shortly after may return more.
+    """
+
+    pass
+
+
 class RedisPackageIsNotAvailable(Exception):
     def __init__(self, message):
         super(Exception, self).__init__(message)
@@ -42,12 +77,34 @@ class StorageBase(object):
     def append_event(self, channel, event_type, data):
         raise NotImplementedError()
 
+    # append_event for async callers. storages with an async client should
+    #   override this. by default, append_event runs in a worker thread
+    async def aappend_event(self, channel, event_type, data):
+        return await sync_to_async(self.append_event)(channel, event_type, data)
+
     def get_events(self, channel, last_id, limit=100):
         raise NotImplementedError()
 
     def get_current_id(self, channel):
         raise NotImplementedError()
 
+    # store the compacted state of a channel as of event_id
+    def set_snapshot(self, channel, event_id, data):
+        raise NotImplementedError()
+
+    # return the channel's snapshot as an Event of type "snapshot", or None.
+    #   storages without snapshot support never have one
+    def get_snapshot(self, channel):
+        return None
+
+    # return dict of (channel, current-id). storages that can look up
+    #   several channels in one round trip should override this
+    def get_current_ids(self, channels):
+        out = {}
+        for channel in channels:
+            out[channel] = self.get_current_id(channel)
+        return out
+
 
 class RedisStorage(StorageBase):
     def __init__(self) -> None:
@@ -75,18 +132,16 @@ class RedisStorage(StorageBase):
 
     def _connect(self):
         """
-        Connects to the Redis server using the provided connection details.
+        Gets the process-wide Redis client for the provided connection details.
 
         Returns:
-            Redis: A Redis client instance.
+            Redis: A Redis client instance, sharing a bounded connection pool.
 
         Raises:
             RedisPackageIsNotAvailable: If the Redis package is not available.
         """
         try:
-            import redis
-
-            return redis.Redis(**self.connection_details)
+            return get_redis_client(self.connection_details)
         except ModuleNotFoundError:
             raise RedisPackageIsNotAvailable(
                 "Redis package is not available. Please install it using !pip install redis"
@@ -104,6 +159,7 @@ class RedisStorage(StorageBase):
             self.redis_client = self._connect()
         return self.redis_client
 
+    @timed
     def append_event(self, channel: str, event_type: str, data: dict):
         """
         Appends a new event to the storage for the specified channel.
@@ -133,6 +189,38 @@ class RedisStorage(StorageBase):
             except ConnectionError as e:
                 raise ConnectionError("Failed to append event to Redis.") from e
 
+    @timed
+    async def aappend_event(self, channel: str, event_type: str, data: dict):
+        """
+        Appends a new event like append_event, using an async Redis client.
+
+        Args:
+            channel (str): The name of the channel to append the event to.
+            event_type (str): The type of the event.
+            data (dict): The data associated with the event.
+
+        Returns:
+            Event: An Event object representing the appended event.
+        """
+        try:
+            client = get_async_redis_client(self.connection_details)
+        except ModuleNotFoundError:
+            raise RedisPackageIsNotAvailable(
+                "Redis package is not available. Please install it using !pip install redis"
+            )
+        try:
+            event_id = await client.incr("event_counter:" + channel)
+            event_data = json.dumps({"type": event_type, "data": data})
+            await client.setex(
+                "event:" + channel + ":" + str(event_id),
+                EVENT_TIMEOUT * 60,
+                event_data,
+            )
+            return Event(channel, event_type, data, id=event_id)
+        except ConnectionError as e:
+            raise ConnectionError("Failed to append event to Redis.") from e
+
+    @timed
     def get_events(self, channel: str, last_id: int, limit: int = 100):
         """
         Retrieves events from the storage for the specified channel,
@@ -150,13 +238,15 @@ class RedisStorage(StorageBase):
         current_id = self.get_current_id(channel)
         if last_id >= current_id:
             return events
-        for i in range(last_id + 1, min(last_id + limit + 1, current_id + 1)):
-            event_data = self.redis.get("event:" + channel + ":" + str(i))
+        ids = range(last_id + 1, min(last_id + limit + 1, current_id + 1))
+        keys = ["event:" + channel + ":" + str(i) for i in ids]
+        for i, event_data in zip(ids, self.redis.mget(keys)):
             if event_data:
                 event = json.loads(event_data)
                 events.append(Event(channel, event["type"], event["data"], id=i))
         return events
 
+    @timed
     def get_current_id(self, channel: str):
         """
         Gets the current event ID for the specified channel.
@@ -170,16 +260,87 @@ class RedisStorage(StorageBase):
         current_id = self.redis.get("event_counter:" + channel)
         return int(current_id) if current_id else 0
 
+    @timed
+    def get_current_ids(self, channels):
+        """
+        Gets the current event IDs for several channels in one round trip.
+
+        Args:
+            channels (list[str]): The names of the channels.
+
+        Returns:
+            dict: The current event ID for each channel.
+        """
+        channels = list(channels)
+        values = self.redis.mget(["event_counter:" + c for c in channels])
+        return {c: int(v) if v else 0 for c, v in zip(channels, values)}
+
+    @timed
+    def set_snapshot(self, channel: str, event_id: int, data):
+        """
+        Stores the compacted state of a channel as of an event ID.
+
+        Args:
+            channel (str): The name of the channel.
+            event_id (int): The ID of the last event included in the state.
+            data: The state data.
+        """
+        snapshot_data = json.dumps({"id": event_id, "data": data})
+        self.redis.set("snapshot:" + channel, snapshot_data)
+
+    @timed
+    def get_snapshot(self, channel: str):
+        """
+        Gets the snapshot stored for a channel.
+
+        Args:
+            channel (str): The name of the channel.
+
+        Returns:
+            Event: The snapshot as an Event of type "snapshot", or None.
+        """
+        snapshot_data = self.redis.get("snapshot:" + channel)
+        if not snapshot_data:
+            return None
+        snapshot = json.loads(snapshot_data)
+        return Event(channel, "snapshot", snapshot["data"], id=snapshot["id"])
+
 
 class DjangoModelStorage(StorageBase):
-    def append_event(self, channel, event_type, data):
+    # set from settings by __init__, which subclasses may not call
+    read_database = None
+
+    def __init__(self):
+        # database alias to read events from, such as a replica. see
+        #   read_replica_events
+        self.read_database = getattr(
+            settings, "EVENTSTREAM_STORAGE_READ_DATABASE", None
+        )
+
+    # the model events are stored in
+    def get_event_model(self):
         from . import models
 
-        db_event = models.Event(
+        return models.Event
+
+    # extra filters for the query reading the events that follow ref, the
+    #   referenced event
+    def get_read_filters(self, ref):
+        return {}
+
+    # on_insert, if given, is called with the new Event within the
+    #   transaction that inserts it
+    @timed
+    def append_event(self, channel, event_type, data, on_insert=None):
+        db_event = self.get_event_model()(
             channel=channel,
             type=event_type,
             data=json.dumps(data, cls=DjangoJSONEncoder),
         )
+        if on_insert:
+            db_event.on_insert = lambda db_event: on_insert(
+                Event(channel, event_type, data, id=db_event.eid)
+            )
         db_event.save()
 
         self.trim_event_log()
@@ -188,6 +349,12 @@ class DjangoModelStorage(StorageBase):
 
         return e
 
+    async def aappend_event(self, channel, event_type, data, on_insert=None):
+        return await sync_to_async(self.append_event)(
+            channel, event_type, data, on_insert=on_insert
+        )
+
+    @timed
     def get_events(self, channel, last_id, limit=100):
         from . import models
 
@@ -196,25 +363,110 @@ class DjangoModelStorage(StorageBase):
         else:
             assert isinstance(last_id, (int, long))
 
+        # with a read database, the current id must come from the primary
+        primary = None
+        if self.read_database is not None:
+            primary = router.db_for_write(models.EventCounter)
+
         try:
-            ec = models.EventCounter.objects.get(name=channel)
+            ec = models.EventCounter.objects.using(primary).get(name=channel)
             cur_id = ec.value
+            allocated = ec.updated
         except models.EventCounter.DoesNotExist:
             cur_id = 0
+            allocated = None
 
         if last_id == cur_id:
             return []
 
+        if primary is not None:
+            return self.read_replica_events(
+                channel, last_id, limit, primary, cur_id, allocated
+            )
+
+        return self.read_events(None, channel, last_id, limit, cur_id, allocated)
+
+    # read from the read database as far as it has caught up, and the rest
+    #   from the primary. the channel's counter on each side tells how far
+    #   that is, since it is updated in the transaction inserting the event
+    def read_replica_events(self, channel, last_id, limit, primary, cur_id, allocated):
+        from . import models
+
+        metrics = get_metrics()
+
+        try:
+            ec = models.EventCounter.objects.using(self.read_database).get(name=channel)
+            replica_id = ec.value
+            replica_allocated = ec.updated
+        except models.EventCounter.DoesNotExist:
+            replica_id = 0
+            replica_allocated = None
+
+        if replica_id <= last_id:
+            # nothing to read from the replica, or it is behind the
+            #   requested position
+            metrics.inc("eventstream_replica_reads_total", source="primary")
+            return self.read_events(primary, channel, last_id, limit, cur_id, allocated)
+
+        try:
+            events = self.read_events(
+                self.read_database,
+                channel,
+                last_id,
+                limit,
+                replica_id,
+                replica_allocated,
+            )
+        except EventDoesNotExist:
+            # let the primary decide, with its current id
+            metrics.inc("eventstream_replica_reads_total", source="primary")
+            return self.read_events(primary, channel, last_id, limit, cur_id, allocated)
+
+        # an id the replica skipped as timed out may only be missing there,
+        #   since the replica can apply commits later than the primary. let
+        #   the primary decide from the first skipped id
+        expected_id = last_id + 1
+        for i, e in enumerate(events):
+            if e.id != expected_id:
+                events = events[:i]
+                break
+            expected_id = e.id + 1
+        else:
+            if (
+                replica_id >= cur_id
+                or isinstance(events, PartialEvents)
+                or len(events) >= limit
+            ):
+                metrics.inc("eventstream_replica_reads_total", source="replica")
+                return events
+
+        # the replica is behind the primary. read the events it doesn't have
+        #   yet from the primary
+        metrics.inc("eventstream_replica_reads_total", source="both")
+        from_id = events[-1].id if events else last_id
+        tail = self.read_events(
+            primary, channel, from_id, limit - len(events), cur_id, allocated
+        )
+        if isinstance(tail, PartialEvents):
+            return PartialEvents(events + tail)
+        return events + tail
+
+    # read up to limit events following last_id from the database with the
+    #   given alias, where cur_id is the channel's current id as seen by that
+    #   database and allocated is when it was handed out
+    def read_events(self, using, channel, last_id, limit, cur_id, allocated):
+        events = self.get_event_model().objects.using(using)
+
         # look up the referenced event first, to avoid a range query when
         #   the referenced event doesn't exist
         try:
-            models.Event.objects.get(channel=channel, eid=last_id)
-        except models.Event.DoesNotExist:
+            ref = events.get(channel=channel, eid=last_id)
+        except events.model.DoesNotExist:
             raise EventDoesNotExist("No such event %d" % last_id, cur_id)
 
         # increase limit by 1 since we'll exclude the first result
-        db_events = models.Event.objects.filter(
-            channel=channel, eid__gte=last_id
+        db_events = events.filter(
+            channel=channel, eid__gte=last_id, **self.get_read_filters(ref)
         ).order_by("eid")[: limit + 1]
 
         # ensure the first result matches the referenced event
@@ -224,8 +476,23 @@ class DjangoModelStorage(StorageBase):
         # exclude the first result
         db_events = db_events[1:]
 
+        # when ids are allocated ahead of the inserts, an event may be
+        #   visible before one with a lower id. stop at the first missing id,
+        #   unless it was handed out long enough ago that its insert must
+        #   have failed
+        gap_cutoff = timezone.now() - datetime.timedelta(
+            seconds=getattr(settings, "EVENTSTREAM_ID_GAP_TIMEOUT", ID_GAP_TIMEOUT)
+        )
+        partial = False
+
         out = []
+        expected_id = last_id + 1
         for db_event in db_events:
+            # an event created after the cutoff was given its id after the
+            #   missing ones, so they may still be in progress
+            if db_event.eid != expected_id and db_event.created > gap_cutoff:
+                partial = True
+                break
             e = Event(
                 db_event.channel,
                 db_event.type,
@@ -233,9 +500,23 @@ class DjangoModelStorage(StorageBase):
                 id=db_event.eid,
             )
             out.append(e)
+            expected_id = db_event.eid + 1
+        else:
+            # ids up to the current one were handed out, but not all of the
+            #   events are visible yet
+            if (
+                len(db_events) < limit
+                and expected_id <= cur_id
+                and allocated > gap_cutoff
+            ):
+                partial = True
+
+        if partial:
+            return PartialEvents(out)
 
         return out
 
+    @timed
     def get_current_id(self, channel):
         from . import models
 
@@ -245,18 +526,664 @@ class DjangoModelStorage(StorageBase):
         except models.EventCounter.DoesNotExist:
             return 0
 
-    def trim_event_log(self):
+    @timed
+    def get_current_ids(self, channels):
+        from . import models
+
+        out = dict.fromkeys(channels, 0)
+        for name, value in models.EventCounter.objects.filter(
+            name__in=list(out.keys())
+        ).values_list("name", "value"):
+            out[name] = value
+        return out
+
+    @timed
+    def set_snapshot(self, channel, event_id, data):
         from . import models
 
+        models.EventSnapshot.objects.update_or_create(
+            channel=channel,
+            defaults={
+                "eid": event_id,
+                "data": json.dumps(data, cls=DjangoJSONEncoder),
+            },
+        )
+
+    @timed
+    def get_snapshot(self, channel):
+        from . import models
+
+        try:
+            snapshot = models.EventSnapshot.objects.get(channel=channel)
+        except models.EventSnapshot.DoesNotExist:
+            return None
+
+        return Event(channel, "snapshot", json.loads(snapshot.data), id=snapshot.eid)
+
+    @timed
+    def trim_event_log(self):
+        event_model = self.get_event_model()
+
         now = timezone.now()
         cutoff = now - datetime.timedelta(minutes=EVENT_TIMEOUT)
         while True:
-            events = models.Event.objects.filter(created__lt=cutoff)[:EVENT_TRIM_BATCH]
+            events = event_model.objects.filter(created__lt=cutoff)[:EVENT_TRIM_BATCH]
             if len(events) < 1:
                 break
             for e in events:
                 try:
                     e.delete()
-                except models.Event.DoesNotExist:
+                except event_model.DoesNotExist:
                     # someone else deleted. that's fine
                     pass
+
+
+class PartitionedModelStorage(DjangoModelStorage):
+    """
+    Stores events in a PostgreSQL table range-partitioned by creation time,
+    see the partitions module. Expired events are removed by dropping whole
+    partitions with the eventstream_partitions command, rather than row by
+    row, and reads only scan the partitions created since the referenced
+    event.
+    """
+
+    def __init__(self):
+        from .partitions import get_config
+
+        super().__init__()
+        self.read_slack = get_config()["read_slack"]
+
+    def get_event_model(self):
+        from . import models
+
+        return models.PartitionedEvent
+
+    def get_read_filters(self, ref):
+        # an event may be created slightly before one with a lower id, when
+        #   ids are allocated ahead of the inserts or hosts' clocks disagree
+        return {
+            "created__gte": ref.created - datetime.timedelta(seconds=self.read_slack)
+        }
+
+    def trim_event_log(self):
+        # expired partitions are dropped by the eventstream_partitions
+        #   command
+        pass
+
+
+# index entry: the offset of an event's record in the segment log
+SEGMENT_INDEX_ENTRY = struct.Struct("<Q")
+
+# record header: payload length and crc32
+SEGMENT_RECORD_HEADER = struct.Struct("<II")
+
+# seconds between retention passes for a channel that keeps being written to
+SEGMENT_RETENTION_INTERVAL = 60
+
+
+def segment_dir_name(channel):
+    name = quote(channel, safe="")
+    if len(name) > 200:
+        name = hashlib.sha1(channel.encode("utf-8")).hexdigest()
+    return "c-" + name
+
+
+class Segment(object):
+    """
+    A part of a channel's log: a file of records, and an index file holding
+    the offset of each record, so the position of an event is found without
+    scanning. Events are numbered from first_id. Reads go through memory
+    maps, which are remapped when the files have grown past them.
+    """
+
+    def __init__(self, path, first_id):
+        self.first_id = first_id
+        self.log_path = os.path.join(path, "%020d.log" % first_id)
+        self.index_path = os.path.join(path, "%020d.idx" % first_id)
+        self.lock = threading.Lock()
+        self.log_map = None
+        self.index_map = None
+
+    def count(self):
+        return os.stat(self.index_path).st_size // SEGMENT_INDEX_ENTRY.size
+
+    def log_size(self):
+        return os.stat(self.log_path).st_size
+
+    @staticmethod
+    def remap(m, path, size):
+        if m is not None and len(m) >= size:
+            return m
+        # maps are never closed, as other threads may be reading from them
+        with open(path, "rb") as f:
+            return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    # read the events numbered start to end, inclusive
+    def read(self, channel, start, end):
+        first = start - self.first_id
+        last = end - self.first_id
+
+        with self.lock:
+            self.index_map = self.remap(
+                self.index_map,
+                self.index_path,
+                (last + 1) * SEGMENT_INDEX_ENTRY.size,
+            )
+            index_map = self.index_map
+
+            # index entries are written after their records, so the log is
+            #   at least as long as the last entry needs
+            offset = SEGMENT_INDEX_ENTRY.unpack_from(
+                index_map, last * SEGMENT_INDEX_ENTRY.size
+            )[0]
+            self.log_map = self.remap(
+                self.log_map, self.log_path, offset + SEGMENT_RECORD_HEADER.size
+            )
+            size = SEGMENT_RECORD_HEADER.unpack_from(self.log_map, offset)[0]
+            self.log_map = self.remap(
+                self.log_map,
+                self.log_path,
+                offset + SEGMENT_RECORD_HEADER.size + size,
+            )
+            log_map = self.log_map
+
+        out = []
+        for i in range(first, last + 1):
+            offset = SEGMENT_INDEX_ENTRY.unpack_from(
+                index_map, i * SEGMENT_INDEX_ENTRY.size
+            )[0]
+            size = SEGMENT_RECORD_HEADER.unpack_from(log_map, offset)[0]
+            start = offset + SEGMENT_RECORD_HEADER.size
+            record = json.loads(log_map[start : start + size])
+            out.append(
+                Event(channel, record["type"], record["data"], id=self.first_id + i)
+            )
+        return out
+
+
+class SegmentWriter(object):
+    def __init__(self, segment):
+        self.segment = segment
+        self.log = open(segment.log_path, "a+b", buffering=0)
+        self.index = open(segment.index_path, "a+b", buffering=0)
+        # appends waiting to be flushed. the files are closed once the
+        #   writer is retired and none are left
+        self.syncing = 0
+        self.retired = False
+
+    def close(self):
+        self.log.close()
+        self.index.close()
+
+    def retire(self):
+        self.retired = True
+        if self.syncing == 0:
+            self.close()
+
+    # drop what a crash left behind: a partial index entry, index entries
+    #   whose records are incomplete, and records without index entries
+    def repair(self):
+        log_fd = self.log.fileno()
+        index_fd = self.index.fileno()
+
+        log_size = os.fstat(log_fd).st_size
+        count = os.fstat(index_fd).st_size // SEGMENT_INDEX_ENTRY.size
+
+        end = 0
+        while count > 0:
+            offset = SEGMENT_INDEX_ENTRY.unpack(
+                os.pread(
+                    index_fd,
+                    SEGMENT_INDEX_ENTRY.size,
+                    (count - 1) * SEGMENT_INDEX_ENTRY.size,
+                )
+            )[0]
+            header = os.pread(log_fd, SEGMENT_RECORD_HEADER.size, offset)
+            if len(header) == SEGMENT_RECORD_HEADER.size:
+                size, crc = SEGMENT_RECORD_HEADER.unpack(header)
+                start = offset + SEGMENT_RECORD_HEADER.size
+                payload = os.pread(log_fd, size, start)
+                if len(payload) == size and zlib.crc32(payload) == crc:
+                    end = start + size
+                    break
+            count -= 1
+
+        os.ftruncate(index_fd, count * SEGMENT_INDEX_ENTRY.size)
+        if log_size > end:
+            os.ftruncate(log_fd, end)
+
+
+class GroupCommit(object):
+    """
+    Flushes written files to disk on behalf of several writers at once.
+    Files passed to sync() while another flush is running are flushed
+    together by the next one, so under concurrent appends the number of
+    fsync calls stays well below the number of events.
+    """
+
+    def __init__(self, delay=0):
+        self.delay = delay
+        self.lock = threading.Lock()
+        self.sync_lock = threading.Lock()
+        self.batch = GroupCommitBatch()
+
+    def sync(self, files):
+        with self.lock:
+            batch = self.batch
+            batch.files.update(files)
+
+        with self.sync_lock:
+            # batches are completed in order, so one that isn't complete yet
+            #   is still the current one
+            if not batch.done:
+                if self.delay > 0:
+                    time.sleep(self.delay)
+                with self.lock:
+                    self.batch = GroupCommitBatch()
+                try:
+                    for f in batch.files:
+                        os.fsync(f.fileno())
+                except OSError as e:
+                    batch.error = e
+                batch.done = True
+
+        if batch.error is not None:
+            raise batch.error
+
+
+class GroupCommitBatch(object):
+    def __init__(self):
+        # holding the files keeps them open until they are flushed
+        self.files = set()
+        self.done = False
+        self.error = None
+
+
+class SegmentLog(object):
+    """
+    The segments of one channel. Appends are serialized between threads by
+    a lock, and between processes by an exclusive lock on a file in the
+    channel's directory. Other processes may add segments at any time, so
+    the list of segments is read again whenever the newest known segment
+    is full.
+    """
+
+    def __init__(self, storage, channel):
+        self.storage = storage
+        self.channel = channel
+        self.path = os.path.join(storage.path, segment_dir_name(channel))
+        self.lock = threading.Lock()
+        self.segments = []
+        self.writer = None
+        self.lock_file = None
+        self.retention_checked = 0
+
+    def load(self):
+        try:
+            names = os.listdir(self.path)
+        except FileNotFoundError:
+            names = []
+
+        known = {s.first_id: s for s in self.segments}
+        segments = []
+        for first_id in sorted(int(n[:-4]) for n in names if n.endswith(".idx")):
+            segment = known.get(first_id)
+            if segment is None:
+                segment = Segment(self.path, first_id)
+            segments.append(segment)
+        self.segments = segments
+
+    def is_full(self, segment):
+        try:
+            return segment.log_size() >= self.storage.segment_size
+        except FileNotFoundError:
+            return True
+
+    def get_segments(self):
+        segments = self.segments
+        if not segments or self.is_full(segments[-1]):
+            with self.lock:
+                self.load()
+            segments = self.segments
+        return segments
+
+    def current_id(self, segments=None):
+        if segments is None:
+            segments = self.get_segments()
+        if not segments:
+            return 0
+        active = segments[-1]
+        try:
+            return active.first_id + active.count() - 1
+        except FileNotFoundError:
+            # removed by another process
+            with self.lock:
+                self.load()
+            return self.current_id()
+
+    def get_writer(self):
+        if self.writer is not None and not self.is_full(self.writer.segment):
+            return self.writer
+
+        self.load()
+
+        if self.segments and not self.is_full(self.segments[-1]):
+            segment = self.segments[-1]
+        else:
+            # start a new segment after the last one
+            first_id = self.current_id(self.segments) + 1
+            segment = Segment(self.path, first_id)
+            self.segments = self.segments + [segment]
+
+        if self.writer is not None:
+            self.writer.retire()
+        self.writer = SegmentWriter(segment)
+        self.writer.repair()
+
+        if len(self.segments) > 1:
+            self.apply_retention()
+
+        return self.writer
+
+    def append(self, event_type, data):
+        payload = json.dumps(
+            {"type": event_type, "data": data}, cls=DjangoJSONEncoder
+        ).encode("utf-8")
+        record = SEGMENT_RECORD_HEADER.pack(len(payload), zlib.crc32(payload))
+
+        with self.lock:
+            if self.lock_file is None:
+                os.makedirs(self.path, exist_ok=True)
+                self.lock_file = open(os.path.join(self.path, "lock"), "ab")
+
+            fcntl.flock(self.lock_file.fileno(), fcntl.LOCK_EX)
+            try:
+                writer = self.get_writer()
+                offset = os.fstat(writer.log.fileno()).st_size
+                event_id = (
+                    writer.segment.first_id
+                    + os.fstat(writer.index.fileno()).st_size
+                    // SEGMENT_INDEX_ENTRY.size
+                )
+                writer.log.write(record + payload)
+                writer.index.write(SEGMENT_INDEX_ENTRY.pack(offset))
+                if self.storage.committer is not None:
+                    writer.syncing += 1
+
+                now = time.monotonic()
+                if now - self.retention_checked >= SEGMENT_RETENTION_INTERVAL:
+                    self.apply_retention()
+                    self.retention_checked = now
+            finally:
+                fcntl.flock(self.lock_file.fileno(), fcntl.LOCK_UN)
+
+        if self.storage.committer is not None:
+            try:
+                self.storage.committer.sync([writer.log, writer.index])
+            finally:
+                with self.lock:
+                    writer.syncing -= 1
+                    if writer.retired and writer.syncing == 0:
+                        writer.close()
+
+        return event_id
+
+    def close(self):
+        with self.lock:
+            if self.writer is not None:
+                self.writer.retire()
+                self.writer = None
+            if self.lock_file is not None:
+                self.lock_file.close()
+                self.lock_file = None
+
+    # delete old segments, never the one being written to. called with the
+    #   channel locked
+    def apply_retention(self):
+        storage = self.storage
+        now = time.time()
+        total = self.segments[-1].log_size()
+        expired = []
+        for segment in reversed(self.segments[:-1]):
+            try:
+                st = os.stat(segment.log_path)
+                total += st.st_size + segment.count() * SEGMENT_INDEX_ENTRY.size
+            except FileNotFoundError:
+                continue
+            if (
+                storage.retention_age and now - st.st_mtime > storage.retention_age
+            ) or (storage.retention_size and total > storage.retention_size):
+                expired.append(segment)
+
+        for segment in expired:
+            # readers find segments by their index files
+            for path in (segment.index_path, segment.log_path):
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+
+        if expired:
+            self.segments = [s for s in self.segments if s not in expired]
+
+    def read(self, last_id, limit):
+        segments = self.get_segments()
+        cur_id = self.current_id(segments)
+
+        if last_id == cur_id:
+            return []
+
+        if last_id > cur_id or not segments or last_id + 1 < segments[0].first_id:
+            raise EventDoesNotExist("No such event %d" % last_id, cur_id)
+
+        start = last_id + 1
+        end = min(last_id + limit, cur_id)
+
+        i = bisect.bisect_right([s.first_id for s in segments], start) - 1
+        out = []
+        try:
+            for n, segment in enumerate(segments[i:], i):
+                if start > end:
+                    break
+                if n + 1 < len(segments):
+                    segment_end = min(end, segments[n + 1].first_id - 1)
+                else:
+                    segment_end = end
+                out.extend(segment.read(self.channel, start, segment_end))
+                start = segment_end + 1
+        except FileNotFoundError:
+            # removed by retention in another process
+            raise EventDoesNotExist("No such event %d" % last_id, cur_id)
+
+        return out
+
+
+class SegmentFileStorage(StorageBase):
+    """
+    Keeps each channel's events in append-only segment files on local disk,
+    for single-node installs that want durable replay without a database.
+    Appends are flushed to disk before returning, with concurrent appends
+    sharing flushes. Old segments are removed by age and total size.
+    """
+
+    def __init__(self):
+        if fcntl is None:
+            raise IncompatibleSettings(
+                "Segment file storage needs file locking, which isn't available on this platform"
+            )
+
+        config = getattr(settings, "EVENTSTREAM_SEGMENT_STORAGE", None)
+        if not isinstance(config, dict) or not config.get("path"):
+            raise IncompatibleSettings(
+                "To use segment file storage, set the directory to store events in as EVENTSTREAM_SEGMENT_STORAGE['path']"
+            )
+
+        self.path = config["path"]
+        self.segment_size = config.get("segment_size", 64 * 1024 * 1024)
+        self.retention_age = config.get("retention_age", EVENT_TIMEOUT * 60)
+        self.retention_size = config.get("retention_size")
+        if config.get("fsync", True):
+            self.committer = GroupCommit(config.get("fsync_delay", 0) / 1000.0)
+        else:
+            self.committer = None
+
+        self.logs = {}
+        self.logs_lock = threading.Lock()
+
+    # close the files held open for writing. the storage can still be used
+    #   afterwards, and opens them again as needed
+    def close(self):
+        with self.logs_lock:
+            logs = list(self.logs.values())
+        for log in logs:
+            log.close()
+
+    def get_log(self, channel):
+        log = self.logs.get(channel)
+        if log is None:
+            with self.logs_lock:
+                log = self.logs.get(channel)
+                if log is None:
+                    log = SegmentLog(self, channel)
+                    self.logs[channel] = log
+        return log
+
+    @timed
+    def append_event(self, channel, event_type, data):
+        event_id = self.get_log(channel).append(event_type, data)
+        return Event(channel, event_type, data, id=event_id)
+
+    @timed
+    def get_events(self, channel, last_id, limit=100):
+        return self.get_log(channel).read(last_id, limit)
+
+    @timed
+    def get_current_id(self, channel):
+        return self.get_log(channel).current_id()
+
+    def snapshot_path(self, channel):
+        return os.path.join(self.path, segment_dir_name(channel), "snapshot")
+
+    @timed
+    def set_snapshot(self, channel, event_id, data):
+        path = self.snapshot_path(channel)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = "%s.%d.%d" % (path, os.getpid(), threading.get_ident())
+        with open(tmp_path, "w") as f:
+            json.dump({"id": event_id, "data": data}, f, cls=DjangoJSONEncoder)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+
+    @timed
+    def get_snapshot(self, channel):
+        try:
+            with open(self.snapshot_path(channel)) as f:
+                snapshot = json.load(f)
+        except FileNotFoundError:
+            return None
+        return Event(channel, "snapshot", snapshot["data"], id=snapshot["id"])
+
+
+class ReadFlight(object):
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class ReadCoalescer(object):
+    """
+    Wraps the reads of a storage so that identical concurrent calls to
+    get_events share a single fetch. When the caller knows the channel's
+    current id, the result is also kept for a short time, keyed on that id,
+    so later identical reads don't reach the storage either.
+    """
+
+    def __init__(self, storage, cache_ttl=1.0):
+        self.storage = storage
+        self.cache_ttl = cache_ttl
+        self.lock = threading.Lock()
+        self.flights = {}
+        self.results = {}
+
+    def get_events(self, channel, last_id, limit=100, current_id=None):
+        key = (channel, last_id, limit)
+        now = time.monotonic()
+
+        with self.lock:
+            if current_id is not None:
+                cached = self.results.get(key)
+                if cached and cached[0] == current_id and cached[1] > now:
+                    return self._result(cached[2])
+
+            flight = self.flights.get(key)
+            if flight is None:
+                flight = ReadFlight()
+                self.flights[key] = flight
+                leader = True
+            else:
+                leader = False
+
+        if not leader:
+            flight.done.wait()
+            return self._result(flight)
+
+        try:
+            flight.result = self.storage.get_events(channel, last_id, limit=limit)
+        except Exception as e:
+            flight.error = e
+            raise
+        finally:
+            with self.lock:
+                del self.flights[key]
+                if current_id is not None and self.cache_ttl > 0:
+                    self._cache(key, current_id, now + self.cache_ttl, flight)
+            flight.done.set()
+
+        return flight.result
+
+    def _cache(self, key, current_id, expires, flight):
+        if not isinstance(flight.error, (type(None), EventDoesNotExist)):
+            return
+        if isinstance(flight.result, PartialEvents):
+            # the rest may become visible without the current id changing
+            return
+        if len(self.results) >= READ_CACHE_MAX:
+            now = time.monotonic()
+            for k, v in list(self.results.items()):
+                if v[1] <= now:
+                    del self.results[k]
+            if len(self.results) >= READ_CACHE_MAX:
+                self.results.clear()
+        self.results[key] = (current_id, expires, flight)
+
+    @staticmethod
+    def _result(flight):
+        e = flight.error
+        if e is None:
+            return flight.result
+        if isinstance(e, EventDoesNotExist):
+            # raise a new instance for each caller, since raising appends
+            #   to the traceback of the instance, and cached errors are
+            #   raised from many threads
+            raise EventDoesNotExist(str(e), e.current_id)
+        raise e
+
+
+coalescers = weakref.WeakKeyDictionary()
+coalescers_lock = threading.Lock()
+
+
+# return the ReadCoalescer for a storage instance, or None if disabled
+def get_read_coalescer(storage):
+    if not getattr(settings, "EVENTSTREAM_READ_COALESCING", False):
+        return None
+    cache_ttl = getattr(settings, "EVENTSTREAM_READ_CACHE_TTL", 1.0)
+    with coalescers_lock:
+        c = coalescers.get(storage)
+        if c is None:
+            c = ReadCoalescer(storage)
+            coalescers[storage] = c
+        c.cache_ttl = cache_ttl
+    return c
@@ -0,0 +1,37 @@
+import random
+import time
+from django.conf import settings
+from .metrics import get_metrics
+
+# A trace is a dict carried with a sampled event, in process with the Event
+#   object and across processes in the Redis message. It holds the wall clock
+#   time the event was sent and the time of the most recent stage, so each
+#   stage can record how long it took since the one before. Wall clock times
+#   are used so that stages in different processes can be compared.
+
+
+def start_trace():
+    rate = getattr(settings, "EVENTSTREAM_TRACE_SAMPLE_RATE", 0)
+    if not rate or not get_metrics().enabled or random.random() >= rate:
+        return None
+    now = time.time()
+    return {"start": now, "last": now}
+
+
+def observe_stage(stage, seconds):
+    # clocks of different hosts may disagree slightly
+    get_metrics().observe(
+        "eventstream_trace_stage_seconds", max(seconds, 0), stage=stage
+    )
+
+
+# record a pipeline stage that happens once per event in a process
+def mark_stage(trace, stage):
+    now = time.time()
+    observe_stage(stage, now - trace["last"])
+    trace["last"] = now
+
+
+# record that a traced event reached a client, end to end
+def observe_delivered(trace, now):
+    get_metrics().observe("eventstream_trace_seconds", max(now - trace["start"], 0))
@@ -1,8 +1,15 @@
+import asyncio
+import base64
+import functools
 import json
 import threading
+import weakref
 import importlib
 import re
+import time
+import zlib
 import six
+from collections import OrderedDict
 from django.conf import settings
 from django.http import HttpResponse
 from django.core.serializers.json import DjangoJSONEncoder
@@ -14,17 +21,38 @@ try:
 except ImportError:
     from urllib.parse import quote, urlparse
 
-tlocal = threading.local()
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# prefix distinguishing compact ids from the legacy channel:id format
+COMPACT_ID_PREFIX = "~"
+
+loaded_classes = {}
+loaded_classes_lock = threading.Lock()
+
+redis_clients = {}
+redis_clients_lock = threading.Lock()
+
+# redis.asyncio clients, per event loop
+async_redis_clients = weakref.WeakKeyDictionary()
 
 
 # return dict of (channel, last-id)
 def parse_last_event_id(s):
-    out = {}
+    return dict(parse_last_event_id_cached(s))
+
+
+# clients on the same stream resume with the same ids, so remember them
+@functools.lru_cache(maxsize=1024)
+def parse_last_event_id_cached(s):
+    out = []
     parts = s.split(",")
     for part in parts:
         channel, last_id = part.split(":")
-        out[channel] = last_id
-    return out
+        out.append((channel, last_id))
+    return tuple(out)
 
 
 def make_id(ids):
@@ -35,6 +63,95 @@ def make_id(ids):
     return ",".join(id_parts)
 
 
+# the prefix alone doesn't tell, since quote() leaves it as is and a legacy
+#   id may start with it. legacy ids always contain ":" though, and compact
+#   ids never do
+def is_compact_id(s):
+    return s.startswith(COMPACT_ID_PREFIX) and ":" not in s
+
+
+# return the channels in a fixed order, and a checksum of that order
+@functools.lru_cache(maxsize=1024)
+def get_compact_id_order(channels):
+    order = tuple(sorted(channels))
+    checksum = zlib.crc32("\n".join(order).encode("utf-8")) & 0xFFFF
+    return order, checksum
+
+
+def make_compact_id(ids, channels):
+    """
+    Encode ids as a vector of varints, one per channel in sorted order, with
+    each value being the id plus one, or zero if the channel has no id. The
+    vector is preceded by a checksum of the channel names, and the result is
+    base64 encoded. Decoding requires the same set of channels.
+    """
+    order, checksum = get_compact_id_order(frozenset(channels))
+
+    out = bytearray(checksum.to_bytes(2, "big"))
+    for channel in order:
+        id = ids.get(channel)
+        if id is None:
+            n = 0
+        else:
+            try:
+                n = int(id) + 1
+            except ValueError:
+                return make_id(ids)
+            if n < 1:
+                return make_id(ids)
+        while n >= 0x80:
+            out.append((n & 0x7F) | 0x80)
+            n >>= 7
+        out.append(n)
+
+    enc = base64.urlsafe_b64encode(bytes(out)).rstrip(b"=").decode("ascii")
+    return COMPACT_ID_PREFIX + enc
+
+
+# return dict of (channel, last-id), or an empty dict if the id was made for
+#   a different set of channels
+def parse_compact_id(s, channels):
+    return dict(parse_compact_id_cached(s, frozenset(channels)))
+
+
+@functools.lru_cache(maxsize=1024)
+def parse_compact_id_cached(s, channels):
+    order, checksum = get_compact_id_order(channels)
+
+    enc = s[len(COMPACT_ID_PREFIX) :]
+    data = base64.urlsafe_b64decode(enc + "=" * (-len(enc) % 4))
+
+    if len(data) < 2:
+        raise ValueError("compact id too short")
+    if int.from_bytes(data[:2], "big") != checksum:
+        return ()
+
+    values = []
+    n = 0
+    shift = 0
+    for b in data[2:]:
+        n |= (b & 0x7F) << shift
+        if b & 0x80:
+            shift += 7
+        else:
+            values.append(n)
+            n = 0
+            shift = 0
+
+    if shift != 0 or len(values) != len(order):
+        raise ValueError("invalid compact id")
+
+    out = []
+    for channel, n in zip(order, values):
+        if n > 0:
+            out.append((channel, str(n - 1)))
+    return tuple(out)
+
+
+def use_compact_ids():
+    return getattr(settings, "EVENTSTREAM_COMPACT_IDS", False)
+
+
 def build_id_escape(s):
     out = ""
     for c in s:
@@ -83,11 +200,40 @@ def sse_error_response(condition, text, extra=None):
     )
 
 
+def grip_publish(channel, formats, **kwargs):
+    from django_grip import publish
+    from .publisher import get_grip_publisher
+
+    from .metrics import get_metrics
+
+    publisher = get_grip_publisher()
+    if publisher.enabled:
+        kwargs.pop("callback", None)
+        publisher.publish(channel, formats, **kwargs)
+        return
+
+    metrics = get_metrics()
+    if not metrics.enabled:
+        publish(channel, formats, **kwargs)
+        return
+
+    def callback(success, message):
+        if not success:
+            metrics.inc("eventstream_grip_publish_failed_total")
+
+    if not kwargs.get("blocking"):
+        kwargs["callback"] = callback
+
+    try:
+        publish(channel, formats, **kwargs)
+    except ValueError:
+        metrics.inc("eventstream_grip_publish_failed_total")
+        raise
+
+
 def publish_event(
     channel, event_type, data, pub_id, pub_prev_id, skip_user_ids=None, **publish_kwargs
 ):
-    from django_grip import publish
-
     if skip_user_ids is None:
         skip_user_ids = []
 
@@ -101,7 +247,7 @@ def publish_event(
     meta = {}
     if skip_user_ids:
         meta["skip_users"] = ",".join(skip_user_ids)
-    publish(
+    grip_publish(
         "events-%s" % quote(channel),
         HttpStreamFormat(content, content_filters=content_filters),
         id=pub_id,
@@ -112,14 +258,12 @@ def publish_event(
 
 
 def publish_kick(user_id, channel):
-    from django_grip import publish
-
     msg = "Permission denied to channels: %s" % channel
     data = {"condition": "forbidden", "text": msg, "channels": [channel]}
     content = sse_encode_event("stream-error", data, event_id="error")
     meta = {"require_sub": "events-%s" % channel}
-    publish("user-%s" % user_id, HttpStreamFormat(content), id="kick-1", meta=meta)
-    publish(
+    grip_publish("user-%s" % user_id, HttpStreamFormat(content), id="kick-1", meta=meta)
+    grip_publish(
         "user-%s" % user_id,
         HttpStreamFormat(close=True),
         id="kick-2",
@@ -128,6 +272,50 @@ def publish_kick(user_id, channel):
     )
 
 
+class LRUCache(object):
+    """
+    Thread-safe mapping that keeps at most maxsize entries, dropping the least
+    recently used first. Entries also expire after ttl seconds, if set.
+    """
+
+    def __init__(self, maxsize, ttl=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+
+    def get(self, key, default=None):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return default
+            value, expires = entry
+            if expires is not None and expires <= time.monotonic():
+                del self.entries[key]
+                return default
+            self.entries.move_to_end(key)
+            return value
+
+    def set(self, key, value, ttl=None):
+        if ttl is None:
+            ttl = self.ttl
+        expires = time.monotonic() + ttl if ttl is not None else None
+        with self.lock:
+            self.entries[key] = (value, expires)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+
+    def pop(self, key, default=None):
+        with self.lock:
+            entry = self.entries.pop(key, None)
+        return entry[0] if entry is not None else default
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+
 def load_class(name):
     at = name.rfind(".")
     if at == -1:
@@ -137,14 +325,16 @@ def load_class(name):
     return getattr(importlib.import_module(module_name), class_name)()
 
 
-# load and keep in thread local storage
+# load and keep for the whole process. loaded classes are shared by all
+#   threads, so they must be thread-safe
 def get_class(name):
-    if not hasattr(tlocal, "loaded"):
-        tlocal.loaded = {}
-    c = tlocal.loaded.get(name)
+    c = loaded_classes.get(name)
     if c is None:
-        c = load_class(name)
-        tlocal.loaded[name] = c
+        with loaded_classes_lock:
+            c = loaded_classes.get(name)
+            if c is None:
+                c = load_class(name)
+                loaded_classes[name] = c
     return c
 
 
@@ -157,6 +347,87 @@ def get_class_from_setting(setting_name, default=None):
         return None
 
 
+# return a process-wide redis client for the given connection details. all
+#   clients share a bounded, blocking connection pool per set of details
+def get_redis_client(connection_details):
+    import redis
+
+    key = json.dumps(connection_details, sort_keys=True, default=str)
+    with redis_clients_lock:
+        client = redis_clients.get(key)
+        if client is None:
+            # let redis work out the connection class and arguments
+            base_pool = redis.Redis(**connection_details).connection_pool
+            pool = redis.BlockingConnectionPool(
+                max_connections=getattr(
+                    settings, "EVENTSTREAM_REDIS_MAX_CONNECTIONS", 50
+                ),
+                timeout=getattr(settings, "EVENTSTREAM_REDIS_POOL_TIMEOUT", 20),
+                connection_class=base_pool.connection_class,
+                **base_pool.connection_kwargs,
+            )
+            client = redis.Redis(connection_pool=pool)
+            redis_clients[key] = client
+    return client
+
+
+# like get_redis_client, but returns a redis.asyncio client for use on the
+#   running event loop. such clients can't be shared between loops, so each
+#   loop gets its own
+def get_async_redis_client(connection_details):
+    import redis.asyncio
+
+    loop = asyncio.get_running_loop()
+    key = json.dumps(connection_details, sort_keys=True, default=str)
+    with redis_clients_lock:
+        clients = async_redis_clients.get(loop)
+        if clients is None:
+            clients = {}
+            async_redis_clients[loop] = clients
+        client = clients.get(key)
+        if client is None:
+            base_pool = redis.asyncio.Redis(**connection_details).connection_pool
+            pool = redis.asyncio.BlockingConnectionPool(
+                max_connections=getattr(
+                    settings, "EVENTSTREAM_REDIS_MAX_CONNECTIONS", 50
+                ),
+                timeout=getattr(settings, "EVENTSTREAM_REDIS_POOL_TIMEOUT", 20),
+                connection_class=base_pool.connection_class,
+                **base_pool.connection_kwargs,
+            )
+            client = redis.asyncio.Redis(connection_pool=pool)
+            clients[key] = client
+    return client
+
+
+def get_redis_pool_stats():
+    with redis_clients_lock:
+        clients = list(redis_clients.values())
+
+    out = []
+    for client in clients:
+        pool = client.connection_pool
+        stats = {
+            "host": pool.connection_kwargs.get("host"),
+            "port": pool.connection_kwargs.get("port"),
+            "db": pool.connection_kwargs.get("db"),
+            "max_connections": pool.max_connections,
+        }
+
+        # usage comes from internals of BlockingConnectionPool, which may
+        #   change between redis versions. left out if they aren't there
+        connections = getattr(pool, "_connections", None)
+        queue = getattr(getattr(pool, "pool", None), "queue", None)
+        if connections is not None and queue is not None:
+            created = len(connections)
+            idle = len([c for c in list(queue) if c is not None])
+            stats["created"] = created
+            stats["in_use"] = created - idle
+
+        out.append(stats)
+    return out
+
+
 def get_storage():
     return get_class_from_setting("EVENTSTREAM_STORAGE_CLASS")
 
@@ -168,6 +439,81 @@ def get_channelmanager():
     )
 
 
+# return (max delay in seconds, max bytes) for grouping queued events into
+#   a single chunk. a delay of zero flushes every wakeup immediately
+def get_flush_policy():
+    delay = getattr(settings, "EVENTSTREAM_FLUSH_DELAY", 0)
+    max_bytes = getattr(settings, "EVENTSTREAM_FLUSH_MAX_BYTES", 65536)
+    return max(delay, 0) / 1000.0, max_bytes
+
+
+class StreamCompressor(object):
+    def __init__(self, encoding):
+        self.encoding = encoding
+        if encoding == "br":
+            self.compressor = brotli.Compressor()
+        else:
+            # gzip and deflate differ only in the framing around the data
+            wbits = 31 if encoding == "gzip" else 15
+            self.compressor = zlib.compressobj(6, zlib.DEFLATED, wbits)
+
+    # compress a chunk and flush it, so the client can decode everything
+    #   sent so far while the compression context is kept for later chunks
+    def compress(self, data):
+        if isinstance(data, str):
+            data = data.encode("utf-8")
+        if self.encoding == "br":
+            return self.compressor.process(data) + self.compressor.flush()
+        return self.compressor.compress(data) + self.compressor.flush(zlib.Z_SYNC_FLUSH)
+
+
+def get_compression_encodings():
+    setting = getattr(settings, "EVENTSTREAM_COMPRESSION", False)
+    if not setting:
+        return []
+    if setting is True:
+        setting = ["br", "gzip", "deflate"]
+    return [e for e in setting if e != "br" or brotli is not None]
+
+
+# return the preferred encoding accepted by the request, or None
+def negotiate_stream_encoding(request):
+    encodings = get_compression_encodings()
+    if not encodings:
+        return None
+
+    accepted = {}
+    for part in request.META.get("HTTP_ACCEPT_ENCODING", "").split(","):
+        params = part.strip().split(";")
+        name = params[0].strip().lower()
+        if not name:
+            continue
+        q = 1.0
+        for param in params[1:]:
+            k, _, v = param.strip().partition("=")
+            if k == "q":
+                try:
+                    q = float(v)
+                except ValueError:
+                    q = 0.0
+        accepted[name] = q
+
+    for encoding in encodings:
+        if accepted.get(encoding, accepted.get("*", 0.0)) > 0:
+            return encoding
+
+    return None
+
+
+async def compress_stream(stream, encoding):
+    compressor = StreamCompressor(encoding)
+    try:
+        async for chunk in stream:
+            yield compressor.compress(chunk)
+    finally:
+        await stream.aclose()
+
+
 def add_default_headers(headers, request):
     headers["Cache-Control"] = "no-cache"
     headers["X-Accel-Buffering"] = "no"
@@ -2,19 +2,47 @@
 from __future__ import unicode_literals
 
 import asyncio
+import collections
 import copy
+import functools
+import hmac
 import logging
+import os
+import random
 import threading
+import time
 import json
 from asgiref.sync import sync_to_async
-from django.http import HttpResponseBadRequest, StreamingHttpResponse
-from .utils import add_default_headers
+from django.http import (
+    HttpResponse,
+    HttpResponseBadRequest,
+    HttpResponseForbidden,
+    JsonResponse,
+    StreamingHttpResponse,
+)
+from django.utils.cache import patch_vary_headers
+from .metrics import get_metrics
+from .pgnotify import get_config as get_postgres_config
+from .tracing import mark_stage, observe_delivered, observe_stage
+from .utils import add_default_headers, negotiate_stream_encoding, compress_stream
 from django.conf import settings
 
 logger = logging.getLogger(__name__)
 
 MAX_PENDING = 10
 
+# seconds to wait before reading again, when a read stopped at an event that
+#   was still being written
+GAP_RETRY_DELAY = 0.05
+
+
+# return the event loop of the calling thread, or None
+def get_running_loop():
+    try:
+        return asyncio.get_running_loop()
+    except RuntimeError:
+        return None
+
 
 class Listener(object):
     def __init__(self):
@@ -22,9 +50,12 @@ class Listener(object):
         self.aevent = asyncio.Event()
         self.user_id = ""
         self.channels = set()
+        self.event_types = None
         self.channel_items = {}
         self.overflow = False
         self.error = ""
+        self.created = time.time()
+        self.last_write = None
 
     def assign_loop(self):
         self.loop = asyncio.get_event_loop()
@@ -32,6 +63,15 @@ class Listener(object):
     def wake_threadsafe(self):
         self.loop.call_soon_threadsafe(self.aevent.set)
 
+    # wake from running_loop, the loop of the calling thread if any. when
+    #   it's the listener's own loop, set the event directly instead of
+    #   scheduling it
+    def wake(self, running_loop):
+        if running_loop is not None and running_loop is self.loop:
+            self.aevent.set()
+        else:
+            self.wake_threadsafe()
+
 
 class RedisListener(object):
     def __init__(self):
@@ -44,48 +84,108 @@ class RedisListener(object):
 
         self.redis_client = Redis(**settings.EVENTSTREAM_REDIS)
         self.pubsub = self.redis_client.pubsub()
+        self.subscribed = False
+        self.received = 0
+        self.last_message = None
 
     async def listen(self):
         await self.pubsub.subscribe("events_channel")
+        self.subscribed = True
+        try:
+            await self.receive()
+        finally:
+            self.subscribed = False
+
+    async def receive(self):
         async for message in self.pubsub.listen():
             if message["type"] == "message":
-                event_data = json.loads(message["data"])
-                channel = event_data["channel"]
-                event_type = event_data["event_type"]
-                data = event_data["data"]
-                pub_id = event_data["pub_id"]
+                self.received += 1
+                self.last_message = time.time()
+                dispatch_message(json.loads(message["data"]), "redis")
 
-                from .event import Event
+    async def start(self):
+        await self.listen()
 
-                e = Event(channel, event_type, data, id=pub_id)
 
-                # Notify local listeners
-                get_listener_manager().add_to_queues(channel, e)
+# handle a message sent by send_event or channel_permission_changed in
+#   another process. stage names the hop it arrived through, for tracing
+def dispatch_message(event_data, stage):
+    if event_data.get("type") == "permission-changed":
+        from .eventstream import apply_permission_changed
 
-    async def start(self):
-        await self.listen()
+        apply_permission_changed(
+            event_data["user_id"],
+            event_data["channel"],
+            kick=event_data["kick"],
+        )
+        return
+
+    channel = event_data["channel"]
+    event_type = event_data["event_type"]
+    data = event_data["data"]
+    pub_id = event_data["pub_id"]
+    if pub_id is not None:
+        # sent as a string
+        pub_id = int(pub_id)
+    trace = event_data.get("trace")
+    if trace:
+        mark_stage(trace, stage)
+
+    from .event import Event
+
+    e = Event(channel, event_type, data, id=pub_id, trace=trace)
+
+    # Notify local listeners
+    get_listener_manager().add_to_queues(channel, e)
 
 
 class ListenerManager(object):
     def __init__(self):
         self.lock = threading.Lock()
         self.listeners_by_channel = {}
+        self.listeners = set()
+        self.listener_count = 0
         self.redis_listener = None
         self.redis_listener_started = False
+        self.pg_listener = None
+        self.pg_listener_started = False
         if hasattr(settings, "EVENTSTREAM_REDIS"):
             self.redis_listener = RedisListener()
+        elif get_postgres_config() is not None:
+            from .pgnotify import PostgresListener
 
-    async def start_redis_listener(self):
-        await self.redis_listener.start()
+            self.pg_listener = PostgresListener()
+
+    # start receiving messages from the other processes, if configured. they
+    #   are received on the calling thread's event loop if it has one, else
+    #   on a thread of their own
+    def ensure_subscriber(self):
+        with self.lock:
+            if self.redis_listener:
+                if self.redis_listener_started:
+                    return
+                subscriber = self.redis_listener
+                self.redis_listener_started = True
+            elif self.pg_listener:
+                if self.pg_listener_started:
+                    return
+                subscriber = self.pg_listener
+                self.pg_listener_started = True
+            else:
+                return
+
+        loop = get_running_loop()
+        if loop is not None:
+            loop.create_task(subscriber.start())
+        else:
+            thread = threading.Thread(
+                target=lambda: asyncio.run(subscriber.start()), daemon=True
+            )
+            thread.start()
 
     def add_listener(self, listener):
         logger.info(f"added listener {id(listener)}")
-        if self.redis_listener:
-            loop = asyncio.get_event_loop()
-            with self.lock:
-                if not self.redis_listener_started:
-                    loop.create_task(self.start_redis_listener())
-                    self.redis_listener_started = True
+        self.ensure_subscriber()
 
         with self.lock:
             for channel in listener.channels:
@@ -94,6 +194,10 @@ class ListenerManager(object):
                     clisteners = set()
                     self.listeners_by_channel[channel] = clisteners
                 clisteners.add(listener)
+            self.listeners.add(listener)
+            self.listener_count += 1
+
+        get_metrics().inc("eventstream_listeners_added_total")
 
     def remove_listener(self, listener):
         with self.lock:
@@ -102,13 +206,26 @@ class ListenerManager(object):
                 clisteners.remove(listener)
                 if len(clisteners) == 0:
                     del self.listeners_by_channel[channel]
+            self.listeners.discard(listener)
+            self.listener_count -= 1
             logger.debug(f"removed listener {id(listener)}")
 
+        get_metrics().inc("eventstream_listeners_removed_total")
+
     def add_to_queues(self, channel, event):
+        overflows = 0
         with self.lock:
             wake = []
             listeners = self.listeners_by_channel.get(channel, set())
             for listener in listeners:
+                if (
+                    listener.event_types is not None
+                    and event.type not in listener.event_types
+                ):
+                    continue
+                if listener.overflow:
+                    # reading from the db anyway
+                    continue
                 items = listener.channel_items.get(channel)
                 if items is None:
                     items = []
@@ -120,8 +237,35 @@ class ListenerManager(object):
                 else:
                     logger.debug(f"could not queue event for listener {id(listener)}")
                     listener.overflow = True
+                    overflows += 1
+            if event.trace and wake:
+                # before waking, so listeners see the time it was queued
+                mark_stage(event.trace, "queue")
+            running_loop = get_running_loop()
             for listener in wake:
-                listener.wake_threadsafe()
+                listener.wake(running_loop)
+
+        metrics = get_metrics()
+        if wake:
+            metrics.inc("eventstream_events_queued_total", len(wake))
+            metrics.inc("eventstream_listener_wakes_total", len(wake))
+        if overflows:
+            metrics.inc("eventstream_listener_overflows_total", overflows)
+
+    # have the listeners of a channel read from the db, for events that
+    #   could not be queued
+    def set_overflow(self, channel):
+        with self.lock:
+            listeners = list(self.listeners_by_channel.get(channel, set()))
+            running_loop = get_running_loop()
+            for listener in listeners:
+                listener.overflow = True
+                listener.wake(running_loop)
+
+        if listeners:
+            metrics = get_metrics()
+            metrics.inc("eventstream_listener_overflows_total", len(listeners))
+            metrics.inc("eventstream_listener_wakes_total", len(listeners))
 
     def kick(self, user_id, channel):
         with self.lock:
@@ -137,8 +281,90 @@ class ListenerManager(object):
                         "extra": {"channels": [channel]},
                     }
                     wake.append(listener)
+            running_loop = get_running_loop()
             for listener in wake:
-                listener.wake_threadsafe()
+                listener.wake(running_loop)
+
+        if wake:
+            metrics = get_metrics()
+            metrics.inc("eventstream_kicks_total", len(wake))
+            metrics.inc("eventstream_listener_wakes_total", len(wake))
+
+    def get_snapshot(self, limit=100):
+        """
+        Describe the current listeners, for finding hot channels and stuck
+        connections. Only references are copied while holding the lock, and
+        listener state is read afterwards, so the figures for a listener may
+        be slightly out of date but the lock is never held for long.
+        """
+
+        with self.lock:
+            counts = [(len(ls), c) for c, ls in self.listeners_by_channel.items()]
+            listeners = list(self.listeners)
+
+        now = time.time()
+
+        counts.sort(key=lambda x: (-x[0], x[1]))
+        channels = [{"channel": c, "listeners": n} for n, c in counts[:limit]]
+
+        connections = []
+        for listener in listeners:
+            channel_items = listener.channel_items
+            last_write = listener.last_write
+            connections.append(
+                {
+                    "id": id(listener),
+                    "user_id": listener.user_id or None,
+                    "channels": sorted(listener.channels),
+                    "pending": sum(
+                        len(items) for items in list(channel_items.values())
+                    ),
+                    "overflow": listener.overflow,
+                    "error": bool(listener.error),
+                    "age": round(now - listener.created, 3),
+                    "idle": (
+                        round(now - last_write, 3) if last_write is not None else None
+                    ),
+                }
+            )
+
+        # most likely to be stuck first
+        connections.sort(key=lambda c: (-c["pending"], -(c["idle"] or c["age"])))
+
+        redis = None
+        if self.redis_listener:
+            last_message = self.redis_listener.last_message
+            redis = {
+                "started": self.redis_listener_started,
+                "subscribed": self.redis_listener.subscribed,
+                "received": self.redis_listener.received,
+                "idle": (
+                    round(now - last_message, 3) if last_message is not None else None
+                ),
+            }
+
+        pg = None
+        if self.pg_listener:
+            last_message = self.pg_listener.last_message
+            pg = {
+                "started": self.pg_listener_started,
+                "listening": self.pg_listener.listening,
+                "received": self.pg_listener.received,
+                "fetched": self.pg_listener.fetched,
+                "idle": (
+                    round(now - last_message, 3) if last_message is not None else None
+                ),
+            }
+
+        return {
+            "pid": os.getpid(),
+            "listeners": len(listeners),
+            "channels": len(counts),
+            "top_channels": channels,
+            "connections": connections[:limit],
+            "redis_listener": redis,
+            "postgres_listener": pg,
+        }
 
 
 listener_manager = ListenerManager()
@@ -148,18 +374,177 @@ def get_listener_manager():
     return listener_manager
 
 
+class CatchupWaiter(object):
+    def __init__(self, loop):
+        self.loop = loop
+        self.future = loop.create_future()
+        self.granted = False
+
+    def grant(self):
+        self.granted = True
+        self.loop.call_soon_threadsafe(self.wake)
+
+    def wake(self):
+        if not self.future.done():
+            self.future.set_result(None)
+
+
+class AdmissionController(object):
+    """
+    Limits how quickly a worker accepts new streams, and how many streams may
+    be catching up from storage at the same time. Streams beyond the catch-up
+    limit wait in a queue. Rejected clients are told to retry after a random
+    delay, so that they don't all come back at the same moment.
+    """
+
+    def __init__(self, config=None):
+        if config is None:
+            config = {}
+        self.enabled = bool(config)
+        self.max_catchup = config.get("max_catchup")
+        self.queue_size = config.get("queue_size", 1000)
+        self.rate = config.get("rate")
+        self.burst = config.get("burst", self.rate)
+        self.retry = config.get("retry", (1000, 10000))
+
+        self.lock = threading.Lock()
+        self.tokens = self.burst
+        self.tokens_updated = time.monotonic()
+        self.catching_up = 0
+        self.waiters = collections.deque()
+        self.admitted = 0
+        self.deferred = 0
+        self.rejected = 0
+
+    def retry_hint(self):
+        return "retry: %d\n\n" % random.randint(*self.retry)
+
+    def busy_body(self):
+        return ": server busy\n" + self.retry_hint()
+
+    # take a token for a new stream, returns False if the rate is exceeded
+    def admit_stream(self):
+        with self.lock:
+            if self.rate:
+                now = time.monotonic()
+                elapsed = now - self.tokens_updated
+                self.tokens = min(self.burst, self.tokens + elapsed * self.rate)
+                self.tokens_updated = now
+                if self.tokens < 1:
+                    self.rejected += 1
+                    return False
+                self.tokens -= 1
+            self.admitted += 1
+            return True
+
+    # wait for a catch-up slot, returns False if the queue is full
+    async def acquire_catchup(self):
+        with self.lock:
+            if self.max_catchup is None or self.catching_up < self.max_catchup:
+                self.catching_up += 1
+                return True
+            if len(self.waiters) >= self.queue_size:
+                self.rejected += 1
+                return False
+            waiter = CatchupWaiter(asyncio.get_event_loop())
+            self.waiters.append(waiter)
+            self.deferred += 1
+
+        try:
+            await waiter.future
+        except asyncio.CancelledError:
+            with self.lock:
+                if waiter.granted:
+                    self.release_catchup_locked()
+                elif waiter in self.waiters:
+                    self.waiters.remove(waiter)
+            raise
+
+        return True
+
+    def release_catchup(self):
+        with self.lock:
+            self.release_catchup_locked()
+
+    def release_catchup_locked(self):
+        # hand the slot over to the next waiter, if any
+        while self.waiters:
+            waiter = self.waiters.popleft()
+            if not waiter.future.cancelled():
+                waiter.grant()
+                return
+        self.catching_up -= 1
+
+    def get_stats(self):
+        with self.lock:
+            return {
+                "catching_up": self.catching_up,
+                "queued": len(self.waiters),
+                "admitted": self.admitted,
+                "deferred": self.deferred,
+                "rejected": self.rejected,
+            }
+
+
+admission_controller = None
+admission_controller_lock = threading.Lock()
+
+
+def get_admission_controller():
+    global admission_controller
+    with admission_controller_lock:
+        if admission_controller is None:
+            admission_controller = AdmissionController(
+                getattr(settings, "EVENTSTREAM_ADMISSION", None)
+            )
+    return admission_controller
+
+
+def get_admission_stats():
+    return get_admission_controller().get_stats()
+
+
 async def stream(event_request, listener):
     from .eventstream import get_events, EventPermissionError
-    from .utils import sse_encode_event, sse_encode_error, make_id
+    from .utils import (
+        sse_encode_event,
+        sse_encode_error,
+        make_id,
+        make_compact_id,
+        use_compact_ids,
+        get_flush_policy,
+    )
 
     get_events = sync_to_async(get_events)
 
+    if use_compact_ids():
+        make_id = functools.partial(make_compact_id, channels=event_request.channels)
+
+    flush_delay, flush_max_bytes = get_flush_policy()
+
+    # ids allocated from a sequence may be queued out of order, or ahead of
+    #   an earlier event whose insert hasn't committed yet
+    contiguous_ids = (
+        getattr(settings, "EVENTSTREAM_ID_ALLOCATION", "lock") == "sequence"
+    )
+
+    metrics = get_metrics()
+
     listener.assign_loop()
 
     lm = get_listener_manager()
     lm.add_listener(listener)
 
+    admission = get_admission_controller()
+    catchup_slot = False
+
     try:
+        if admission.enabled:
+            if not await admission.acquire_catchup():
+                yield admission.busy_body()
+                return
+            catchup_slot = True
+
         first_result = True
 
         while True:
@@ -183,6 +568,8 @@ async def stream(event_request, listener):
                 # include padding on the first result
                 body += ":" + (" " * 2048) + "\n\n"
                 body += "event: stream-open\ndata:\n\n"
+                if admission.enabled:
+                    body += admission.retry_hint()
 
             if len(event_response.channel_reset) > 0:
                 body += sse_encode_event(
@@ -192,12 +579,21 @@ async def stream(event_request, listener):
                     json_encode=True,
                 )
 
+            sent = 0
             for channel, items in event_response.channel_items.items():
                 for item in items:
                     last_ids[channel] = item.id
                     event_id = make_id(last_ids)
                     body += sse_encode_event(item.type, item.data, event_id=event_id)
+                sent += len(items)
 
+            last_ids.update(event_response.channel_read_ids)
+
+            metrics.inc("eventstream_catchup_reads_total")
+            metrics.inc("eventstream_stream_events_total", sent)
+            metrics.inc("eventstream_stream_bytes_total", len(body))
+
+            listener.last_write = time.time()
             yield body
 
             if len(event_response.channel_more) > 0:
@@ -217,10 +613,22 @@ async def stream(event_request, listener):
             lm.lock.release()
 
             if conflict:
+                # resume after what was just sent, not where this read began
+                event_request.channel_last_ids = last_ids
+                continue
+
+            if len(event_response.channel_gaps) > 0:
+                # another publisher is still writing an earlier event
+                event_request.channel_last_ids = last_ids
+                await asyncio.sleep(GAP_RETRY_DELAY)
                 continue
 
             # if we get here then the client is caught up. time to wait
 
+            if catchup_slot:
+                catchup_slot = False
+                admission.release_catchup()
+
             while True:
                 f = asyncio.ensure_future(listener.aevent.wait())
                 while True:
@@ -228,46 +636,99 @@ async def stream(event_request, listener):
                     if f in done:
                         break
                     body = "event: keep-alive\ndata:\n\n"
+                    metrics.inc("eventstream_keepalives_total")
+                    metrics.inc("eventstream_stream_bytes_total", len(body))
                     yield body
 
-                lm.lock.acquire()
-
-                channel_items = listener.channel_items
-                overflow = listener.overflow
-                error_data = listener.error
-
-                listener.aevent.clear()
-                listener.channel_items = {}
-                listener.overflow = False
-
-                lm.lock.release()
-
                 body = ""
-                for channel, items in channel_items.items():
-                    for item in items:
-                        if channel in last_ids:
-                            if item.id is not None:
-                                last_ids[channel] = item.id
+                sent = 0
+                traced = []
+                more = True
+                overflow = False
+                flush_deadline = None
+
+                # drain queued items. with a flush delay configured, keep
+                #   collecting items that arrive within the window so they
+                #   go out as a single chunk
+                while True:
+                    lm.lock.acquire()
+
+                    channel_items = listener.channel_items
+                    overflow = overflow or listener.overflow
+                    error_data = listener.error
+
+                    listener.aevent.clear()
+                    listener.channel_items = {}
+                    listener.overflow = False
+
+                    lm.lock.release()
+
+                    drained_at = time.time()
+
+                    for channel, items in channel_items.items():
+                        for item in items:
+                            if channel in last_ids:
+                                if item.id is not None:
+                                    last_id = int(last_ids[channel])
+                                    if item.id <= last_id:
+                                        # already sent
+                                        continue
+                                    if contiguous_ids and item.id != last_id + 1:
+                                        # toss the rest and check db, as
+                                        #   with an overflow
+                                        overflow = True
+                                        break
+                                    last_ids[channel] = item.id
+                                else:
+                                    del last_ids[channel]
+                            if last_ids:
+                                event_id = make_id(last_ids)
                             else:
-                                del last_ids[channel]
-                        if last_ids:
-                            event_id = make_id(last_ids)
-                        else:
-                            event_id = None
-                        body += sse_encode_event(
-                            item.type, item.data, event_id=event_id
-                        )
+                                event_id = None
+                            if item.trace:
+                                encode_start = time.time()
+                            body += sse_encode_event(
+                                item.type, item.data, event_id=event_id
+                            )
+                            if item.trace:
+                                encoded_at = time.time()
+                                observe_stage("wake", drained_at - item.trace["last"])
+                                observe_stage("encode", encoded_at - encode_start)
+                                traced.append((item.trace, encoded_at))
+                            sent += 1
+
+                    if error_data:
+                        condition = error_data["condition"]
+                        text = error_data["text"]
+                        extra = error_data.get("extra")
+                        body += sse_encode_error(condition, text, extra=extra)
+                        more = False
+                        break
 
-                more = True
+                    if overflow or flush_delay <= 0 or len(body) >= flush_max_bytes:
+                        break
 
-                if error_data:
-                    condition = error_data["condition"]
-                    text = error_data["text"]
-                    extra = error_data.get("extra")
-                    body += sse_encode_error(condition, text, extra=extra)
-                    more = False
+                    loop = asyncio.get_event_loop()
+                    if flush_deadline is None:
+                        flush_deadline = loop.time() + flush_delay
+                    remaining = flush_deadline - loop.time()
+                    if remaining <= 0:
+                        break
+
+                    try:
+                        await asyncio.wait_for(listener.aevent.wait(), remaining)
+                    except asyncio.TimeoutError:
+                        break
 
                 if body or not more:
+                    metrics.inc("eventstream_stream_events_total", sent)
+                    metrics.inc("eventstream_stream_bytes_total", len(body))
+                    if traced:
+                        now = time.time()
+                        for trace, encoded_at in traced:
+                            observe_stage("flush", now - encoded_at)
+                            observe_delivered(trace, now)
+                    listener.last_write = time.time()
                     yield body
 
                 if not more:
@@ -279,15 +740,24 @@ async def stream(event_request, listener):
 
             event_request.channel_last_ids = last_ids
     finally:
+        if catchup_slot:
+            admission.release_catchup()
         listener.aevent.set()
         lm.remove_listener(listener)
 
 
 def events(request, **kwargs):
+    from .authcache import get_authorization_cache
     from .eventrequest import EventRequest
     from .eventstream import EventPermissionError, get_events
     from .utils import sse_error_response
 
+    if get_authorization_cache():
+        # cached permissions must be invalidated by the other processes,
+        #   even in a process without local streams, such as one serving
+        #   only a GRIP proxy
+        get_listener_manager().ensure_subscriber()
+
     try:
         event_request = EventRequest(request, view_kwargs=kwargs)
         response = None
@@ -321,13 +791,62 @@ def events(request, **kwargs):
     # if we got here then the request was not a grip request, and there
     #   were no errors, so we can begin a local stream response
 
+    admission = get_admission_controller()
+    if admission.enabled and not admission.admit_stream():
+        response = HttpResponse(admission.busy_body(), content_type="text/event-stream")
+        add_default_headers(response, request=request)
+        return response
+
     listener = Listener()
-    listener.user_id = event_request.user.pk if event_request.user else "anonymous"
+    listener.user_id = event_request.user_id
     listener.channels = event_request.channels
+    listener.event_types = event_request.event_types
 
-    response = StreamingHttpResponse(
-        stream(event_request, listener), content_type="text/event-stream"
-    )
+    body = stream(event_request, listener)
+
+    encoding = negotiate_stream_encoding(request)
+    if encoding:
+        body = compress_stream(body, encoding)
+
+    response = StreamingHttpResponse(body, content_type="text/event-stream")
+    if encoding:
+        response["Content-Encoding"] = encoding
+        patch_vary_headers(response, ("Accept-Encoding",))
     add_default_headers(response, request=request)
 
     return response
+
+
+def is_debug_allowed(request):
+    token = getattr(settings, "EVENTSTREAM_DEBUG_TOKEN", None)
+    if token:
+        auth = request.headers.get("Authorization", "")
+        if auth.startswith("Bearer ") and hmac.compare_digest(
+            auth[7:].encode("utf-8"), token.encode("utf-8")
+        ):
+            return True
+
+    user = getattr(request, "user", None)
+    return bool(user and user.is_active and user.is_staff)
+
+
+def debug(request):
+    if not is_debug_allowed(request):
+        return HttpResponseForbidden("Forbidden\n", content_type="text/plain")
+
+    try:
+        limit = int(request.GET.get("limit", 100))
+    except ValueError:
+        return HttpResponseBadRequest("Invalid limit\n", content_type="text/plain")
+
+    return JsonResponse(get_listener_manager().get_snapshot(limit=limit))
+
+
+def metrics(request):
+    m = get_metrics()
+    if not m.enabled:
+        return HttpResponse("Not Found\n", status=404, content_type="text/plain")
+
+    return HttpResponse(
+        m.render(), content_type="text/plain; version=0.0.4; charset=utf-8"
+    )
@@ -26,7 +26,7 @@ class EventsViewSet(ViewSet):
     Those three ways are mutually exclusive, so you can only use one of them.
 
     If you want to see a specific type of messages and not the default "message" type, you can set the messages_types attribute in the class definition or by using the configure_events_view_set method.
-    That's the only ways provided to set the messages types.
+    That's the only ways provided to set the messages types. When set, events of other types are filtered out on the server.
     """
 
     http_method_names = ["get"]
@@ -155,6 +155,8 @@ class EventsViewSet(ViewSet):
             return Response(data, status=status.HTTP_200_OK)
         elif self._accepted_format(request, ["text/event-stream", "*/*"]):
             kwargs = {"channels": channels}
+            if self.messages_types:
+                kwargs["event_types"] = self.messages_types
             return events(request, **kwargs)
 
         return Response(
@@ -0,0 +1,29 @@
+import json
+from io import StringIO
+
+from django.core.management import call_command
+from django.test import TestCase, override_settings
+
+
+class LoadTestCommandTest(TestCase):
+    @override_settings(ROOT_URLCONF="django_eventstream.urls")
+    def test_loadtest(self):
+        out = StringIO()
+        call_command(
+            "eventstream_loadtest",
+            path="/",
+            clients=4,
+            channels=2,
+            rate=20,
+            duration=1,
+            reconnect=0.5,
+            reconnect_delay=0.2,
+            stdout=out,
+        )
+        result = json.loads(out.getvalue())
+
+        self.assertEqual(result["clients"], 4)
+        self.assertEqual(result["events_sent"], 20)
+        self.assertGreater(result["deliveries"], 0)
+        self.assertEqual(result["reconnected"], 2)
+        self.assertIsNotNone(result["latency_ms"]["p50"])
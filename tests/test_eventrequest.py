@@ -0,0 +1,79 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import time
+
+import jwt
+from django.conf import settings
+from django.test import RequestFactory, TestCase
+from django_eventstream.event import Event
+from django_eventstream.eventrequest import EventRequest
+from django_eventstream.eventresponse import EventResponse
+from django_grip import GripData
+from unittest.mock import patch
+
+
+class EventRequestTest(TestCase):
+    def make_es_meta(self, user):
+        es_meta = {
+            "iss": "es",
+            "exp": int(time.time()) + 3600,
+            "channels": ["a"],
+            "user": user,
+        }
+        return jwt.encode(es_meta, settings.SECRET_KEY.encode("utf-8"))
+
+    def test_next_link_user_not_loaded(self):
+        token = self.make_es_meta("5")
+        request = RequestFactory().get("/", {"link": "next", "es-meta": token})
+
+        with self.assertNumQueries(0):
+            event_request = EventRequest(request)
+
+        self.assertEqual(event_request.user_id, "5")
+        self.assertEqual(event_request.channels, ["a"])
+
+    def test_es_meta_decoded_once(self):
+        token = self.make_es_meta("anonymous")
+        request = RequestFactory().get("/", {"link": "next", "es-meta": token})
+
+        with patch("jwt.decode", wraps=jwt.decode) as decode:
+            EventRequest(request)
+            EventRequest(request)
+
+        self.assertEqual(decode.call_count, 1)
+
+    def test_legacy_id_with_compact_prefix(self):
+        # a channel name starting with the compact id prefix
+        request = RequestFactory().get(
+            "/", {"channel": "~user"}, HTTP_LAST_EVENT_ID="~user:5"
+        )
+        event_request = EventRequest(request)
+        self.assertEqual(event_request.channel_last_ids, {"~user": "5"})
+
+    def test_grip_response_token_reused(self):
+        def make_response():
+            event_response = EventResponse()
+            event_response.channel_items = {"a": [Event("a", "message", "x", id=2)]}
+            event_response.channel_last_ids = {"a": 1}
+            event_response.user_id = "7"
+
+            request = RequestFactory().get("/", {"channel": "a"})
+            request.grip = GripData()
+            event_response.to_grip_response(request)
+            return request
+
+        with patch("jwt.encode", wraps=jwt.encode) as encode:
+            first = make_response()
+            second = make_response()
+
+        self.assertEqual(encode.call_count, 1)
+        self.assertEqual(first.grip.instruct.next_link, second.grip.instruct.next_link)
+        self.assertEqual(first.grip.instruct.meta["id_format"], "a:%(events-a)s")
+
+        # the token is accepted on renewal
+        next_request = RequestFactory().get(first.grip.instruct.next_link)
+        next_request.grip = GripData()
+        event_request = EventRequest(next_request)
+        self.assertEqual(event_request.user_id, "7")
+        self.assertEqual(event_request.channels, ["a"])
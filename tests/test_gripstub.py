@@ -0,0 +1,63 @@
+from unittest.mock import patch
+
+from django.test import TestCase
+from django_eventstream import send_event
+from django_eventstream.gripstub import GripStub, build_id
+from django_eventstream.storage import DjangoModelStorage
+
+
+class GripStubTest(TestCase):
+    def setUp(self):
+        self.storage = DjangoModelStorage()
+        p = patch(
+            "django_eventstream.eventstream.get_storage", return_value=self.storage
+        )
+        p.start()
+        self.addCleanup(p.stop)
+
+        self.stub = GripStub()
+        installed = self.stub.installed()
+        installed.__enter__()
+        self.addCleanup(installed.__exit__, None, None, None)
+
+    def test_build_id(self):
+        self.assertEqual(
+            build_id(
+                "id: %I\ndata: 100%%\n",
+                "a:%(events-a)s,b:%(events-b)s",
+                {"events-a": "3", "events-b": "1"},
+            ),
+            "id: a:3,b:1\ndata: 100%\n",
+        )
+
+    def test_stream_and_publish(self):
+        send_event("a", "message", "before")
+        stream = self.stub.open("/events/?channel=a&lastEventId=a:0")
+
+        self.assertTrue(stream.held)
+        self.assertIn('data: "before"', stream.body)
+
+        send_event("a", "message", "after")
+        self.assertTrue(
+            stream.body.endswith('event: message\nid: a:2\ndata: "after"\n\n')
+        )
+
+    def test_skip_users(self):
+        stream = self.stub.open("/events/?channel=a")
+        send_event("a", "message", "hidden", skip_user_ids=["anonymous"])
+        send_event("a", "message", "shown")
+
+        self.assertNotIn("hidden", stream.body)
+        self.assertIn("shown", stream.body)
+
+    def test_recover(self):
+        stream = self.stub.open("/events/?channel=a")
+
+        # an event the proxy never saw
+        self.storage.append_event("a", "message", '"missed"')
+        send_event("a", "message", "after")
+
+        self.assertEqual(self.stub.recovered, 1)
+        self.assertEqual(stream.requests, 2)
+        self.assertIn("missed", stream.body)
+        self.assertIn("after", stream.body)
@@ -0,0 +1,124 @@
+import json
+from unittest.mock import patch
+
+from django.test import RequestFactory, TestCase, override_settings
+from django_eventstream import send_event
+from django_eventstream.metrics import Metrics, MetricsRegistry, MetricsSinkBase
+from django_eventstream.storage import DjangoModelStorage
+from django_eventstream.event import Event
+from django_eventstream.views import Listener, debug, get_listener_manager, metrics
+
+
+class RecordingSink(MetricsSinkBase):
+    def __init__(self):
+        self.calls = []
+
+    def inc(self, name, value=1, labels=None):
+        self.calls.append((name, value, labels))
+
+    def observe(self, name, value, labels=None):
+        self.calls.append((name, value, labels))
+
+
+class MetricsTest(TestCase):
+    def test_render(self):
+        registry = MetricsRegistry(buckets=(0.1, 1.0))
+        registry.inc("requests_total", 2, {"path": 'a"b'})
+        registry.observe("latency_seconds", 0.05)
+        registry.observe("latency_seconds", 5)
+
+        text = registry.render([("open_streams", "gauge", None, 3)])
+        self.assertIn("# TYPE requests_total counter\n", text)
+        self.assertIn('requests_total{path="a\\"b"} 2\n', text)
+        self.assertIn('latency_seconds_bucket{le="0.1"} 1\n', text)
+        self.assertIn('latency_seconds_bucket{le="1.0"} 1\n', text)
+        self.assertIn('latency_seconds_bucket{le="+Inf"} 2\n', text)
+        self.assertIn("latency_seconds_count 2\n", text)
+        self.assertIn("# TYPE open_streams gauge\nopen_streams 3\n", text)
+
+    def test_pipeline_metrics(self):
+        sink = RecordingSink()
+        m = Metrics(enabled=True, sinks=[sink])
+        storage = DjangoModelStorage()
+
+        listener = Listener()
+        listener.channels = {"a"}
+        listener.wake_threadsafe = lambda: None
+        lm = get_listener_manager()
+
+        with (
+            patch("django_eventstream.metrics.metrics", m),
+            patch("django_eventstream.eventstream.get_storage", return_value=storage),
+        ):
+            lm.add_listener(listener)
+            try:
+                send_event("a", "message", "hello")
+                response = metrics(RequestFactory().get("/metrics/"))
+            finally:
+                lm.remove_listener(listener)
+
+        text = response.content.decode("utf-8")
+        self.assertEqual(response.status_code, 200)
+        self.assertIn("eventstream_events_sent_total 1\n", text)
+        self.assertIn("eventstream_events_queued_total 1\n", text)
+        self.assertIn("eventstream_listeners 1\n", text)
+        self.assertIn('eventstream_channel_listeners{channel="a"} 1\n', text)
+        self.assertIn(
+            'eventstream_storage_seconds_count{backend="DjangoModelStorage",op="append_event"} 1\n',
+            text,
+        )
+        self.assertIn(("eventstream_events_sent_total", 1, {}), sink.calls)
+
+    @override_settings(
+        EVENTSTREAM_METRICS=True,
+        EVENTSTREAM_METRICS_SINKS=["%s.RecordingSink" % __name__],
+    )
+    def test_sinks_from_settings(self):
+        from django_eventstream.metrics import get_metrics
+
+        with patch("django_eventstream.metrics.metrics", None):
+            m = get_metrics()
+            m.inc("requests_total")
+
+        # after the registry
+        sink = m.sinks[-1]
+        self.assertIsInstance(sink, RecordingSink)
+        self.assertEqual(sink.calls, [("requests_total", 1, {})])
+
+    def test_disabled(self):
+        with patch("django_eventstream.metrics.metrics", Metrics(enabled=False)):
+            response = metrics(RequestFactory().get("/metrics/"))
+        self.assertEqual(response.status_code, 404)
+
+
+class DebugViewTest(TestCase):
+    @override_settings(EVENTSTREAM_DEBUG_TOKEN="secret")
+    def test_debug(self):
+        listener = Listener()
+        listener.channels = {"hot"}
+        listener.user_id = "alice"
+        listener.wake_threadsafe = lambda: None
+        lm = get_listener_manager()
+
+        lm.add_listener(listener)
+        try:
+            lm.add_to_queues("hot", Event("hot", "message", "x"))
+            response = debug(
+                RequestFactory().get("/debug/", HTTP_AUTHORIZATION="Bearer secret")
+            )
+            denied = debug(
+                RequestFactory().get("/debug/", HTTP_AUTHORIZATION="Bearer wrong")
+            )
+        finally:
+            lm.remove_listener(listener)
+
+        self.assertEqual(denied.status_code, 403)
+        self.assertEqual(response.status_code, 200)
+        snapshot = json.loads(response.content)
+        self.assertEqual(snapshot["listeners"], 1)
+        self.assertEqual(snapshot["top_channels"], [{"channel": "hot", "listeners": 1}])
+        conn = snapshot["connections"][0]
+        self.assertEqual(conn["user_id"], "alice")
+        self.assertEqual(conn["pending"], 1)
+        self.assertIsNone(conn["idle"])
+        self.assertIsNone(snapshot["redis_listener"])
@@ -0,0 +1,262 @@
+import asyncio
+import json
+import os
+import unittest
+from unittest import IsolatedAsyncioTestCase
+from unittest.mock import Mock, patch
+
+from asgiref.sync import sync_to_async
+from django.db import connection
+from django.test import TestCase
+from django_eventstream import send_event
+from django_eventstream.pgnotify import MAX_PAYLOAD, make_payload
+from django_eventstream.storage import DjangoModelStorage
+from django_eventstream.views import Listener, get_listener_manager
+
+try:
+    import psycopg
+except ImportError:
+    psycopg = None
+
+# a libpq connection string, such as "dbname=test", to run the tests that
+#   need a server
+POSTGRES = os.environ.get("EVENTSTREAM_TEST_POSTGRES")
+
+
+class RecordingNotifier(object):
+    def __init__(self):
+        self.messages = []
+
+    def notify(self, message):
+        self.messages.append((message, connection.in_atomic_block))
+
+
+class PostgresNotifyTest(TestCase):
+    def test_make_payload(self):
+        message = {"channel": "a", "event_type": "message", "data": "x", "pub_id": "3"}
+        self.assertEqual(json.loads(make_payload(message)), message)
+
+        message["data"] = "x" * MAX_PAYLOAD
+        self.assertEqual(
+            json.loads(make_payload(message)),
+            {"channel": "a", "pub_id": "3", "fetch": True},
+        )
+
+        message["pub_id"] = None
+        with self.assertRaises(ValueError):
+            make_payload(message)
+
+    def test_notify_in_insert_transaction(self):
+        notifier = RecordingNotifier()
+        storage = DjangoModelStorage()
+
+        listener = Listener()
+        listener.channels = {"notified"}
+        listener.wake_threadsafe = lambda: None
+        lm = get_listener_manager()
+
+        with (
+            patch(
+                "django_eventstream.eventstream.get_postgres_notifier",
+                return_value=notifier,
+            ),
+            patch("django_eventstream.eventstream.get_storage", return_value=storage),
+        ):
+            lm.add_listener(listener)
+            try:
+                send_event("notified", "message", {"a": 1})
+            finally:
+                lm.remove_listener(listener)
+
+        message, in_transaction = notifier.messages[0]
+        self.assertTrue(in_transaction)
+        self.assertEqual(message["pub_id"], "1")
+        self.assertEqual(message["data"], '{"a": 1}')
+
+        # delivered to local listeners by the notification, not directly
+        self.assertEqual(listener.channel_items, {})
+
+    def test_revoke_with_notifier(self):
+        from django_eventstream import authcache, eventstream
+
+        cache = authcache.LocalAuthorizationCache()
+        cache.set("anonymous", "a", True)
+        notifier = RecordingNotifier()
+        channelmanager = Mock()
+        channelmanager.can_read_channel.return_value = False
+
+        # no listener in this process receives the notification
+        with (
+            patch(
+                "django_eventstream.eventstream.get_postgres_notifier",
+                return_value=notifier,
+            ),
+            patch(
+                "django_eventstream.eventstream.get_authorization_cache",
+                return_value=cache,
+            ),
+            patch(
+                "django_eventstream.eventstream.get_channelmanager",
+                return_value=channelmanager,
+            ),
+            patch("django_eventstream.eventstream.publish_kick"),
+        ):
+            eventstream.channel_permission_changed(None, "a")
+
+        self.assertIsNone(cache.get("anonymous", "a"))
+        message, _ = notifier.messages[0]
+        self.assertEqual(message["type"], "permission-changed")
+        self.assertTrue(message["kick"])
+
+
+@unittest.skipUnless(psycopg, "psycopg package is not installed")
+class PostgresListenerTest(IsolatedAsyncioTestCase):
+    def make_listener(self, **config):
+        from django_eventstream.pgnotify import PostgresListener
+
+        return PostgresListener(config)
+
+    async def test_fetched_events_keep_order(self):
+        storage = DjangoModelStorage()
+        e = await sync_to_async(storage.append_event)("fetched", "message", "big")
+
+        pg_listener = self.make_listener()
+        received = []
+        with patch(
+            "django_eventstream.pgnotify.PostgresListener.dispatch",
+            lambda self, message: received.append(message["data"]),
+        ):
+            pg_listener.handle(
+                {"channel": "fetched", "pub_id": str(e.id), "fetch": True}
+            )
+            pg_listener.handle(
+                {
+                    "channel": "fetched",
+                    "event_type": "message",
+                    "data": "small",
+                    "pub_id": None,
+                }
+            )
+            while pg_listener.pending is not None:
+                await asyncio.sleep(0.01)
+
+        self.assertEqual(received, ["big", "small"])
+        self.assertEqual(pg_listener.fetched, 1)
+
+    async def test_stream_sends_notified_events(self):
+        from django_eventstream.eventrequest import EventRequest
+        from django_eventstream.eventstream import make_message
+        from django_eventstream.views import stream
+
+        storage = DjangoModelStorage()
+        await sync_to_async(storage.append_event)("pgstream", "message", "0")
+
+        request = EventRequest()
+        request.is_next = False
+        request.is_recover = False
+        request.channels = ["pgstream"]
+        request.channel_last_ids = {"pgstream": 1}
+        listener = Listener()
+        listener.channels = {"pgstream"}
+
+        pg_listener = self.make_listener()
+        with patch("django_eventstream.eventstream.get_storage", return_value=storage):
+            response = stream(request, listener)
+            try:
+                # padding and stream-open
+                await response.__anext__()
+
+                # wait until the stream is waiting for queued items
+                chunk = asyncio.ensure_future(response.__anext__())
+                await asyncio.sleep(0.1)
+
+                big = await sync_to_async(storage.append_event)(
+                    "pgstream", "message", "big"
+                )
+                small = await sync_to_async(storage.append_event)(
+                    "pgstream", "message", "small"
+                )
+                pg_listener.handle(
+                    {"channel": "pgstream", "pub_id": str(big.id), "fetch": True}
+                )
+                pg_listener.handle(make_message(small))
+
+                body = await asyncio.wait_for(chunk, 5)
+            finally:
+                await response.aclose()
+
+        self.assertEqual(
+            body,
+            "event: message\nid: pgstream:2\ndata: big\n\n"
+            "event: message\nid: pgstream:3\ndata: small\n\n",
+        )
+
+    async def test_unfetched_events_overflow(self):
+        listener = Listener()
+        listener.channels = {"unfetched"}
+        listener.assign_loop()
+        lm = get_listener_manager()
+        lm.add_listener(listener)
+
+        def fail(self, messages):
+            raise RuntimeError("connection lost")
+
+        pg_listener = self.make_listener()
+        try:
+            with patch("django_eventstream.pgnotify.PostgresListener.fetch", fail):
+                pg_listener.handle(
+                    {"channel": "unfetched", "pub_id": "1", "fetch": True}
+                )
+                pg_listener.handle(
+                    {
+                        "channel": "unfetched",
+                        "event_type": "message",
+                        "data": "small",
+                        "pub_id": "2",
+                    }
+                )
+                while pg_listener.pending is not None:
+                    await asyncio.sleep(0.01)
+        finally:
+            lm.remove_listener(listener)
+
+        # read from the db instead, rather than skipping the first event
+        self.assertTrue(listener.overflow)
+        self.assertTrue(listener.aevent.is_set())
+        self.assertEqual(listener.channel_items, {})
+
+    @unittest.skipUnless(POSTGRES, "EVENTSTREAM_TEST_POSTGRES is not set")
+    async def test_listen(self):
+        pg_listener = self.make_listener(conninfo=POSTGRES, channel="eventstream_test")
+
+        listener = Listener()
+        listener.channels = {"pg"}
+        listener.assign_loop()
+        lm = get_listener_manager()
+        lm.add_listener(listener)
+
+        task = asyncio.ensure_future(pg_listener.start())
+        try:
+            while not pg_listener.listening:
+                await asyncio.sleep(0.01)
+
+            message = {
+                "channel": "pg",
+                "event_type": "message",
+                "data": "x",
+                "pub_id": None,
+            }
+            conn = await psycopg.AsyncConnection.connect(POSTGRES, autocommit=True)
+            async with conn:
+                await conn.execute(
+                    "SELECT pg_notify(%s, %s)",
+                    ["eventstream_test", json.dumps(message)],
+                )
+
+            await asyncio.wait_for(listener.aevent.wait(), 5)
+        finally:
+            task.cancel()
+            lm.remove_listener(listener)
+
+        self.assertEqual([e.data for e in listener.channel_items["pg"]], ["x"])
+        self.assertEqual(pg_listener.received, 1)
@@ -0,0 +1,94 @@
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from django.test import TestCase
+from gripcontrol import GripPubControl, HttpStreamFormat
+from django_eventstream.publisher import GripPublisher
+
+
+class StubPublishHandler(BaseHTTPRequestHandler):
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers["Content-Length"]))
+        server = self.server
+        with server.lock:
+            server.requests.append(json.loads(body))
+            fail = server.failures > 0
+            if fail:
+                server.failures -= 1
+        self.send_response(503 if fail else 200)
+        self.end_headers()
+        self.wfile.write(b"Unavailable\n" if fail else b"Published\n")
+
+    def log_message(self, format, *args):
+        pass
+
+
+class GripPublisherTest(TestCase):
+    def setUp(self):
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), StubPublishHandler)
+        self.server.lock = threading.Lock()
+        self.server.requests = []
+        self.server.failures = 0
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+        uri = "http://127.0.0.1:%d" % self.server.server_address[1]
+        self.pubcontrol = GripPubControl({"control_uri": uri})
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def make_publisher(self, **config):
+        config.setdefault("batch_delay", 50)
+        return GripPublisher(config, pubcontrol=self.pubcontrol)
+
+    def test_batches_across_channels(self):
+        publisher = self.make_publisher()
+        publisher.publish("events-a", HttpStreamFormat("one"), id="1")
+        publisher.publish("events-b", HttpStreamFormat("two"), id="1")
+        publisher.publish("events-a", HttpStreamFormat("three"), id="2", prev_id="1")
+        publisher.publish("events-b", HttpStreamFormat("four"), blocking=True)
+
+        self.assertEqual(len(self.server.requests), 1)
+        items = self.server.requests[0]["items"]
+        self.assertEqual(
+            [(i["channel"], i["http-stream"]["content"]) for i in items],
+            [
+                ("events-a", "one"),
+                ("events-b", "two"),
+                ("events-a", "three"),
+                ("events-b", "four"),
+            ],
+        )
+        self.assertEqual(items[2]["prev-id"], "1")
+
+        stats = publisher.get_stats()
+        self.assertEqual(stats["sent"], 4)
+        self.assertEqual(stats["batches"], 1)
+
+    def test_retry(self):
+        # the client's session retries 503 once by itself
+        self.server.failures = 3
+        publisher = self.make_publisher(retries=2, retry_backoff=1)
+        publisher.publish("events-a", HttpStreamFormat("one"), blocking=True)
+
+        self.assertEqual(self.server.requests[-1]["items"][0]["channel"], "events-a")
+        self.assertEqual(publisher.get_stats()["retried"], 1)
+
+        self.server.failures = 100
+        publisher = self.make_publisher(retries=1, retry_backoff=1)
+        with self.assertRaises(ValueError):
+            publisher.publish("events-a", HttpStreamFormat("one"), blocking=True)
+        self.assertEqual(publisher.get_stats()["failed"], 1)
+
+    def test_bounded_queue(self):
+        publisher = self.make_publisher(queue_size=2)
+
+        # no worker, so nothing leaves the queue
+        publisher.ensure_thread = lambda: None
+        publisher.publish("events-a", HttpStreamFormat("one"))
+        publisher.publish("events-a", HttpStreamFormat("two"))
+        publisher.publish("events-a", HttpStreamFormat("three"))
+        self.assertEqual(publisher.dropped, 1)
+        self.assertEqual(len(publisher.queue), 2)
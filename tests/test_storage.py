@@ -1,8 +1,40 @@
 # -*- coding: utf-8 -*-
 from __future__ import unicode_literals
 
-from django.test import TestCase
-from django_eventstream.storage import DjangoModelStorage, EventDoesNotExist
+import datetime
+import os
+import shutil
+import tempfile
+import threading
+import time
+from types import SimpleNamespace
+
+import unittest
+from unittest import IsolatedAsyncioTestCase
+from unittest.mock import patch
+
+from asgiref.sync import sync_to_async
+
+from django.db import connection
+from django.test import TestCase, override_settings
+from django.utils import timezone
+from benchmarks.fakeredis import FakeRedisServer
+from django_eventstream import partitions, utils
+from django_eventstream.storage import (
+    DjangoModelStorage,
+    EventDoesNotExist,
+    PartialEvents,
+    PartitionedModelStorage,
+    ReadCoalescer,
+    RedisStorage,
+    SegmentFileStorage,
+    StorageBase,
+)
+
+try:
+    import redis
+except ImportError:
+    redis = None
 
 
 class DjangoStorageTest(TestCase):
@@ -41,3 +73,448 @@ class DjangoStorageTest(TestCase):
             self.storage.get_events(channel, 2)
 
         self.assertEqual(cm.exception.current_id, 1)
+
+    def test_get_current_ids(self):
+        self.storage.append_event("channel1", "message", "x")
+        self.storage.append_event("channel1", "message", "x")
+
+        self.assertEqual(
+            self.storage.get_current_ids(["channel1", "empty"]),
+            {"channel1": 2, "empty": 0},
+        )
+
+    @override_settings(EVENTSTREAM_ID_ALLOCATION="sequence")
+    def test_sequence_allocation(self):
+        for i in range(3):
+            e = self.storage.append_event("sequenced", "message", i)
+            self.assertEqual(e.id, i + 1)
+
+        self.assertEqual(self.storage.get_current_id("sequenced"), 3)
+        events = self.storage.get_events("sequenced", 0)
+        self.assertEqual([e.data for e in events], [0, 1, 2])
+
+    def test_get_events_stops_at_gap(self):
+        from django_eventstream import models
+
+        channel = "gapped"
+        self.storage.append_event(channel, "message", 1)
+
+        # ids 2 and 3 handed out, but only 3 inserted so far
+        models.EventCounter.objects.filter(name=channel).update(value=3)
+        models.Event(channel=channel, type="message", data="3", eid=3).save()
+
+        events = self.storage.get_events(channel, 0)
+        self.assertIsInstance(events, PartialEvents)
+        self.assertEqual([e.id for e in events], [1])
+
+        models.Event(channel=channel, type="message", data="2", eid=2).save()
+        events = self.storage.get_events(channel, 0)
+        self.assertNotIsInstance(events, PartialEvents)
+        self.assertEqual([e.id for e in events], [1, 2, 3])
+
+    def test_get_events_skips_expired_gap(self):
+        from django_eventstream import models
+
+        channel = "gapped"
+        self.storage.append_event(channel, "message", 1)
+        models.EventCounter.objects.filter(name=channel).update(value=3)
+        models.Event(channel=channel, type="message", data="3", eid=3).save()
+
+        with override_settings(EVENTSTREAM_ID_GAP_TIMEOUT=0):
+            events = self.storage.get_events(channel, 0)
+        self.assertNotIsInstance(events, PartialEvents)
+        self.assertEqual([e.id for e in events], [1, 3])
+
+        # a missing last id
+        models.EventCounter.objects.filter(name=channel).update(value=4)
+        self.assertIsInstance(self.storage.get_events(channel, 3), PartialEvents)
+
+
+class PartitionedStorageTest(TestCase):
+    @classmethod
+    def setUpClass(cls):
+        from django_eventstream.models import PartitionedEvent
+
+        # not partitioned here, but enough to exercise the storage
+        with connection.schema_editor() as editor:
+            editor.create_model(PartitionedEvent)
+        super().setUpClass()
+        cls.storage = PartitionedModelStorage()
+
+    @classmethod
+    def tearDownClass(cls):
+        from django_eventstream.models import PartitionedEvent
+
+        super().tearDownClass()
+        with connection.schema_editor() as editor:
+            editor.delete_model(PartitionedEvent)
+
+    def test_append(self):
+        from django_eventstream import models
+
+        for i in range(3):
+            self.storage.append_event("partitioned", "message", i)
+
+        events = self.storage.get_events("partitioned", 1)
+        self.assertEqual([e.data for e in events], [1, 2])
+        self.assertEqual(models.Event.objects.filter(channel="partitioned").count(), 0)
+
+        # expired events are left for the partition drop
+        old = timezone.now() - datetime.timedelta(days=30)
+        models.PartitionedEvent.objects.update(created=old)
+        self.storage.append_event("partitioned", "message", 3)
+        self.assertEqual(
+            [e.data for e in self.storage.get_events("partitioned", 2)], [2, 3]
+        )
+
+    def test_plan_partitions(self):
+        day = 60 * 60 * 24
+        now = datetime.datetime(2024, 5, 2, 13, 30, tzinfo=datetime.timezone.utc)
+
+        wanted = partitions.get_wanted_partitions("events", now, day, 2)
+        self.assertEqual(
+            [(name, start.day, end.day) for name, start, end in wanted],
+            [
+                ("events_p202405020000", 2, 3),
+                ("events_p202405030000", 3, 4),
+                ("events_p202405040000", 4, 5),
+            ],
+        )
+
+        existing = [
+            ("events_p202404200000",)
+            + partitions.parse_bound(
+                "FOR VALUES FROM ('2024-04-20 00:00:00+00') TO ('2024-04-21 00:00:00+00')"
+            ),
+            wanted[0],
+            # made with a longer interval, overlapping the last one
+            ("events_p202405041200",)
+            + partitions.parse_bound(
+                "FOR VALUES FROM ('2024-05-04 12:00:00+00') TO ('2024-05-10 00:00:00+00')"
+            ),
+        ]
+        create, drop = partitions.plan_partitions(
+            existing, wanted, now - datetime.timedelta(days=1)
+        )
+        self.assertEqual([p[0] for p in create], ["events_p202405030000"])
+        self.assertEqual([p[0] for p in drop], ["events_p202404200000"])
+
+
+@override_settings(EVENTSTREAM_STORAGE_READ_DATABASE="replica")
+class ReplicaReadTest(TestCase):
+    databases = {"default", "replica"}
+
+    def setUp(self):
+        self.storage = DjangoModelStorage()
+        for i in range(4):
+            self.storage.append_event("replicated", "message", i)
+
+    # copy the channel's events up to an id to the replica, with a type
+    #   telling them apart
+    def replicate(self, upto, missing=()):
+        from django_eventstream import models
+
+        # bypassing save, which would allocate ids
+        models.Event.objects.using("replica").bulk_create(
+            [
+                models.Event(channel=e.channel, type="replica", data=e.data, eid=e.eid)
+                for e in models.Event.objects.filter(
+                    channel="replicated", eid__lte=upto
+                )
+                if e.eid not in missing
+            ]
+        )
+        models.EventCounter.objects.using("replica").create(
+            name="replicated", value=upto
+        )
+
+    def test_caught_up(self):
+        self.replicate(4)
+        events = self.storage.get_events("replicated", 0)
+        self.assertEqual([e.id for e in events], [1, 2, 3, 4])
+        self.assertEqual({e.type for e in events}, {"replica"})
+
+    def test_behind_primary(self):
+        self.replicate(2)
+        events = self.storage.get_events("replicated", 0)
+        self.assertEqual([e.id for e in events], [1, 2, 3, 4])
+        self.assertEqual(
+            [e.type for e in events], ["replica", "replica", "message", "message"]
+        )
+
+        events = self.storage.get_events("replicated", 0, limit=2)
+        self.assertEqual([e.type for e in events], ["replica", "replica"])
+
+    def test_behind_cursor(self):
+        events = self.storage.get_events("replicated", 2)
+        self.assertEqual(
+            [(e.id, e.type) for e in events], [(3, "message"), (4, "message")]
+        )
+
+        self.replicate(2)
+        events = self.storage.get_events("replicated", 3)
+        self.assertEqual([(e.id, e.type) for e in events], [(4, "message")])
+
+    @override_settings(EVENTSTREAM_ID_GAP_TIMEOUT=0)
+    def test_gap_on_replica(self):
+        # the replica would skip 3 as timed out, but it isn't on the replica
+        #   yet
+        self.replicate(4, missing=(3,))
+        events = self.storage.get_events("replicated", 0)
+        self.assertEqual([e.id for e in events], [1, 2, 3, 4])
+        self.assertEqual(
+            [e.type for e in events], ["replica", "replica", "message", "message"]
+        )
+
+    def test_subclass_without_init(self):
+        class Storage(DjangoModelStorage):
+            def __init__(self):
+                pass
+
+        self.replicate(4)
+        events = Storage().get_events("replicated", 0)
+        self.assertEqual({e.type for e in events}, {"message"})
+
+
+class SegmentFileStorageTest(TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.path)
+
+    def make_storage(self, **config):
+        config["path"] = self.path
+        with override_settings(EVENTSTREAM_SEGMENT_STORAGE=config):
+            storage = SegmentFileStorage()
+        self.addCleanup(storage.close)
+        return storage
+
+    def test_append(self):
+        storage = self.make_storage()
+        channel = "a/../b"
+
+        self.assertEqual(storage.get_current_id(channel), 0)
+        self.assertEqual(storage.get_events(channel, 0), [])
+
+        e = storage.append_event(channel, "message", {"a": "b"})
+        self.assertEqual(e.id, 1)
+        storage.append_event(channel, "other", "x")
+
+        self.assertEqual(storage.get_current_id(channel), 2)
+        events = storage.get_events(channel, 0)
+        self.assertEqual(
+            [(e.type, e.data, e.id) for e in events],
+            [("message", {"a": "b"}, 1), ("other", "x", 2)],
+        )
+        self.assertEqual(storage.get_events(channel, 2), [])
+
+        with self.assertRaises(EventDoesNotExist) as cm:
+            storage.get_events(channel, 3)
+        self.assertEqual(cm.exception.current_id, 2)
+
+        # another instance, as in another process, sees the same events
+        self.assertEqual(len(self.make_storage().get_events(channel, 0)), 2)
+
+    def test_rotation_and_retention(self):
+        storage = self.make_storage(segment_size=100, retention_size=400)
+        for i in range(30):
+            storage.append_event("rotated", "message", "event %d" % i)
+
+        events = storage.get_events("rotated", 25, limit=10)
+        self.assertEqual(
+            [e.data for e in events], ["event %d" % i for i in range(25, 30)]
+        )
+
+        with self.assertRaises(EventDoesNotExist):
+            storage.get_events("rotated", 0)
+
+        segments = [
+            n for n in os.listdir(storage.get_log("rotated").path) if n.endswith(".idx")
+        ]
+        self.assertLess(len(segments), 10)
+
+    def test_repair(self):
+        storage = self.make_storage()
+        for i in range(3):
+            storage.append_event("repaired", "message", i)
+
+        # a record without an index entry, and a partial index entry
+        segment = storage.get_log("repaired").segments[-1]
+        with open(segment.log_path, "ab") as f:
+            f.write(b"garbage")
+        with open(segment.index_path, "ab") as f:
+            f.write(b"\x01\x02")
+
+        storage = self.make_storage()
+        self.assertEqual(storage.append_event("repaired", "message", 3).id, 4)
+        events = storage.get_events("repaired", 0)
+        self.assertEqual([e.data for e in events], [0, 1, 2, 3])
+
+    def test_concurrent_appends(self):
+        storage = self.make_storage(segment_size=1000, fsync_delay=1)
+        ids = []
+
+        def append():
+            for i in range(20):
+                ids.append(storage.append_event("concurrent", "message", i).id)
+
+        threads = [threading.Thread(target=append) for _ in range(5)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+        self.assertEqual(sorted(ids), list(range(1, 101)))
+        events = storage.get_events("concurrent", 0, limit=200)
+        self.assertEqual([e.id for e in events], list(range(1, 101)))
+
+    def test_snapshot(self):
+        storage = self.make_storage()
+        self.assertIsNone(storage.get_snapshot("snap"))
+        storage.set_snapshot("snap", 5, {"count": 2})
+        snapshot = storage.get_snapshot("snap")
+        self.assertEqual((snapshot.id, snapshot.data), (5, {"count": 2}))
+
+
+class SlowStorage(StorageBase):
+    def __init__(self):
+        self.calls = 0
+
+    def get_events(self, channel, last_id, limit=100):
+        self.calls += 1
+        time.sleep(0.1)
+        return ["event"]
+
+
+class ReadCoalescerTest(TestCase):
+    def test_concurrent_reads_share_one_fetch(self):
+        storage = SlowStorage()
+        coalescer = ReadCoalescer(storage)
+
+        results = []
+
+        def read():
+            results.append(coalescer.get_events("channel", 5, limit=10))
+
+        threads = [threading.Thread(target=read) for _ in range(10)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+        self.assertEqual(storage.calls, 1)
+        self.assertEqual(results, [["event"]] * 10)
+
+    def test_results_cached_by_current_id(self):
+        storage = SlowStorage()
+        coalescer = ReadCoalescer(storage)
+
+        coalescer.get_events("channel", 5, limit=10, current_id=7)
+        coalescer.get_events("channel", 5, limit=10, current_id=7)
+        self.assertEqual(storage.calls, 1)
+
+        coalescer.get_events("channel", 5, limit=10, current_id=8)
+        self.assertEqual(storage.calls, 2)
+
+    def test_cached_errors_raised_as_new_instances(self):
+        storage = SlowStorage()
+
+        def get_events(*args, **kwargs):
+            storage.calls += 1
+            raise EventDoesNotExist("No such event 5", 7)
+
+        storage.get_events = get_events
+        coalescer = ReadCoalescer(storage)
+
+        errors = []
+        for _ in range(3):
+            with self.assertRaises(EventDoesNotExist) as cm:
+                coalescer.get_events("channel", 5, limit=10, current_id=7)
+            errors.append(cm.exception)
+
+        self.assertEqual(storage.calls, 1)
+        self.assertEqual(len(set(id(e) for e in errors)), 3)
+        self.assertEqual([e.current_id for e in errors], [7, 7, 7])
+
+    def test_partial_results_not_cached(self):
+        storage = SlowStorage()
+        storage.get_events = lambda *args, **kwargs: PartialEvents()
+        coalescer = ReadCoalescer(storage)
+
+        coalescer.get_events("channel", 5, limit=10, current_id=7)
+        self.assertEqual(coalescer.results, {})
+
+
+@unittest.skipUnless(redis, "redis package is not installed")
+@override_settings(
+    EVENTSTREAM_STORAGE_CLASS="django_eventstream.storage.RedisStorage",
+    EVENTSTREAM_STORAGE_CONNECTION={"host": "pooltest", "port": 6379},
+    EVENTSTREAM_REDIS_MAX_CONNECTIONS=4,
+)
+class RedisStoragePoolTest(TestCase):
+    @patch("redis.connection.Connection.can_read", return_value=False)
+    @patch("redis.connection.Connection.connect")
+    def test_connection_count_flat_across_threads(self, *mocks):
+        storages = []
+        lock = threading.Lock()
+
+        def use_connection():
+            storage = utils.get_storage()
+            pool = storage.redis.connection_pool
+            conn = pool.get_connection()
+            time.sleep(0.01)
+            pool.release(conn)
+            with lock:
+                storages.append(storage)
+
+        threads = [threading.Thread(target=use_connection) for _ in range(32)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+        self.assertEqual(len(set(id(s) for s in storages)), 1)
+        self.assertIsInstance(storages[0], RedisStorage)
+
+        stats = [s for s in utils.get_redis_pool_stats() if s["host"] == "pooltest"]
+        self.assertEqual(len(stats), 1)
+        self.assertLessEqual(stats[0]["created"], 4)
+        self.assertEqual(stats[0]["in_use"], 0)
+
+    def test_pool_stats_without_internals(self):
+        pool = SimpleNamespace(
+            connection_kwargs={"host": "opaque", "port": 6379, "db": 0},
+            max_connections=4,
+        )
+        clients = {"opaque": SimpleNamespace(connection_pool=pool)}
+
+        with patch.object(utils, "redis_clients", clients):
+            stats = utils.get_redis_pool_stats()
+
+        self.assertEqual(
+            stats, [{"host": "opaque", "port": 6379, "db": 0, "max_connections": 4}]
+        )
+
+
+@unittest.skipUnless(redis, "redis package is not installed")
+class RedisStorageAsyncTest(IsolatedAsyncioTestCase):
+    async def test_aappend_event(self):
+        with FakeRedisServer() as server:
+            with override_settings(
+                EVENTSTREAM_STORAGE_CONNECTION=server.connection_details
+            ):
+                storage = RedisStorage()
+            self.addAsyncCleanup(
+                utils.get_async_redis_client(storage.connection_details).aclose
+            )
+
+            e = await storage.aappend_event("async", "message", {"a": 1})
+            self.assertEqual(e.id, 1)
+            e = await storage.aappend_event("async", "other", "x")
+            self.assertEqual(e.id, 2)
+
+            # readable by the sync client
+            events = await sync_to_async(storage.get_events)("async", 0)
+            self.assertEqual(
+                [(e.type, e.data, e.id) for e in events],
+                [("message", {"a": 1}, 1), ("other", "x", 2)],
+            )
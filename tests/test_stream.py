@@ -3,8 +3,9 @@ from __future__ import unicode_literals
 import asyncio
 
 from asgiref.sync import sync_to_async
-from django.test import TestCase
-from django_eventstream.views import Listener, stream
+from django.test import TestCase, override_settings
+from django_eventstream.event import Event
+from django_eventstream.views import Listener, stream, get_listener_manager
 from django_eventstream.eventrequest import EventRequest
 from unittest import IsolatedAsyncioTestCase
 
@@ -49,6 +50,349 @@ class DjangoStreamTest(IsolatedAsyncioTestCase):
             # print(self.storage.get_events.call_args_list)
             self.__assert_all_events_are_retrieved_only_once()
 
+    @override_settings(EVENTSTREAM_FLUSH_DELAY=100)
+    @patch("django_eventstream.eventstream.get_storage")
+    async def test_stream_flush_delay_groups_events(self, mock_get_storage):
+        mock_get_storage.return_value = None
+
+        request = self.__create_event_request()
+        request.channel_last_ids = {}
+        listener = Listener()
+        listener.channels = set(request.channels)
+
+        response = stream(request, listener)
+        try:
+            # padding and stream-open
+            await response.__anext__()
+
+            async def publish():
+                for i in range(3):
+                    get_listener_manager().add_to_queues(
+                        CHANNEL_NAME, Event(CHANNEL_NAME, "message", str(i))
+                    )
+                    await asyncio.sleep(0.01)
+
+            asyncio.create_task(publish())
+            chunk = await response.__anext__()
+        finally:
+            await response.aclose()
+
+        self.assertEqual(chunk.count("event: message\n"), 3)
+
+    @override_settings(EVENTSTREAM_TRACE_SAMPLE_RATE=1)
+    @patch("django_eventstream.eventstream.get_storage")
+    async def test_stream_traces_event_stages(self, mock_get_storage):
+        from django_eventstream import send_event
+        from django_eventstream.metrics import Metrics
+
+        mock_get_storage.return_value = None
+
+        request = self.__create_event_request()
+        request.channel_last_ids = {}
+        listener = Listener()
+        listener.channels = set(request.channels)
+
+        m = Metrics(enabled=True)
+        with patch("django_eventstream.metrics.metrics", m):
+            response = stream(request, listener)
+            try:
+                await response.__anext__()
+                asyncio.get_event_loop().call_later(
+                    0.01, send_event, CHANNEL_NAME, "message", "hello"
+                )
+                chunk = await response.__anext__()
+            finally:
+                await response.aclose()
+
+        self.assertIn('data: "hello"\n', chunk)
+        stages = [
+            labels[0][1]
+            for (name, labels) in m.registry.histograms
+            if name == "eventstream_trace_stage_seconds"
+        ]
+        self.assertEqual(sorted(stages), ["encode", "flush", "queue", "wake"])
+        self.assertIn(("eventstream_trace_seconds", ()), m.registry.histograms)
+
+    @patch("django_eventstream.eventstream.get_storage")
+    async def test_get_events_filters_event_types(self, mock_get_storage):
+        from django_eventstream.eventstream import get_events
+
+        mock_get_storage.return_value = self.storage
+
+        channel = "filteredchannel"
+        for event_type in ["a", "b", "a", "b"]:
+            await sync_to_async(self.storage.append_event)(channel, event_type, "x")
+
+        request = self.__create_event_request()
+        request.channels = [channel]
+        request.channel_last_ids = {channel: INITIAL_EVENT}
+        request.event_types = {"a"}
+
+        response = await sync_to_async(get_events)(request, user=None)
+
+        items = response.channel_items[channel]
+        self.assertEqual([item.id for item in items], [1, 3])
+        self.assertEqual(response.channel_read_ids[channel], 4)
+
+    @override_settings(EVENTSTREAM_SNAPSHOTS=True)
+    @patch("django_eventstream.eventstream.get_storage")
+    async def test_get_events_starts_from_snapshot(self, mock_get_storage):
+        from django_eventstream.eventstream import get_events, set_snapshot
+
+        mock_get_storage.return_value = self.storage
+
+        channel = "snapshotchannel"
+        for i in range(4):
+            await sync_to_async(self.storage.append_event)(channel, "message", i)
+        await sync_to_async(set_snapshot)(channel, {"count": 2}, event_id=2)
+
+        request = self.__create_event_request()
+        request.channels = [channel]
+        request.channel_last_ids = {}
+
+        response = await sync_to_async(get_events)(request, user=None)
+
+        items = response.channel_items[channel]
+        self.assertEqual(
+            [(item.type, item.id) for item in items],
+            [("snapshot", 2), ("message", 3), ("message", 4)],
+        )
+        self.assertEqual(items[0].data, '{"count": 2}')
+
+    def test_allocate_read_limits(self):
+        from django_eventstream.eventstream import allocate_read_limits
+
+        backlogs = {"busy": 1000}
+        for i in range(9):
+            backlogs["idle%d" % i] = 0
+
+        limits = allocate_read_limits(backlogs, 100)
+        self.assertEqual(limits["busy"], 100)
+        self.assertEqual(limits["idle0"], 10)
+
+        limits = allocate_read_limits({"a": 500, "b": 5, "c": None}, 90)
+        self.assertEqual(limits, {"a": 55, "b": 30, "c": 30})
+
+    async def test_admission_control(self):
+        from django_eventstream.views import AdmissionController
+
+        admission = AdmissionController(
+            {"rate": 1, "burst": 2, "max_catchup": 1, "queue_size": 1}
+        )
+
+        self.assertTrue(admission.admit_stream())
+        self.assertTrue(admission.admit_stream())
+        self.assertFalse(admission.admit_stream())
+
+        self.assertTrue(await admission.acquire_catchup())
+        waiting = asyncio.create_task(admission.acquire_catchup())
+        await asyncio.sleep(0)
+        self.assertFalse(await admission.acquire_catchup())
+        self.assertEqual(admission.get_stats()["queued"], 1)
+
+        admission.release_catchup()
+        self.assertTrue(await waiting)
+        admission.release_catchup()
+
+        stats = admission.get_stats()
+        self.assertEqual(stats["catching_up"], 0)
+        self.assertEqual(stats["deferred"], 1)
+        self.assertEqual(stats["rejected"], 2)
+        self.assertRegex(admission.busy_body(), r"retry: \d+\n\n$")
+
+    async def test_add_to_queues_filters_event_types(self):
+        listener = Listener()
+        listener.channels = {CHANNEL_NAME}
+        listener.event_types = {"a"}
+        listener.assign_loop()
+
+        lm = get_listener_manager()
+        lm.add_listener(listener)
+        try:
+            lm.add_to_queues(CHANNEL_NAME, Event(CHANNEL_NAME, "b", "x"))
+            self.assertEqual(listener.channel_items, {})
+
+            lm.add_to_queues(CHANNEL_NAME, Event(CHANNEL_NAME, "a", "x"))
+            self.assertEqual(len(listener.channel_items[CHANNEL_NAME]), 1)
+        finally:
+            lm.remove_listener(listener)
+
+    @patch("django_eventstream.eventstream.get_storage")
+    async def test_stream_resumes_after_conflict(self, mock_get_storage):
+        mock_get_storage.return_value = self.storage
+
+        channel = "conflictchannel"
+        for i in range(3):
+            await sync_to_async(self.storage.append_event)(channel, "message", str(i))
+
+        request = self.__create_event_request()
+        request.channels = [channel]
+        request.channel_last_ids = {channel: 0}
+        listener = Listener()
+        listener.channels = {channel}
+
+        get_events = self.storage.get_events
+        reads = []
+
+        def read(ch, last_id, limit=100):
+            reads.append(last_id)
+            events = get_events(ch, last_id, limit=limit)
+            if len(reads) == 1:
+                # published while reading, so queued as well
+                e = self.storage.append_event(channel, "message", "3")
+                get_listener_manager().add_to_queues(channel, e)
+            return events
+
+        with patch.object(self.storage, "get_events", read):
+            response = stream(request, listener)
+            try:
+                body = await response.__anext__()
+                body += await response.__anext__()
+            finally:
+                await response.aclose()
+
+        # read again after what was sent, not from where the first read began
+        self.assertEqual(reads, [0, 3])
+        for i in range(4):
+            self.assertEqual(body.count("data: %d\n" % i), 1)
+
+    @override_settings(EVENTSTREAM_ID_ALLOCATION="sequence")
+    @patch("django_eventstream.eventstream.get_storage")
+    async def test_stream_rereads_out_of_order_items(self, mock_get_storage):
+        mock_get_storage.return_value = self.storage
+
+        channel = "reorderchannel"
+        await sync_to_async(self.storage.append_event)(channel, "message", "0")
+
+        request = self.__create_event_request()
+        request.channels = [channel]
+        request.channel_last_ids = {channel: 1}
+        listener = Listener()
+        listener.channels = {channel}
+
+        with patch.object(
+            self.storage, "get_events", wraps=self.storage.get_events
+        ) as get_events:
+            response = stream(request, listener)
+            try:
+                # padding and stream-open
+                await response.__anext__()
+
+                # wait until the stream is waiting for queued items
+                chunk = asyncio.ensure_future(response.__anext__())
+                await asyncio.sleep(0.1)
+
+                e1 = await sync_to_async(self.storage.append_event)(
+                    channel, "message", "1"
+                )
+                e2 = await sync_to_async(self.storage.append_event)(
+                    channel, "message", "2"
+                )
+                get_listener_manager().add_to_queues(channel, e2)
+                get_listener_manager().add_to_queues(channel, e1)
+
+                body = await chunk
+            finally:
+                await response.aclose()
+
+        # the queued items are tossed and read from db, in order
+        get_events.assert_called_with(channel, 1, limit=EVENTS_LIMIT + 1)
+        self.assertEqual(body.count("event: message\n"), 2)
+        self.assertLess(body.index("data: 1\n"), body.index("data: 2\n"))
+
+    @patch("django_eventstream.eventstream.get_storage")
+    async def test_stream_sends_dispatched_message(self, mock_get_storage):
+        from django_eventstream.eventstream import make_message
+        from django_eventstream.views import dispatch_message
+
+        mock_get_storage.return_value = self.storage
+
+        channel = "dispatchchannel"
+        await sync_to_async(self.storage.append_event)(channel, "message", "0")
+
+        request = self.__create_event_request()
+        request.channels = [channel]
+        request.channel_last_ids = {channel: 1}
+        listener = Listener()
+        listener.channels = {channel}
+
+        response = stream(request, listener)
+        try:
+            # padding and stream-open
+            await response.__anext__()
+
+            # wait until the stream is waiting for queued items
+            chunk = asyncio.ensure_future(response.__anext__())
+            await asyncio.sleep(0.1)
+
+            # as received from another process, with the id as a string
+            e = await sync_to_async(self.storage.append_event)(channel, "message", "1")
+            dispatch_message(make_message(e), "redis")
+
+            body = await chunk
+        finally:
+            await response.aclose()
+
+        self.assertEqual(body, "event: message\nid: dispatchchannel:2\ndata: 1\n\n")
+
+    @patch("django_eventstream.eventstream.get_storage")
+    async def test_asend_event(self, mock_get_storage):
+        from django_eventstream import asend_event
+
+        mock_get_storage.return_value = self.storage
+
+        listener = Listener()
+        listener.channels = {"asendchannel"}
+        listener.assign_loop()
+        listener.wake_threadsafe = lambda: self.fail("woken through the loop")
+
+        lm = get_listener_manager()
+        lm.add_listener(listener)
+        try:
+            await asend_event("asendchannel", "message", {"a": 1})
+        finally:
+            lm.remove_listener(listener)
+
+        # set without a trip through the loop
+        self.assertTrue(listener.aevent.is_set())
+        items = listener.channel_items["asendchannel"]
+        self.assertEqual([(e.id, e.data) for e in items], [(1, '{"a": 1}')])
+
+        events = await sync_to_async(self.storage.get_events)("asendchannel", 0)
+        self.assertEqual([e.data for e in events], ['{"a": 1}'])
+
+    @patch("django_eventstream.eventstream.get_storage")
+    async def test_asend_event_publishes_to_redis(self, mock_get_storage):
+        import json
+        from django_eventstream import asend_event, eventstream, utils
+        from benchmarks.fakeredis import FakeRedisServer
+
+        mock_get_storage.return_value = None
+
+        with FakeRedisServer() as server:
+            details = server.connection_details
+            self.addAsyncCleanup(utils.get_async_redis_client(details).aclose)
+
+            # the sync client is only checked for, not used
+            with (
+                override_settings(EVENTSTREAM_REDIS=details),
+                patch.object(eventstream, "redis_client", True),
+            ):
+                await asend_event("redischannel", "message", "x")
+
+        self.assertEqual(len(server.published), 1)
+        name, payload = server.published[0]
+        self.assertEqual(name, b"events_channel")
+        self.assertEqual(
+            json.loads(payload),
+            {
+                "channel": "redischannel",
+                "event_type": "message",
+                "data": '"x"',
+                "pub_id": None,
+            },
+        )
+
     def __assert_all_events_are_retrieved_only_once(self):
         self.storage.get_events.assert_any_call(
             CHANNEL_NAME, INITIAL_EVENT, limit=EVENTS_LIMIT + 1
@@ -1,13 +1,186 @@
 # -*- coding: utf-8 -*-
 from __future__ import unicode_literals
 
-from django.test import TestCase
-from django_eventstream import utils
+import json
+import threading
+import uuid
+import zlib
+
+from django.test import RequestFactory, TestCase, override_settings
+from django_eventstream import authcache, utils
+from django_eventstream.channelmanager import DefaultChannelManager
+from unittest.mock import Mock, patch
 
 
 class UtilsTest(TestCase):
     def test_sse_encode_event(self):
-        self.assertEqual(utils.sse_encode_event("message", "hello"), "event: message\ndata: hello\n\n")
+        self.assertEqual(
+            utils.sse_encode_event("message", "hello"),
+            "event: message\ndata: hello\n\n",
+        )
 
         # Check sanitization
-        self.assertEqual(utils.sse_encode_event("message\nevent: foo", "hello\rworld", event_id="1\nevent_id: 2"), "event: messageevent: foo\nid: 1event_id: 2\ndata: hello\ndata: world\n\n")
+        self.assertEqual(
+            utils.sse_encode_event(
+                "message\nevent: foo", "hello\rworld", event_id="1\nevent_id: 2"
+            ),
+            "event: messageevent: foo\nid: 1event_id: 2\ndata: hello\ndata: world\n\n",
+        )
+
+    def test_compact_id(self):
+        channels = {"a-long-channel-name", "another-long-channel-name", "c"}
+        ids = {"a-long-channel-name": 5, "another-long-channel-name": 300}
+
+        compact = utils.make_compact_id(ids, channels)
+        self.assertTrue(utils.is_compact_id(compact))
+        self.assertLess(len(compact), len(utils.make_id(ids)))
+
+        self.assertEqual(
+            utils.parse_compact_id(compact, channels),
+            {"a-long-channel-name": "5", "another-long-channel-name": "300"},
+        )
+
+        # ids made for a different set of channels are ignored
+        self.assertEqual(utils.parse_compact_id(compact, {"c"}), {})
+
+        self.assertEqual(
+            utils.parse_last_event_id("a:1,b%20c:2"), {"a": "1", "b%20c": "2"}
+        )
+
+    @override_settings(EVENTSTREAM_COMPRESSION=["gzip", "deflate"])
+    def test_negotiate_stream_encoding(self):
+        factory = RequestFactory()
+
+        request = factory.get("/", HTTP_ACCEPT_ENCODING="deflate, gzip;q=0.5")
+        self.assertEqual(utils.negotiate_stream_encoding(request), "gzip")
+
+        request = factory.get("/", HTTP_ACCEPT_ENCODING="gzip;q=0, deflate")
+        self.assertEqual(utils.negotiate_stream_encoding(request), "deflate")
+
+        request = factory.get("/", HTTP_ACCEPT_ENCODING="identity")
+        self.assertIsNone(utils.negotiate_stream_encoding(request))
+
+    def test_stream_compressor_flushes_each_chunk(self):
+        compressor = utils.StreamCompressor("gzip")
+        decompressor = zlib.decompressobj(31)
+
+        for chunk in ["event: stream-open\ndata:\n\n", "event: keep-alive\ndata:\n\n"]:
+            out = decompressor.decompress(compressor.compress(chunk))
+            self.assertEqual(out, chunk.encode("utf-8"))
+
+
+class CountingChannelManager(DefaultChannelManager):
+    def __init__(self):
+        self.checks = 0
+
+    def can_read_channel(self, user, channel):
+        self.checks += 1
+        return True
+
+
+class AuthorizationCacheTest(TestCase):
+    @override_settings(EVENTSTREAM_AUTHORIZATION_CACHE_TTL=60)
+    def test_can_read_channel_cached_until_invalidated(self):
+        cache = authcache.LocalAuthorizationCache()
+        channelmanager = CountingChannelManager()
+
+        with patch("django_eventstream.authcache.get_authorization_cache") as m:
+            m.return_value = cache
+
+            self.assertTrue(authcache.can_read_channel(channelmanager, None, "a"))
+            self.assertTrue(authcache.can_read_channel(channelmanager, None, "a"))
+            self.assertEqual(channelmanager.checks, 1)
+
+            cache.invalidate("anonymous", "a")
+            self.assertTrue(authcache.can_read_channel(channelmanager, None, "a"))
+            self.assertEqual(channelmanager.checks, 2)
+
+    @override_settings(EVENTSTREAM_AUTHORIZATION_CACHE_TTL=60)
+    def test_revoke_with_redis(self):
+        from django_eventstream import eventstream
+
+        cache = authcache.LocalAuthorizationCache()
+        cache.set("anonymous", "a", True)
+        redis_client = Mock()
+        channelmanager = Mock()
+        channelmanager.can_read_channel.return_value = False
+
+        # no listener in this process receives the published message
+        with (
+            patch.object(eventstream, "redis_client", redis_client),
+            patch(
+                "django_eventstream.eventstream.get_authorization_cache",
+                return_value=cache,
+            ),
+            patch(
+                "django_eventstream.eventstream.get_channelmanager",
+                return_value=channelmanager,
+            ),
+            patch("django_eventstream.eventstream.publish_kick") as publish_kick,
+        ):
+            eventstream.channel_permission_changed(None, "a")
+
+        self.assertIsNone(cache.get("anonymous", "a"))
+        message = json.loads(redis_client.publish.call_args[0][1])
+        self.assertEqual(message["type"], "permission-changed")
+        self.assertTrue(message["kick"])
+        publish_kick.assert_called_once_with("anonymous", "a")
+
+    def test_revoke_with_uuid_pk(self):
+        from django_eventstream import eventstream
+        from django_eventstream.views import (
+            Listener,
+            dispatch_message,
+            get_listener_manager,
+        )
+
+        user = Mock(pk=uuid.uuid4())
+        redis_client = Mock()
+        channelmanager = Mock()
+        channelmanager.can_read_channel.return_value = False
+
+        with (
+            patch.object(eventstream, "redis_client", redis_client),
+            patch(
+                "django_eventstream.eventstream.get_channelmanager",
+                return_value=channelmanager,
+            ),
+            patch("django_eventstream.eventstream.publish_kick"),
+        ):
+            eventstream.channel_permission_changed(user, "a")
+
+        message = json.loads(redis_client.publish.call_args[0][1])
+        self.assertEqual(message["user_id"], str(user.pk))
+
+        # kicks the user's listeners in the receiving process
+        listener = Listener()
+        listener.channels = {"a"}
+        listener.user_id = authcache.get_user_id(user)
+        listener.wake_threadsafe = lambda: None
+        lm = get_listener_manager()
+        lm.add_listener(listener)
+        try:
+            dispatch_message(message, "redis")
+        finally:
+            lm.remove_listener(listener)
+        self.assertEqual(listener.error["condition"], "forbidden")
+
+    def test_subscriber_starts_without_listener(self):
+        from django_eventstream.views import ListenerManager
+
+        started = threading.Event()
+        starts = []
+
+        class Subscriber(object):
+            async def start(self):
+                starts.append(1)
+                started.set()
+
+        lm = ListenerManager()
+        lm.redis_listener = Subscriber()
+
+        # no event loop here, as in a process serving only a GRIP proxy
+        lm.ensure_subscriber()
+        lm.ensure_subscriber()
+        self.assertTrue(started.wait(5))
+        self.assertEqual(starts, [1])